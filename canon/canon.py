@@ -1,7 +1,13 @@
 import collections
+import concurrent.futures
+import contextlib
 import filecmp
+import functools
 import importlib.util
 import itertools
+import json
+import locale
+import operator
 import os
 import re
 import shutil
@@ -26,12 +32,14 @@ def shorten_long_filename(file):
     return file_to_use
 
 
-def open_long_filename_to_write(file):
+# binary is for --bytes
+def open_long_filename_to_write(file, binary=False):
     path, filename = os.path.split(file)
     filename_to_use = shorten_long_filename(filename)
-    f = open(os.path.join(path, filename_to_use), "w")
+    f = open(os.path.join(path, filename_to_use), "wb" if binary else "w")
     if filename != filename_to_use:
-        f.write("Long filename: " + filename)
+        note = "Long filename: " + filename
+        f.write(note.encode(locale.getpreferredencoding(False)) if binary else note)
     return f
 
 
@@ -56,6 +64,13 @@ class DiffConfig(ConfigBase):
         self.include_references = cmd_args.include_references
         self.include_missing = not cmd_args.omit_missing_functions
         self.only_functions = cmd_args.only_functions
+        self.intern_lines = cmd_args.intern_lines
+        self.paranoid = cmd_args.paranoid
+        self.changed_regions = cmd_args.changed_regions
+        self.hash_cache = cmd_args.hash_cache
+        # The functions that are left are split from the mapped files
+        self.mmap = self.mmap or self.changed_regions
+        self.canon_per_line = cmd_args.canon_per_line
 
         self.debug_patterns = cmd_args.debug_patterns
 
@@ -100,7 +115,7 @@ class DiffTool:
             "--strategy",
             metavar="FILE",
             dest="strategy_filenames",
-            help="Specify file containing pattern matching strategy/ies",
+            help="Specify file containing pattern matching strategy/ies (Python, or declarative if it ends in .jsonl)",
             nargs="*",
             action="append",
             default=[],
@@ -157,6 +172,35 @@ class DiffTool:
             action="store_true",
             default=False,
         )
+        config_group.add_argument(
+            "--intern-lines",
+            help="keep one copy of each distinct line of a pair of input files, and canonicalize it once",
+            action="store_true",
+            default=False,
+        )
+        config_group.add_argument(
+            "--canon-per-line",
+            help="canonicalize functions line by line instead of all at once (implied by --intern-lines and --line-cache, which work per line)",
+            action="store_true",
+            default=False,
+        )
+        config_group.add_argument(
+            "--paranoid",
+            help="when function fingerprints match, compare the functions' lines too",
+            action="store_true",
+            default=False,
+        )
+        config_group.add_argument(
+            "--hash-cache",
+            metavar="FILE",
+            help="find identical input files by hashes of their contents, which are kept in FILE between runs (and hashed on --walk-threads threads)",
+        )
+        config_group.add_argument(
+            "--changed-regions",
+            help="with --only-functions, find the functions that are the same in base and diff before splitting the files, and only split the rest (implies --mmap)",
+            action="store_true",
+            default=False,
+        )
 
         filter_group.add_argument(
             "--file-limit",
@@ -166,13 +210,13 @@ class DiffTool:
         )
         filter_group.add_argument(
             "--func-limit",
-            help="Set approximate maximum number of functions with diffs to report",
+            help="Set maximum number of functions with diffs to report",
             type=int,
             default=0,
         )
         filter_group.add_argument(
             "--diff-limit",
-            help="Set approximate maximum number of diffs to report",
+            help="Set maximum number of diffs to report",
             type=int,
             default=0,
         )
@@ -199,10 +243,12 @@ class DiffTool:
         config = DiffTool.parse_args(args)
         difftool = DiffTool()
         difftool.config = config
-        difftool.stats = Stats("Total")
+        difftool.stats = Stats("Total", config.timing)
 
-        difftool.parser = parser_map()[config.kind]()
+        difftool.parser = get_parser_class(config.kind)()
         difftool.parser.config = config
+        if config.bytes_mode:
+            difftool.parser.for_bytes()
         if not config.filespecs:
             config.filespecs = [difftool.parser.default_filespec()]
 
@@ -229,92 +275,200 @@ class DiffTool:
         #
 
         rel_dir_dict = {}
-        with self.stats.timers[TimeKind.Walk]:
-            HasFile.add_dirwalk(
-                rel_dir_dict,
-                base_dir,
-                HasFile.BASE,
-                self.config.filespecs,
-                self.config.exclude_filespecs,
-            )
-            HasFile.add_dirwalk(
-                rel_dir_dict,
-                diff_dir,
-                HasFile.DIFF,
-                self.config.filespecs,
-                self.config.exclude_filespecs,
-            )
+        stat_dict = {}
+        walk_timer = self.stats.timers[TimeKind.Walk]
+
+        # Each directory is queued as soon as it has been listed in both trees, while
+        # the rest of the trees are being walked, unless the order of the jobs
+        # matters: which functions are reported up to the limits depends on it, and
+        # with -j1 the jobs run right away on this thread anyway.  Directories that
+        # are only in one of the trees are queued after the walk.
+        pipelined = self.config.jobs > 1 and not (
+            self.config.file_limit or self.config.func_limit or self.config.diff_limit
+        )
+        listed = {}  # dirpath -> HasFile of the trees it has been listed in
+        queued = []  # futures of the queue_dir calls made during the walk
+
+        def on_listed(dirpath, value):
+            listed[dirpath] = listed.get(dirpath, HasFile.NONE) | value
+            if listed[dirpath] == HasFile.BOTH and dirpath in rel_dir_dict:
+                # Comparing the files and queueing the jobs is done on queue_thread,
+                # so that the walk can keep listing directories in the meantime
+                file_dict = rel_dir_dict.pop(dirpath)
+                queued.append(
+                    queue_thread.submit(
+                        self.queue_dir,
+                        controller,
+                        dirpath,
+                        file_dict,
+                        stat_dict,
+                        hash_cache,
+                    )
+                )
 
-        #
-        # Queue a job to compare each file across base/diff
-        #
+        with FileHashCache(
+            self.config.hash_cache, self.config.walk_threads
+        ) if self.config.hash_cache else contextlib.nullcontext() as hash_cache:
+            with concurrent.futures.ThreadPoolExecutor(1) as queue_thread:
+                with walk_timer:
+                    dir_count = HasFile.add_dirwalks(
+                        rel_dir_dict,
+                        [(base_dir, HasFile.BASE), (diff_dir, HasFile.DIFF)],
+                        self.config.filespecs,
+                        self.config.exclude_filespecs,
+                        stat_dict,
+                        self.config.walk_threads,
+                        on_listed if pipelined else None,
+                    )
+                for future in queued:
+                    future.result()
+            self.stats.incr(CounterKind.WalkDirs, dir_count)
+            HasFile.print_walk_rate(dir_count, walk_timer)
 
-        for dirpath in sorted(rel_dir_dict.keys()):
-            print("Canonicalize directory {} ".format(dirpath))
-            inner_dir = os.path.basename(dirpath)
+            #
+            # Queue a job to compare each file across base/diff
+            #
+
+            for dirpath in sorted(rel_dir_dict.keys()):
+                self.queue_dir(
+                    controller, dirpath, rel_dir_dict[dirpath], stat_dict, hash_cache
+                )
+
+    # Queues the jobs for the files of one directory, file_dict being
+    # { file -> HasFile }.  hash_cache is the FileHashCache with --hash-cache.
+    def queue_dir(self, controller, dirpath, file_dict, stat_dict, hash_cache=None):
+        base_dir = self.config.base_dir
+        diff_dir = self.config.diff_dir
+
+        # This runs on queue_thread while finished jobs' stats are added to self.stats,
+        # so this directory's stats are gathered separately and added under the same
+        # lock
+        stats = Stats(dirpath, self.config.timing)
+
+        print("Canonicalize directory {} ".format(dirpath))
+        inner_dir = os.path.basename(dirpath)
+
+        compare_subdir = os.path.join(self.config.output_dir, dirpath)
+        compare_subdir_base = os.path.join(
+            compare_subdir, self.config.compare_base_name
+        )
+        compare_subdir_diff = os.path.join(
+            compare_subdir, self.config.compare_diff_name
+        )
+
+        # Files in both trees: file -> (base_file, diff_file)
+        pairs = {}
+        for file in sorted(file_dict.keys()):
+            has_file = file_dict[file]
+
+            rel_file = os.path.join(dirpath, file)
+            base_file = os.path.join(base_dir, rel_file)
+            diff_file = os.path.join(diff_dir, rel_file)
 
-            compare_subdir = os.path.join(self.config.output_dir, dirpath)
-            compare_subdir_base = os.path.join(
-                compare_subdir, self.config.compare_base_name
+            # If a file only exists on one side (and include_missing is set),
+            # create an empty file for the other to complete the pair.
+            if has_file == HasFile.BASE:
+                with stats.timers[TimeKind.Copy]:
+                    print(" Only in base: {}".format(rel_file))
+                    if self.config.include_missing:
+                        os.makedirs(compare_subdir_base, exist_ok=True)
+                        os.makedirs(compare_subdir_diff, exist_ok=True)
+                        compare_base_file = os.path.join(
+                            compare_subdir_base, change_ext(file, ".asm")
+                        )
+                        shutil.copy(base_file, compare_base_file)
+                        create_empty_file(diff_file)
+                        has_file == HasFile.BOTH
+            elif has_file == HasFile.DIFF:
+                with stats.timers[TimeKind.Copy]:
+                    print(" Only in diff: {}".format(rel_file))
+                    if self.config.include_missing:
+                        os.makedirs(compare_subdir_base, exist_ok=True)
+                        os.makedirs(compare_subdir_diff, exist_ok=True)
+                        compare_diff_file = os.path.join(
+                            compare_subdir_diff, change_ext(file, ".asm")
+                        )
+                        shutil.copy(diff_file, compare_diff_file)
+                        create_empty_file(base_file)
+                        has_file == HasFile.BOTH
+
+            if has_file == HasFile.BOTH:
+                if not (
+                    NameFilter.may_have_wanted_funcs(
+                        self.config, self.parser, base_file, inner_dir
+                    )
+                    or NameFilter.may_have_wanted_funcs(
+                        self.config, self.parser, diff_file, inner_dir
+                    )
+                ):
+                    print(" No requested functions in {}".format(rel_file))
+                    stats.incr(CounterKind.NameFiltered)
+                    continue
+
+                pairs[file] = (base_file, diff_file)
+
+        # Optimization to bypass identical files
+        with stats.timers[TimeKind.Compare]:
+            identical = self.find_identical_files(
+                dirpath, pairs, stat_dict, hash_cache
             )
-            compare_subdir_diff = os.path.join(
-                compare_subdir, self.config.compare_diff_name
+        with controller.lock:
+            self.stats.add(stats)
+
+        for file, (base_file, diff_file) in pairs.items():
+            if file in identical:
+                print(" Identical {}".format(os.path.join(dirpath, file)))
+                continue
+
+            # In both and different
+            file_label = get_without_ext(file)
+            file_for_subdir = file_label if self.config.partition_files else ""
+            controller.queue_job(
+                self.process_file,
+                base_file,
+                diff_file,
+                compare_subdir,
+                inner_dir,
+                file_for_subdir,
+                file_label,
+                files=(base_file, diff_file),
             )
 
-            file_dict = rel_dir_dict[dirpath]
-            for file in sorted(file_dict.keys()):
-                has_file = file_dict[file]
-
-                rel_file = os.path.join(dirpath, file)
-                base_file = os.path.join(base_dir, rel_file)
-                diff_file = os.path.join(diff_dir, rel_file)
-
-                # If a file only exists on one side (and include_missing is set),
-                # create an empty file for the other to complete the pair.
-                if has_file == HasFile.BASE:
-                    with self.stats.timers[TimeKind.Copy]:
-                        print(" Only in base: {}".format(rel_file))
-                        if self.config.include_missing:
-                            os.makedirs(compare_subdir_base, exist_ok=True)
-                            os.makedirs(compare_subdir_diff, exist_ok=True)
-                            compare_base_file = os.path.join(
-                                compare_subdir_base, change_ext(file, ".asm")
-                            )
-                            shutil.copy(base_file, compare_base_file)
-                            create_empty_file(diff_file)
-                            has_file == HasFile.BOTH
-                elif has_file == HasFile.DIFF:
-                    with self.stats.timers[TimeKind.Copy]:
-                        print(" Only in diff: {}".format(rel_file))
-                        if self.config.include_missing:
-                            os.makedirs(compare_subdir_base, exist_ok=True)
-                            os.makedirs(compare_subdir_diff, exist_ok=True)
-                            compare_diff_file = os.path.join(
-                                compare_subdir_diff, change_ext(file, ".asm")
-                            )
-                            shutil.copy(diff_file, compare_diff_file)
-                            create_empty_file(base_file)
-                            has_file == HasFile.BOTH
-
-                if has_file == HasFile.BOTH:
-                    # Optimization to bypass identical files
-                    with self.stats.timers[TimeKind.Compare]:
-                        if filecmp.cmp(base_file, diff_file, shallow=False):
-                            print(" Identical {}".format(rel_file))
-                            continue
-
-                    # In both and different
-                    file_label = get_without_ext(file)
-                    file_for_subdir = file_label if self.config.partition_files else ""
-                    controller.queue_job(
-                        self.process_file,
-                        base_file,
-                        diff_file,
-                        compare_subdir,
-                        inner_dir,
-                        file_for_subdir,
-                        file_label,
-                    )
+    # Returns the files of 'pairs' ({ file -> (base_file, diff_file) } in dirpath)
+    # whose base and diff are identical.  Files of different sizes (as found by the
+    # walk) aren't, and two names of the same file (e.g., hard links) are.  The rest
+    # are compared by hashes with --hash-cache, or else with filecmp.
+    def find_identical_files(self, dirpath, pairs, stat_dict, hash_cache=None):
+        identical = set()
+        to_compare = []
+        for file, (base_file, diff_file) in pairs.items():
+            base_stat = stat_dict.get((dirpath, file, HasFile.BASE))
+            diff_stat = stat_dict.get((dirpath, file, HasFile.DIFF))
+            if base_stat is not None and diff_stat is not None:
+                if base_stat.st_size != diff_stat.st_size:
+                    continue
+                # The inode numbers of the walk are 0 where they aren't known
+                # (Windows)
+                if base_stat.st_ino and os.path.samestat(base_stat, diff_stat):
+                    identical.add(file)
+                    continue
+            to_compare.append((file, base_file, diff_file, base_stat, diff_stat))
+
+        if hash_cache is None:
+            for file, base_file, diff_file, _, _ in to_compare:
+                if filecmp.cmp(base_file, diff_file, shallow=False):
+                    identical.add(file)
+            return identical
+
+        files = []
+        for _, base_file, diff_file, base_stat, diff_stat in to_compare:
+            files.append((base_file, base_stat))
+            files.append((diff_file, diff_stat))
+        hashes = hash_cache.get_hashes(files)
+        for index, (file, _, _, _, _) in enumerate(to_compare):
+            if hashes[2 * index] == hashes[2 * index + 1]:
+                identical.add(file)
+        return identical
 
     def process_extras(self, controller):
         # controller.extra_funcs is
@@ -326,7 +480,7 @@ class DiffTool:
         if controller.hit_any_limit():
             return
 
-        stats = Stats("extra")
+        stats = Stats("extra", self.config.timing)
 
         for compare_subdir, (base_funcs, diff_funcs) in controller.extra_funcs.items():
             len_base = len(base_funcs)
@@ -358,30 +512,91 @@ class DiffTool:
 
         self.stats.add(stats)
 
-    # funcs is { func -> (lines, canon_lines) }.
-    # canon_lines is empty and will be filled in here.
-    def canon_file(self, stats, funcs, file_label):
+    # Canonicalizes the functions in base_funcs and diff_funcs (both { name -> Function
+    # or LazyFunction or SpilledFunction } with the same names) a pair at a time, and
+    # removes the pairs whose canonicalized lines are the same.  Those are compared by
+    # their canon_hash (and, if paranoid, their canonicalized lines), so
+    # canon_lines is only filled in for the functions that remain.
+    # With a LineTable, the canonicalized lines are interned too.
+    def canon_match_file(self, stats, base_funcs, diff_funcs, file_label, line_table):
         print("  Canon {}".format(file_label))
-        for (func, (lines, canon_lines)) in funcs.items():
-            stats.incr(CounterKind.CanonCount)
-            for line in lines:
-                with stats.timers[TimeKind.Canon]:
-                    canoned_line = self.parser.canon_line(line)
+        self.parser.start_line_cache_scope(stats, "pass")
+        canon_line = self.parser.get_line_cache("canon_line")
+        if line_table:
+            canon_line = functools.partial(line_table.canon, canon_line=canon_line)
+        by_block = self.parser.by_block() and not (
+            self.config.canon_per_line or line_table or self.config.line_cache
+        )
+        paranoid = self.config.paranoid
 
-                with stats.timers[TimeKind.Append]:
-                    canon_lines.append(canoned_line)
+        to_delete = []
+        for funcname, base_func in base_funcs.items():
+            diff_func = diff_funcs[funcname]
+            stats.incr(CounterKind.CanonCount, 2)
+            base_canon = self.canon_function(stats, base_func, canon_line, by_block)
+            diff_canon = self.canon_function(stats, diff_func, canon_line, by_block)
+
+            with stats.timers[TimeKind.CanonMatch]:
+                if base_canon is None or diff_canon is None:
+                    same = same_function_canon_lines(base_func, diff_func, paranoid)
+                else:
+                    same = base_func.canon_hash == diff_func.canon_hash and (
+                        not paranoid or base_canon == diff_canon
+                    )
+            if same:
+                stats.incr(CounterKind.CanonMatch)
+                to_delete.append(funcname)
+                continue
+
+            for func, canon in [(base_func, base_canon), (diff_func, diff_canon)]:
+                if canon is not None and by_block:
+                    canon = self.parser.split_text(canon)
+                if canon is not None:
+                    func.canon_lines = canon
+
+        for funcname in to_delete:
+            del base_funcs[funcname]
+            del diff_funcs[funcname]
+
+        self.parser.report_line_caches(stats)
+
+    # Canonicalizes one function and sets its canon_hash.  Returns the canonicalized
+    # lines, or if by_block, the canonicalized text (split into lines only if they
+    # are needed).  None for a SpilledFunction, which is canonicalized a chunk at a
+    # time when it's compared or written.
+    def canon_function(self, stats, func, canon_line, by_block):
+        if isinstance(func, SpilledFunction):
+            return None
+        if by_block:
+            with stats.timers[TimeKind.Canon]:
+                canon_text = self.parser.canon_text_by_block(func.lines)
+                func.canon_hash = fingerprint(canon_text)
+            return canon_text
+
+        canon_lines = []
+        for line in func.lines:
+            with stats.timers[TimeKind.Canon]:
+                canoned_line = canon_line(line)
+
+            with stats.timers[TimeKind.Append]:
+                canon_lines.append(canoned_line)
+
+        with stats.timers[TimeKind.Canon]:
+            func.canon_hash = fingerprint(self.parser.empty.join(canon_lines))
+        return canon_lines
 
     # funcs is a dict: name (str) -> Function
     def write_files(self, output_dir, base_diff, funcs, file_for_subdir):
         output_dir = os.path.join(output_dir, file_for_subdir, base_diff)
         os.makedirs(output_dir, exist_ok=True)
+        binary = self.parser.is_bytes
         for funcname, function in funcs.items():
             with open_long_filename_to_write(
-                os.path.join(output_dir, funcname + ".asm")
+                os.path.join(output_dir, funcname + ".asm"), binary
             ) as asm:
                 asm.writelines(function.lines)
             with open_long_filename_to_write(
-                os.path.join(output_dir, funcname + ".canon")
+                os.path.join(output_dir, funcname + ".canon"), binary
             ) as canon:
                 canon.writelines(function.canon_lines)
 
@@ -390,6 +605,8 @@ class DiffTool:
     # that replaces the current one.  This can be used to represent the state of
     # having partially processed a DiffCommand.  See MatchContext.get_command.
     class Position:
+        __slots__ = ("command_index", "updated_current_command")
+
         def __init__(self, command_index, updated_current_command=None):
             self.command_index = command_index
             self.updated_current_command = updated_current_command
@@ -425,6 +642,11 @@ class DiffTool:
             self.strategies = strategies
             self.skips = skips
 
+            # Used by strategies made only of literal lines (see get_literal_lines)
+            self.line_table = {}
+            self.line_ids = {}
+            self.literal_starts = {}
+
         def get_command(self, position):
             updated = position.updated_current_command
             return (
@@ -439,15 +661,64 @@ class DiffTool:
                 or position.command_index < len(self.commands)
             )
 
+        # Returns the lines of the base or diff as interned ids.  The ids are shared
+        # between base and diff.  A trailing newline is dropped since the "$" that
+        # ends every compiled pattern line matches before it.
+        def get_line_ids(self, is_base):
+            line_ids = self.line_ids.get(is_base)
+            if line_ids is None:
+                lines = self.base_file_lines if is_base else self.diff_file_lines
+                line_table = self.line_table
+                line_ids = [
+                    line_table.setdefault(
+                        line[:-1] if line[-1:] == "\n" else line, len(line_table)
+                    )
+                    for line in lines
+                ]
+                self.line_ids[is_base] = line_ids
+            return line_ids
+
+        # Returns the set of line numbers at which the literal lines of a strategy start
+        # in the base or diff.  All occurrences are found with one pass over the lines.
+        def get_literal_starts(self, strategy, is_base):
+            key = (id(strategy), is_base)
+            starts = self.literal_starts.get(key)
+            if starts is None:
+                line_ids = self.get_line_ids(is_base)
+                literals = strategy.literal_lines[1 if is_base else 0]
+                pattern = [self.line_table.get(literal) for literal in literals]
+                if None in pattern:
+                    starts = set()
+                else:
+                    starts = set(find_subsequences(line_ids, pattern))
+                self.literal_starts[key] = starts
+            return starts
+
+        # Returns False if a strategy made of literal lines can't match at 'position'
+        def literal_match_possible(self, strategy, position):
+            command = self.get_command(position)
+            diff_literals, base_literals = strategy.literal_lines
+            if diff_literals and command.diff_range.start not in (
+                self.get_literal_starts(strategy, False)
+            ):
+                return False
+            if base_literals and command.base_range.start not in (
+                self.get_literal_starts(strategy, True)
+            ):
+                return False
+            return True
+
     # After a Diff is matched in a Strategy, the line numbers in the base and diff files
     # are stored in an ExpectedLines so that the next Diff can be checked to start at an
     # expected location.  A Gap will be used to allow Space between the Diffs (and is
     # necessary because if there is no space, then the Diffs could just be combined).
     class ExpectedLines:
+        __slots__ = ("diff", "base", "gap")
+
         def __init__(self, diff, base, gap=None):
             self.diff = diff
             self.base = base
-            self.gap = gap if gap else Gap(Range(0))
+            self.gap = gap if gap else no_gap
 
         def with_gap(self, gap):
             # might be worth checking this: assert self.gap is None
@@ -480,23 +751,48 @@ class DiffTool:
     # that a second copy of a skip can not begin to be processed until the previous one is
     # finished.
     #
-    # mappings stores any assigned variables just like with Strategies.
+    # mappings stores any assigned variables just like with Strategies.  They are only
+    # allocated once a skip starts matching.
+    #
+    # A SkipState is created for every strategy tried at every position, and the completion
+    # checks are made on every iteration of match_strategy, so the number of skips with
+    # outstanding differences or progress on each side is kept up to date in set_progress
+    # rather than recomputed by scanning.
     class SkipState:
+        __slots__ = (
+            "skips",
+            "match_differences",
+            "base_progress",
+            "diff_progress",
+            "mappings",
+            "base_pending",
+            "diff_pending",
+            "base_active",
+            "diff_active",
+        )
+
         def __init__(self, skips):
             size = len(skips)
             self.skips = skips
             self.match_differences = [0] * size
             self.base_progress = [0] * size
             self.diff_progress = [0] * size
-            self.mappings = [{} for _ in range(size)]
+            self.mappings = [None] * size
+
+            # number of skips with match_differences < 0 (base_pending) or > 0 (diff_pending)
+            self.base_pending = 0
+            self.diff_pending = 0
+            # number of skips with a partial match in base_progress/diff_progress
+            self.base_active = 0
+            self.diff_active = 0
 
         def __str__(self):
             d = {}
-            if any(self.match_differences):
+            if self.base_pending or self.diff_pending:
                 d["match_differences"] = self.match_differences
-            if any(self.base_progress):
+            if self.base_active:
                 d["base_progress"] = self.base_progress
-            if any(self.diff_progress):
+            if self.diff_active:
                 d["diff_progress"] = self.diff_progress
             return str(d)
 
@@ -505,33 +801,31 @@ class DiffTool:
 
         def is_complete(self):
             return not (
-                any(self.match_differences)
-                or any(self.base_progress)
-                or any(self.diff_progress)
+                self.base_pending
+                or self.diff_pending
+                or self.base_active
+                or self.diff_active
             )
 
         def diff_is_complete(self):
-            return not (
-                any(d > 0 for d in self.match_differences) or any(self.diff_progress)
-            )
+            return not (self.diff_pending or self.diff_active)
 
         def base_is_complete(self):
-            return not (
-                any(d < 0 for d in self.match_differences) or any(self.base_progress)
-            )
+            return not (self.base_pending or self.base_active)
 
         def needs_progress(self, is_base, index):
-            if is_base and self.match_differences[index] > 0:
-                return True
-            if (not is_base) and self.match_differences[index] < 0:
-                return True
-            return False
+            if is_base:
+                return self.match_differences[index] > 0
+            return self.match_differences[index] < 0
 
         def get_progress(self, is_base, index):
+            mapping = self.mappings[index]
+            if mapping is None:
+                mapping = self.mappings[index] = {}
             if is_base:
-                return self.base_progress[index], self.mappings[index]
+                return self.base_progress[index], mapping
             else:
-                return self.diff_progress[index], self.mappings[index]
+                return self.diff_progress[index], mapping
 
         # pattern_index may be len(skips.{base,diff}_lines, in which case it set
         # match_differences and reset progress.
@@ -549,11 +843,21 @@ class DiffTool:
 
             if pattern_index >= len(patterns):
                 if len(other) > 0:
-                    self.match_differences[index] += incr
-                progress[index] = 0
-                self.mappings[index] = {}
+                    old = self.match_differences[index]
+                    new = old + incr
+                    self.match_differences[index] = new
+                    self.base_pending += (new < 0) - (old < 0)
+                    self.diff_pending += (new > 0) - (old > 0)
+                pattern_index = 0
+                self.mappings[index] = None
+
+            old_progress = progress[index]
+            progress[index] = pattern_index
+            active_change = (pattern_index != 0) - (old_progress != 0)
+            if is_base:
+                self.base_active += active_change
             else:
-                progress[index] = pattern_index
+                self.diff_active += active_change
 
     # Try to match one "pattern line" (from either the base or diff of a strategy element)
     @indent_decorator("check pattern {} at line {}", 2, 4)
@@ -989,7 +1293,7 @@ class DiffTool:
             mapping,
             element,
             context.diff_file_lines,
-            lambda command: command.diff_range,
+            get_diff_range,
             position,
             context,
             is_base=False,
@@ -1004,7 +1308,7 @@ class DiffTool:
             mapping,
             element,
             context.base_file_lines,
-            lambda command: command.base_range,
+            get_base_range,
             position,
             context,
             is_base=True,
@@ -1183,6 +1487,11 @@ class DiffTool:
     # Otherwise, return None.
     def match_strategies(self, position, context):
         for strategy_index, strategy in enumerate(context.strategies):
+            if (
+                strategy.literal_lines is not None
+                and not context.literal_match_possible(strategy, position)
+            ):
+                continue
             with self.config.indent(
                 "strategy {} - {} at {}", strategy_index, strategy.name, position
             ):
@@ -1193,6 +1502,10 @@ class DiffTool:
                     return result
 
         for skip_index, skip in enumerate(context.skips):
+            if skip.literal_lines is not None and not context.literal_match_possible(
+                skip, position
+            ):
+                continue
             with self.config.indent(
                 "skip {} - {} at {}", skip_index, skip.name, position
             ):
@@ -1235,16 +1548,9 @@ class DiffTool:
     def write_d_file(
         self, stats, compare_subdir, file_for_subdir, funcname, base_func, diff_func
     ):
-        base_output_dir = os.path.join(
-            compare_subdir, file_for_subdir, self.config.compare_base_name
+        base_canon_file, diff_canon_file, diff_file = self.get_function_files(
+            compare_subdir, file_for_subdir, funcname
         )
-        diff_output_dir = os.path.join(
-            compare_subdir, file_for_subdir, self.config.compare_diff_name
-        )
-        filename = shorten_long_filename(funcname + ".canon")
-        base_canon_file = os.path.join(base_output_dir, filename)
-        diff_canon_file = os.path.join(diff_output_dir, filename)
-        diff_file = change_ext(diff_canon_file, ".d")
         self.config.print("Function {}", funcname)
 
         with stats.timers[TimeKind.WriteDiff]:
@@ -1265,13 +1571,18 @@ class DiffTool:
             stats.incr(CounterKind.RawDiff, len(diff_commands))
             context = DiffTool.MatchContext(
                 stats,
-                base_func.lines,
-                diff_func.lines,
+                self.parser.text_lines(base_func.lines),
+                self.parser.text_lines(diff_func.lines),
                 diff_commands,
                 self.config.filter_diff_strategies,
                 self.config.filter_diff_skips,
             )
             diff_commands = self.filter_diff(context)
+
+            # Other workers may have used up --diff-limit/--func-limit in the meantime
+            limits = SharedLimits.current
+            if limits is not None and diff_commands:
+                diff_commands = diff_commands[: limits.reserve(len(diff_commands))]
             stats.incr(CounterKind.FinalDiff, len(diff_commands))
 
             if diff_commands:
@@ -1281,14 +1592,35 @@ class DiffTool:
                 with open(diff_file, "w") as write_diff_file:
                     write_diff_file.writelines(output_diff_commands)
             else:
-                os.remove(change_ext(base_canon_file, ".asm"))
-                os.remove(change_ext(diff_canon_file, ".asm"))
-                os.remove(base_canon_file)
-                os.remove(diff_canon_file)
+                self.remove_function_files(compare_subdir, file_for_subdir, funcname)
+
+    # Returns the paths of the base .canon, diff .canon and .d files for a function
+    def get_function_files(self, compare_subdir, file_for_subdir, funcname):
+        base_output_dir = os.path.join(
+            compare_subdir, file_for_subdir, self.config.compare_base_name
+        )
+        diff_output_dir = os.path.join(
+            compare_subdir, file_for_subdir, self.config.compare_diff_name
+        )
+        filename = shorten_long_filename(funcname + ".canon")
+        base_canon_file = os.path.join(base_output_dir, filename)
+        diff_canon_file = os.path.join(diff_output_dir, filename)
+        diff_file = change_ext(diff_canon_file, ".d")
+        return base_canon_file, diff_canon_file, diff_file
+
+    # Removes the files written for a function that has nothing to report
+    def remove_function_files(self, compare_subdir, file_for_subdir, funcname):
+        base_canon_file, diff_canon_file, diff_file = self.get_function_files(
+            compare_subdir, file_for_subdir, funcname
+        )
+        os.remove(change_ext(base_canon_file, ".asm"))
+        os.remove(change_ext(diff_canon_file, ".asm"))
+        os.remove(base_canon_file)
+        os.remove(diff_canon_file)
 
-                # Remove a .d file if it exists from an earlier run
-                if os.path.exists(diff_file):
-                    os.remove(diff_file)
+        # Remove a .d file if it exists from an earlier run
+        if os.path.exists(diff_file):
+            os.remove(diff_file)
 
     def process_file(
         self,
@@ -1324,16 +1656,63 @@ class DiffTool:
         print(" Process {}".format(file_label))
         os.makedirs(compare_subdir, exist_ok=True)
 
-        stats = Stats(file_label)
-        base_funcs = self.parser.split_file(stats, base_file, inner_dir, file_label)
-        diff_funcs = self.parser.split_file(stats, diff_file, inner_dir, file_label)
+        stats = Stats(file_label, self.config.timing)
+        if SharedLimits.current_reached():
+            # The job was already queued when a limit was reached
+            print("  Limit reached, skipping {}".format(file_label))
+            return compare_subdir, {}, {}, stats
+        if self.config.name_filter:
+            # Builds the name filters that weren't there when the files were queued
+            # (both of them, for the next run)
+            may_have = [
+                NameFilter.may_have_wanted_funcs(
+                    self.config, self.parser, file, inner_dir, build=True
+                )
+                for file in (base_file, diff_file)
+            ]
+            if not any(may_have):
+                print("  No requested functions in {}".format(file_label))
+                stats.incr(CounterKind.NameFiltered)
+                return compare_subdir, {}, {}, stats
+
+        self.parser.start_line_cache_scope(stats, "file")
+        line_table = LineTable() if self.config.intern_lines else None
+        unchanged = ()
+        if self.config.changed_regions:
+            print("  Finding changed functions in {}".format(file_label))
+            unchanged = self.parser.find_unchanged_funcs(
+                stats, base_file, diff_file, inner_dir
+            )
+        base_funcs = self.parser.split_file(
+            stats, base_file, inner_dir, file_label, line_table, unchanged
+        )
+        if SharedLimits.current_reached():
+            print("  Limit reached, skipping {}".format(file_label))
+            return compare_subdir, {}, {}, stats
+        diff_funcs = self.parser.split_file(
+            stats, diff_file, inner_dir, file_label, line_table, unchanged
+        )
 
         return self.process_file_contents(
-            stats, base_funcs, diff_funcs, compare_subdir, file_for_subdir, file_label
+            stats,
+            base_funcs,
+            diff_funcs,
+            compare_subdir,
+            file_for_subdir,
+            file_label,
+            line_table,
         )
 
+    # line_table is the LineTable used to split the files, if any
     def process_file_contents(
-        self, stats, base_funcs, diff_funcs, compare_subdir, file_for_subdir, file_label
+        self,
+        stats,
+        base_funcs,
+        diff_funcs,
+        compare_subdir,
+        file_for_subdir,
+        file_label,
+        line_table=None,
     ):
         base_extra_funcs = {}
         diff_extra_funcs = {}
@@ -1345,7 +1724,7 @@ class DiffTool:
             for funcname, base_func in base_funcs.items():
                 diff_func = diff_funcs.get(funcname)
                 if diff_func:
-                    if base_func.lines == diff_func.lines:
+                    if same_function_lines(base_func, diff_func, self.config.paranoid):
                         stats.incr(CounterKind.EarlyMatch)
                         to_delete.append(funcname)
                 else:
@@ -1366,23 +1745,11 @@ class DiffTool:
 
         # At this point, a function is either in both base_funcs and diff_funcs or neither.
 
-        self.canon_file(stats, base_funcs, file_label)
-        self.canon_file(stats, diff_funcs, file_label)
+        if SharedLimits.current_reached():
+            print("  Limit reached, skipping {}".format(file_label))
+            return compare_subdir, {}, {}, stats
 
-        with stats.timers[TimeKind.CanonMatch]:
-            to_delete = []
-            print("  Canon matching {}".format(file_label))
-
-            for funcname, base_func in base_funcs.items():
-                diff_func = diff_funcs.get(funcname)
-                if diff_func:
-                    if base_func.canon_lines == diff_func.canon_lines:
-                        stats.incr(CounterKind.CanonMatch)
-                        to_delete.append(funcname)
-
-            for funcname in to_delete:
-                base_funcs.pop(funcname, None)
-                diff_funcs.pop(funcname, None)
+        self.canon_match_file(stats, base_funcs, diff_funcs, file_label, line_table)
 
         with stats.timers[TimeKind.WriteFunc]:
             print("  Writing function files for {}".format(file_label))
@@ -1400,8 +1767,16 @@ class DiffTool:
             )
 
         print("  Writing .d function files for {}".format(file_label))
+        limits = SharedLimits.current
         for funcname, base_func in base_funcs.items():
             try:
+                if limits is not None and limits.reached():
+                    # Stop as soon as --diff-limit/--func-limit is reached (possibly by
+                    # another worker) rather than finishing the file.
+                    self.remove_function_files(
+                        compare_subdir, file_for_subdir, funcname
+                    )
+                    continue
                 self.write_d_file(
                     stats,
                     compare_subdir,
@@ -1414,6 +1789,8 @@ class DiffTool:
                 print("exception while processing ", funcname)
                 raise
 
+        # Lines of lazy functions may have been cleaned since the split
+        self.parser.report_line_caches(stats)
         print(stats.report(indent=4))
         return compare_subdir, base_extra_funcs, diff_extra_funcs, stats
 
@@ -1428,6 +1805,8 @@ diff_delete = re.compile(r"^(\d+)(?:,(\d+))?d(\d+)$", re.ASCII)
 # which describes add/deletes/changes, or a set of changes to get from one
 # file to another.
 class DiffCommand:
+    __slots__ = ("diff_range", "base_range")
+
     def __init__(self, diff_range, base_range):
         self.diff_range = diff_range
         self.base_range = base_range
@@ -1446,6 +1825,11 @@ class DiffCommand:
         )
 
 
+# Accessors passed to match_pattern_lines (avoids creating lambdas while matching)
+get_diff_range = operator.attrgetter("diff_range")
+get_base_range = operator.attrgetter("base_range")
+
+
 # Parse the output of the 'diff' command into DiffCommands
 def parse_diff_command(line):
     # note: order is diff..base, so add/delete are backwards
@@ -1536,6 +1920,8 @@ def output_diff_command(command):
 
 
 class Gap:
+    __slots__ = ("gap_range",)
+
     def __init__(self, gap_range):
         self.gap_range = gap_range  # avoid conflict with 'range'
 
@@ -1543,6 +1929,10 @@ class Gap:
         return "Gap({})".format(repr(self.gap_range))
 
 
+# Shared default for ExpectedLines (Gaps are never modified after construction)
+no_gap = Gap(Range(0))
+
+
 # The main component of diff patterns.  A Diff is a sequence of base lines and a
 # sequence of diff lines (if one is empty, then it represents an addition or
 # deletion).  The lines are FileCheck-like in format.  It can be specified that
@@ -1562,6 +1952,14 @@ class Diff:
     def lines(self, is_base):
         return self.base_lines if is_base else self.diff_lines
 
+    def __repr__(self):
+        return "Diff({}, {}, repeat={}, is_filler={})".format(
+            repr(self.diff_lines),
+            repr(self.base_lines),
+            repr(self.repeat),
+            repr(self.is_filler),
+        )
+
 
 # A Strategy is a complete pattern to search for and remove from the set of diffs.
 # It consists of a list of patterns (Diffs, Gaps) and a list of skips (Skips).
@@ -1575,6 +1973,9 @@ class Strategy:
         self.patterns = patterns
         self.skips = skips
 
+        # Set when compiling.  See get_literal_lines.
+        self.literal_lines = None
+
     def __repr__(self):
         return "Strategy(name={}, patterns={}, skips={})".format(
             repr(self.name), repr(self.patterns), repr(self.skips)
@@ -1592,7 +1993,7 @@ class Skip:
         self.skip = skip
 
     def __repr__(self):
-        return "Skip(name={}, skip={})".format(repr(name), repr(self.skip))
+        return "Skip(name={}, skip={})".format(repr(self.name), repr(self.skip))
 
 
 # Directives are shortcuts to REs/format strings.
@@ -2133,22 +2534,208 @@ def compile_element(element, debug_patterns):
     )
 
 
+def is_literal_line(line):
+    return pattern_re.search(line) is None and "\n" not in line
+
+
+# Some strategies start with a Diff of nothing but literal lines (e.g., a fixed prologue
+# that was added).  If such a strategy has no skips, a match at a DiffCommand requires
+# those lines to appear contiguously at the start of the command's ranges, so the
+# matcher can find all candidate starts at once (see MatchContext.get_literal_starts)
+# instead of trying the strategy at every DiffCommand.
+#
+# Returns (diff literal lines, base literal lines) or None if the strategy doesn't
+# qualify.  'patterns' and 'skips' are the uncompiled elements.
+def get_literal_lines(patterns, skips, debug_patterns):
+    if debug_patterns or skips or not patterns:
+        return None
+    first = patterns[0]
+    if type(first) is not Diff or first.is_filler or first.repeat.start < 1:
+        return None
+    if not (first.diff_lines or first.base_lines):
+        return None
+    if not all(
+        is_literal_line(line)
+        for line in itertools.chain(first.diff_lines, first.base_lines)
+    ):
+        return None
+    return (list(first.diff_lines), list(first.base_lines))
+
+
 def compile_skip(skip, debug_patterns=False):
-    return Strategy(
+    compiled = Strategy(
         name=skip.name, patterns=[compile_element(skip.skip, debug_patterns)]
     )
+    compiled.literal_lines = get_literal_lines([skip.skip], [], debug_patterns)
+    return compiled
 
 
 def compile_strategy(strategy, global_skips, debug_patterns=False):
-    return Strategy(
+    compiled = Strategy(
         name=strategy.name,
         patterns=[compile_element(e, debug_patterns) for e in strategy.patterns],
         skips=[compile_element(s, debug_patterns) for s in strategy.skips]
         + global_skips,
     )
+    compiled.literal_lines = get_literal_lines(
+        strategy.patterns, compiled.skips, debug_patterns
+    )
+    return compiled
+
+
+#
+# Declarative strategy files
+#
+# Python strategy files are evaluated with 'eval', which runs arbitrary code and has to
+# compile a Python expression for every file.  The declarative format has one JSON
+# object per line, each of which is a Strategy or a Skip:
+#
+#   {"strategy": NAME, "patterns": [ELEMENT, ...], "skips": [DIFF, ...]}
+#   {"skip": NAME, "diff": DIFF}
+#
+# where an ELEMENT is a DIFF or a GAP:
+#
+#   DIFF: {"diff": [LINE, ...], "base": [LINE, ...], "repeat": [START, END], "filler": true}
+#   GAP:  {"gap": [START, END]}
+#
+# "skips", "repeat" and "filler" are optional and default to [], [1, 2] and false.
+# Blank lines and lines starting with # are ignored.  The lines are the same
+# FileCheck-like patterns as in the Python files.
+#
+
+declarative_strategy_ext = ".jsonl"
+
+
+def range_to_json(range):
+    return [range.start, range.end]
+
+
+def range_from_json(value):
+    if (
+        type(value) is not list
+        or len(value) != 2
+        or not all(type(v) is int for v in value)
+    ):
+        raise ValueError("range must be [start, end], not {}".format(value))
+    return Range(value[0], value[1])
+
+
+def element_to_json(element):
+    if type(element) is Gap:
+        return {"gap": range_to_json(element.gap_range)}
+    assert type(element) is Diff
+    result = {"diff": element.diff_lines, "base": element.base_lines}
+    if element.repeat != Range(1):
+        result["repeat"] = range_to_json(element.repeat)
+    if element.is_filler:
+        result["filler"] = True
+    return result
+
+
+def check_json_keys(value, required, optional=()):
+    if type(value) is not dict:
+        raise ValueError("expected an object, not {}".format(value))
+    keys = set(value.keys())
+    missing = set(required) - keys
+    if missing:
+        raise ValueError("missing {} in {}".format(sorted(missing), value))
+    unknown = keys - set(required) - set(optional)
+    if unknown:
+        raise ValueError("unknown {} in {}".format(sorted(unknown), value))
+
+
+def diff_from_json(value):
+    check_json_keys(value, ["diff", "base"], ["repeat", "filler"])
+    for key in ["diff", "base"]:
+        lines = value[key]
+        if type(lines) is not list or not all(type(line) is str for line in lines):
+            raise ValueError("{} must be a list of strings".format(key))
+    repeat = value.get("repeat")
+    is_filler = value.get("filler", False)
+    if type(is_filler) is not bool:
+        raise ValueError("filler must be true or false, not {}".format(is_filler))
+    return Diff(
+        value["diff"],
+        value["base"],
+        repeat=range_from_json(repeat) if repeat is not None else None,
+        is_filler=is_filler,
+    )
+
+
+def list_from_json(value, key):
+    if type(value) is not list:
+        raise ValueError("{} must be a list, not {}".format(key, value))
+    return value
+
+
+def name_from_json(value, key):
+    if type(value) is not str:
+        raise ValueError("{} must be a string, not {}".format(key, value))
+    return value
+
+
+def element_from_json(value):
+    if type(value) is dict and "gap" in value:
+        check_json_keys(value, ["gap"])
+        return Gap(range_from_json(value["gap"]))
+    return diff_from_json(value)
+
+
+def strategy_to_json(item):
+    if type(item) is Skip:
+        return {"skip": item.name, "diff": element_to_json(item.skip)}
+    assert type(item) is Strategy
+    result = {
+        "strategy": item.name,
+        "patterns": [element_to_json(e) for e in item.patterns],
+    }
+    if item.skips:
+        result["skips"] = [element_to_json(s) for s in item.skips]
+    return result
+
+
+def strategy_from_json(value):
+    if type(value) is dict and "skip" in value:
+        check_json_keys(value, ["skip", "diff"])
+        return Skip(
+            name_from_json(value["skip"], "skip"), diff_from_json(value["diff"])
+        )
+    check_json_keys(value, ["strategy", "patterns"], ["skips"])
+    patterns = list_from_json(value["patterns"], "patterns")
+    skips = list_from_json(value.get("skips", []), "skips")
+    return Strategy(
+        name_from_json(value["strategy"], "strategy"),
+        patterns=[element_from_json(e) for e in patterns],
+        skips=[diff_from_json(s) for s in skips],
+    )
+
+
+# Yields the Strategies/Skips of a declarative strategy file one line at a time
+def iter_declarative_strategy_file(strategy_filename):
+    with open(strategy_filename, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                yield strategy_from_json(json.loads(line))
+            except ValueError as e:
+                raise ValueError(
+                    "{}:{}: {}".format(strategy_filename, line_number, e)
+                ) from e
+
+
+def write_declarative_strategy_file(items, strategy_filename):
+    with open(strategy_filename, "w", encoding="utf-8") as file:
+        for item in items:
+            file.write(json.dumps(strategy_to_json(item)))
+            file.write("\n")
 
 
 def load_strategy_file(strategy_filename):
+    if get_ext(strategy_filename) == declarative_strategy_ext:
+        return list(iter_declarative_strategy_file(strategy_filename))
+
     # 'eval' runs in the current context if globals/locals aren't specified.
     # This lets the strategy files use Strategy, Diff, etc., without any imports.
     with open(strategy_filename, "rb") as file:
@@ -2,15 +2,27 @@
 
 from abc import ABC, abstractmethod
 import argparse
+import base64
 import collections
 import concurrent.futures
 from enum import IntEnum, Flag, auto, unique
 import fnmatch
+import functools
+import hashlib
+import importlib
+import importlib.util
 import itertools
 import json
+import locale
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import sys
+import tempfile
 import threading
+import time
 import traceback
 
 from canon_util import *
@@ -19,6 +31,39 @@ from canon_util import *
 # Configuration settings taken from the command line
 #
 
+# The regexes of --funcspec (or --exclude-funcspec).  With lots of them, searching a
+# function name for each one in turn is slow, so they are combined into one
+# alternation, unless a pattern has something that would mean something else in the
+# combination (a back reference or conditional, which uses group numbers, or a global
+# inline flag).
+class FuncSpecs:
+    uncombinable = re.compile(r"\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)")
+
+    def __init__(self, specs):
+        specs = list(specs)  # e.g., an itertools.chain of the command line values
+        self.patterns = [re.compile(spec) for spec in specs]
+        self.combined = None
+        if len(self.patterns) > 1 and not any(
+            FuncSpecs.uncombinable.search(spec) for spec in specs
+        ):
+            try:
+                self.combined = re.compile(
+                    "|".join("(?:{})".format(spec) for spec in specs)
+                )
+            except re.error:
+                # e.g., the same group name in two patterns
+                pass
+
+    def __len__(self):
+        return len(self.patterns)
+
+    # Whether any of the patterns is found in name
+    def search(self, name):
+        if self.combined:
+            return self.combined.search(name) is not None
+        return any(pattern.search(name) for pattern in self.patterns)
+
+
 # Note: ConfigBase and get_base_parser (below) process the same set of arguments.
 # Specializations need to provide functionality for both.  This is a quick
 # factoring and could probably be done more cleanly.
@@ -26,22 +71,58 @@ class ConfigBase:
     def __init__(self, cmd_args):
         self.indent_value = ""
 
+        # Also loaded by the worker processes (see init_worker)
+        self.parser_modules = cmd_args.parser_modules
+        for name in self.parser_modules:
+            load_parser_module(name)
         self.kind = cmd_args.kind
+        # Raises ValueError for an unknown kind
+        get_parser_class(self.kind)
         self.jobs = cmd_args.jobs
 
         self.output_dir = cmd_args.output_dir
 
+        # --function-index implies --lazy-functions, which implies --mmap
+        self.bytes_mode = cmd_args.bytes_mode
+        self.timing = cmd_args.timing
+        self.timing_sample = cmd_args.timing_sample
+        if self.timing_sample < 1:
+            raise ValueError("--timing-sample must be at least 1")
+        self.walk_threads = cmd_args.walk_threads
+        if self.walk_threads < 1:
+            raise ValueError("--walk-threads must be at least 1")
+        self.line_cache = cmd_args.line_cache
+        self.line_cache_scope = cmd_args.line_cache_scope
+        self.spill_lines = cmd_args.spill_lines
+        self.function_index = cmd_args.function_index or bool(cmd_args.index_dir)
+        self.index_dir = cmd_args.index_dir
+        self.lazy_functions = cmd_args.lazy_functions or self.function_index
+        self.mmap = cmd_args.mmap or self.lazy_functions
+        self.name_filter = cmd_args.name_filter or bool(cmd_args.name_filter_dir)
+        self.name_filter_dir = cmd_args.name_filter_dir
+        if self.name_filter and not self.name_filter_dir:
+            self.name_filter_dir = get_cache_dir("name-filters")
+        self.prefetch = cmd_args.prefetch
+
         self.opt_only = cmd_args.opt_only
         self.filespecs = list(itertools.chain(*cmd_args.filespecs))
         self.exclude_filespecs = list(itertools.chain(*cmd_args.exclude_filespecs))
-        self.funcspecs = [re.compile(s) for s in itertools.chain(*cmd_args.funcspecs)]
-        self.exclude_funcspecs = [
-            re.compile(s) for s in itertools.chain(*cmd_args.exclude_funcspecs)
-        ]
+        self.funcspecs = FuncSpecs(itertools.chain(*cmd_args.funcspecs))
+        self.exclude_funcspecs = FuncSpecs(
+            itertools.chain(*cmd_args.exclude_funcspecs)
+        )
         self.funcnames = ConfigBase.process_arg_funcnames(
-            itertools.chain(*cmd_args.funcnames)
+            itertools.chain(
+                *cmd_args.funcnames,
+                *map(ConfigBase.read_funcname_file, cmd_args.funcname_files),
+            )
+        )
+        self.exclude_funcnames = frozenset(
+            itertools.chain(
+                *cmd_args.exclude_funcnames,
+                *map(ConfigBase.read_funcname_file, cmd_args.exclude_funcname_files),
+            )
         )
-        self.exclude_funcnames = set(itertools.chain(*cmd_args.exclude_funcnames))
 
         self.debug = cmd_args.debug
 
@@ -63,22 +144,54 @@ class ConfigBase:
                 dir_name, funcname = split
             funcnames.setdefault(dir_name, set()).add(funcname)
 
-        return funcnames
+        return {
+            dir_name: frozenset(dir_funcnames)
+            for dir_name, dir_funcnames in funcnames.items()
+        }
+
+    # Returns the function names in a --funcname-file (or --exclude-funcname-file):
+    # one per line, in the same format as the arguments.  Blank lines are skipped.
+    def read_funcname_file(filename):
+        with open(filename) as read_file:
+            lines = read_file.read().split("\n")
+        return [line.strip() for line in lines if line.strip()]
+
+    # keep_func's answers, since it's asked about each function of both files of a
+    # pair.  It's cleared when it gets too big.
+    keep_func_memo = None
+    keep_func_memo_size = 1 << 16
 
     def keep_func(self, inner_dir, funcname):
+        if not self.filters_funcs():
+            return True
+
+        memo = self.keep_func_memo
+        if memo is None:
+            memo = self.keep_func_memo = {}
+        key = (inner_dir, funcname)
+        keep = memo.get(key)
+        if keep is None:
+            if len(memo) >= self.keep_func_memo_size:
+                memo.clear()
+            keep = memo[key] = self.keep_func2(inner_dir, funcname)
+        return keep
+
+    empty_funcnames = frozenset()
+
+    def keep_func2(self, inner_dir, funcname):
         if self.funcspecs:
-            if not any([funcspec.search(funcname) for funcspec in self.funcspecs]):
+            if not self.funcspecs.search(funcname):
                 return False
 
         if self.funcnames:
-            dir_set = self.funcnames.get(inner_dir, set())
-            global_set = self.funcnames.get(None, set())
+            dir_set = self.funcnames.get(inner_dir, ConfigBase.empty_funcnames)
+            global_set = self.funcnames.get(None, ConfigBase.empty_funcnames)
 
             if not ((funcname in dir_set) or (funcname in global_set)):
                 return False
 
         if self.exclude_funcspecs:
-            if any([funcspec.search(funcname) for funcspec in self.exclude_funcspecs]):
+            if self.exclude_funcspecs.search(funcname):
                 return False
 
         if self.exclude_funcnames:
@@ -87,6 +200,23 @@ class ConfigBase:
 
         return True
 
+    # With --only-functions and --funcname, returns the names of the only functions
+    # that can be kept from a file in inner_dir (possibly none).  Otherwise None.
+    def get_wanted_funcnames(self, inner_dir):
+        if not (self.only_functions and self.funcnames):
+            return None
+        names = self.funcnames.get(inner_dir, ConfigBase.empty_funcnames)
+        return names | self.funcnames.get(None, ConfigBase.empty_funcnames)
+
+    # Whether keep_func can throw away any functions
+    def filters_funcs(self):
+        return bool(
+            self.funcspecs
+            or self.funcnames
+            or self.exclude_funcspecs
+            or self.exclude_funcnames
+        )
+
     #
     # Debug printing and indentation
     #
@@ -154,6 +284,12 @@ def get_base_parser():
         action="store_const",
         const="jitx64",
     )
+    kind_group.add_argument(
+        "-k",
+        "--kind",
+        help="Canonicalize files of a registered kind (including kinds from --parser-module)",
+        dest="kind",
+    )
 
     config_group = cmd_parser.add_argument_group(title="configuration arguments")
     config_group.add_argument(
@@ -170,6 +306,101 @@ def get_base_parser():
         help="Set output compare directory root",
         default="AsmDiff",
     )
+    config_group.add_argument(
+        "--parser-module",
+        metavar="MODULE",
+        help="Load parsers for more kinds from a module name or .py file that calls register_parser; may be repeated",
+        dest="parser_modules",
+        action="append",
+        default=[],
+    )
+    config_group.add_argument(
+        "--bytes",
+        dest="bytes_mode",
+        help="Process (ASCII) input files as bytes instead of decoding them, for speed; the output is the same",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--walk-threads",
+        metavar="N",
+        help="List up to N input directories at a time (for network file systems); defaults to 8",
+        type=int,
+        default=8,
+    )
+    config_group.add_argument(
+        "--timing",
+        help="How to time splitting files: not at all, one timer for the whole split (default), every --timing-sample'th line (scaled up), or every line (slow)",
+        choices=["none", "phase", "sampled", "line"],
+        default="phase",
+    )
+    config_group.add_argument(
+        "--timing-sample",
+        metavar="N",
+        help="Time 1 in N lines with --timing sampled; defaults to 100",
+        type=int,
+        default=100,
+    )
+    config_group.add_argument(
+        "--line-cache",
+        metavar="N",
+        help="Cache the cleaned and canonicalized versions of up to N distinct lines (LRU); defaults to 0 (off)",
+        type=int,
+        default=0,
+    )
+    config_group.add_argument(
+        "--line-cache-scope",
+        help="Clear the --line-cache for each pass over a file (default), for each base/diff pair of files, or never",
+        choices=["pass", "file", "worker"],
+        default="pass",
+    )
+    config_group.add_argument(
+        "--spill-lines",
+        metavar="N",
+        help="Keep functions with more than N lines in temporary files, in chunks of N lines, instead of in memory; defaults to 0 (never)",
+        type=int,
+        default=0,
+    )
+    config_group.add_argument(
+        "--mmap",
+        help="Split input files by memory-mapping them and scanning for function boundaries (only used with --only-functions or --opt-only, or by the extract tool)",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--lazy-functions",
+        help="Only record where each function is in the mapped file and read its lines when they're needed (implies --mmap)",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--function-index",
+        help="Keep a .fidx index of the functions next to each input file and use it instead of scanning the file (implies --lazy-functions)",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--index-dir",
+        metavar="DIR",
+        help="Put .fidx function index files in DIR instead of next to the input files (implies --function-index)",
+    )
+    config_group.add_argument(
+        "--prefetch",
+        help="Read the other input files of a job, and those of the next job, ahead of time on a background thread",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--name-filter",
+        help="With --only-functions and --funcname, keep a .nbf filter of the function names of each input file in a per-user cache directory and skip files without any of the functions",
+        action="store_true",
+        default=False,
+    )
+    config_group.add_argument(
+        "--name-filter-dir",
+        metavar="DIR",
+        help="Put .nbf function name filter files in DIR instead of the per-user cache directory (implies --name-filter)",
+    )
 
     filter_group = cmd_parser.add_argument_group(
         title="Filtering arguments"
@@ -240,6 +471,22 @@ def get_base_parser():
         action="append",
         default=[],
     )
+    filter_group.add_argument(
+        "--funcname-file",
+        metavar="FILE",
+        dest="funcname_files",
+        help="Read --funcname arguments from FILE, one per line",
+        action="append",
+        default=[],
+    )
+    filter_group.add_argument(
+        "--exclude-funcname-file",
+        metavar="FILE",
+        dest="exclude_funcname_files",
+        help="Read --exclude-funcname arguments from FILE, one per line",
+        action="append",
+        default=[],
+    )
 
     debug_group = cmd_parser.add_argument_group(title="Options for debugging")
     debug_group.add_argument(
@@ -269,6 +516,7 @@ class TimeKind(IntEnum):
     WriteFunc = (13,)
     WriteDiff = (14,)
     FilterDiff = (15,)
+    Split = (16,)
 
 
 # Events to be counted in the tools
@@ -284,6 +532,13 @@ class CounterKind(IntEnum):
     FinalDiff = (7,)
     FuncDiff = (8,)
     FileDiff = (9,)
+    CleanCacheHit = (10,)
+    CleanCacheMiss = (11,)
+    CanonCacheHit = (12,)
+    CanonCacheMiss = (13,)
+    Spilled = (14,)
+    NameFiltered = (15,)
+    WalkDirs = (16,)
 
 
 # Statistics that are kept by the tools.
@@ -291,9 +546,12 @@ class CounterKind(IntEnum):
 # Note that "strategies" are specific to the diff tool but are still in this shared type.
 # If no strategies are counted (such as in the extract tool), the "report" method
 # won't mention them.
+#
+# timing is the --timing mode that the times were taken with, if any.
 class Stats:
-    def __init__(self, tag):
+    def __init__(self, tag, timing=None):
         self.tag = tag
+        self.timing = timing
         self.timers = [Stopwatch(str(k)) for k in TimeKind]
         self.counters = [0] * len(CounterKind)
         self.strategy_counters = {}
@@ -319,6 +577,7 @@ class Stats:
     def report(self, indent=None):
         mapping = {
             "tag": self.tag,
+            "timing": self.timing,
             "time": round(sum([sw.total() for sw in self.timers]), 3),
             "times": collections.OrderedDict(
                 (sw.name, round(sw.total(), 3))
@@ -329,6 +588,8 @@ class Stats:
                 (str(i), self.counters[i]) for i in CounterKind if self.counters[i]
             ),
         }
+        if not self.timing:
+            del mapping["timing"]
 
         if self.strategy_counters:
             mapping["strategy matches"] = collections.OrderedDict(
@@ -338,6 +599,136 @@ class Stats:
         return json.dumps(mapping, indent=indent)
 
 
+# Stands in for Stats.timers where nothing should be timed
+null_timers = [NullStopwatch()] * len(TimeKind)
+
+
+# Limits on reported diffs (--diff-limit) and functions with diffs (--func-limit)
+# that are shared by all worker processes.
+#
+# Workers reserve from the limits as they write each function's diffs, so they can
+# stop as soon as a limit is reached instead of finishing the file, and the totals
+# never go past the limits.  The instance is handed to the workers through the
+# ProcessPoolExecutor initializer, init_worker (synchronized values can only be
+# shared between processes by inheritance) and is available as SharedLimits.current.
+class SharedLimits:
+    current = None
+
+    def __init__(self, config):
+        self.diff_limit = config.diff_limit
+        self.func_limit = config.func_limit
+        self.lock = multiprocessing.Lock()
+        self.diff_count = multiprocessing.RawValue("q", 0)
+        self.func_count = multiprocessing.RawValue("q", 0)
+
+    def install(limits):
+        SharedLimits.current = limits
+
+    # Whether the limits installed in this process have been reached, possibly by
+    # another worker
+    def current_reached():
+        limits = SharedLimits.current
+        return limits is not None and limits.reached()
+
+    def has_limits(self):
+        return bool(self.diff_limit or self.func_limit)
+
+    def reached(self):
+        return bool(
+            (self.diff_limit and self.diff_count.value >= self.diff_limit)
+            or (self.func_limit and self.func_count.value >= self.func_limit)
+        )
+
+    # Reserve room to report 'diffs' diffs for one function.  Returns the number of
+    # diffs that may be reported, which is zero if the function may not be reported.
+    def reserve(self, diffs):
+        if diffs <= 0:
+            return 0
+        if not self.has_limits():
+            return diffs
+
+        with self.lock:
+            if self.func_limit and self.func_count.value >= self.func_limit:
+                return 0
+            if self.diff_limit:
+                diffs = min(diffs, self.diff_limit - self.diff_count.value)
+                if diffs <= 0:
+                    return 0
+            self.func_count.value += 1
+            self.diff_count.value += diffs
+            return diffs
+
+
+# ProcessPoolExecutor initializer.  Workers load the --parser-module modules too, so
+# that they can unpickle the parsers from them (e.g., when worker processes are
+# spawned rather than forked).
+def init_worker(limits, parser_modules):
+    for name in parser_modules:
+        load_parser_module(name)
+    SharedLimits.install(limits)
+
+
+# Reads input files ahead of time on a background thread (with --prefetch), so that
+# they are in the OS cache by the time they are split.  Reading a file mostly waits
+# for I/O, which doesn't hold the GIL, so this overlaps the I/O of the next files
+# with the CPU time of splitting the current one.  posix_fadvise is used too where
+# it's available, but it doesn't do much on network file systems, so the files are
+# still read through.
+#
+# Each worker process has its own Prefetcher (see get).
+class Prefetcher:
+    current = None
+    block_size = 1 << 20
+    # Files prefetched recently, which aren't read again
+    recent_count = 16
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.files = queue.Queue()
+        self.recent = collections.deque(maxlen=Prefetcher.recent_count)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get():
+        prefetcher = Prefetcher.current
+        if prefetcher is None or prefetcher.pid != os.getpid():
+            prefetcher = Prefetcher.current = Prefetcher()
+        return prefetcher
+
+    def prefetch(self, files):
+        for file in files:
+            if file not in self.recent:
+                self.recent.append(file)
+                self.files.put(file)
+
+    def run(self):
+        buffer = bytearray(Prefetcher.block_size)
+        while True:
+            Prefetcher.read(self.files.get(), buffer)
+            self.files.task_done()
+
+    def read(file, buffer):
+        try:
+            with open(file, "rb", buffering=0) as read_file:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(
+                        read_file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED
+                    )
+                while read_file.readinto(buffer):
+                    pass
+        except OSError:
+            # Only an optimization; splitting the file will report the error
+            pass
+
+
+# Runs a job queued with Controller.queue_job, after starting to prefetch the files
+# given by the Controller
+def run_job(prefetch_files, function, *args):
+    if prefetch_files:
+        Prefetcher.get().prefetch(prefetch_files)
+    return function(*args)
+
+
 # Multi-threading support for the tools
 #
 # Most multi-_threading_ is done via ProcessPoolExecutor because CPython
@@ -379,9 +770,14 @@ class Controller:
         self.current_job_count = 0
         self.all_queued = False
 
+        self.limits = SharedLimits(self.config)
+        SharedLimits.install(self.limits)
+
         jobs = self.config.jobs
         with concurrent.futures.ProcessPoolExecutor(
-            max_workers=jobs
+            max_workers=jobs,
+            initializer=init_worker,
+            initargs=(self.limits, self.config.parser_modules),
         ) if jobs > 1 else FakeExecutor() as executor:
             self.executor = executor
             with self.lock:
@@ -437,25 +833,9 @@ class Controller:
 
     # Determine if the completed jobs have hit any of the limits for this run
     def hit_any_limit(self):
-        return (
-            (
-                self.config.diff_limit
-                and (
-                    self.stats.counters[CounterKind.FinalDiff] >= self.config.diff_limit
-                )
-            )
-            or (
-                self.config.func_limit
-                and (
-                    self.stats.counters[CounterKind.FuncDiff] >= self.config.func_limit
-                )
-            )
-            or (
-                self.config.file_limit
-                and (
-                    self.stats.counters[CounterKind.FileDiff] >= self.config.file_limit
-                )
-            )
+        return self.limits.reached() or (
+            self.config.file_limit
+            and (self.stats.counters[CounterKind.FileDiff] >= self.config.file_limit)
         )
 
     # launch more jobs if needed
@@ -465,18 +845,26 @@ class Controller:
             and len(self.worklist) > 0
             and not self.limit_hit
         ):
-            args = self.worklist.popleft()
-            future = self.executor.submit(args[0], *args[1:])
+            args, files = self.worklist.popleft()
+            prefetch_files = ()
+            if self.config.prefetch:
+                # The job reads its first file right away, so prefetch the rest, and
+                # the files of the job that will probably run next
+                prefetch_files = list(files[1:])
+                if self.worklist:
+                    prefetch_files.extend(self.worklist[0][1])
+            future = self.executor.submit(run_job, prefetch_files, *args)
             self.current_job_count += 1
             future.add_done_callback(self.consume_job_future)
 
         if self.limit_hit or (self.all_queued and len(self.worklist) == 0):
             self.all_launched.notify()
 
-    # add a job to the queue and (possibly) launch jobs
-    def queue_job(self, *args):
+    # add a job to the queue and (possibly) launch jobs.  'files' are the input files
+    # that the job reads, in order, for --prefetch.
+    def queue_job(self, *args, files=()):
         with self.lock:
-            self.worklist.append(args)
+            self.worklist.append((args, files))
             self.check_jobs()
 
     # end threading section
@@ -494,18 +882,131 @@ class HasFile(Flag):
         file_dict = dir_dict.setdefault(dir, {})
         file_dict[filename] = file_dict.get(filename, HasFile.NONE) | value
 
-    def add_dirwalk(dir_dict, dir, value, filespecs, exclude_filespecs):
-        for dirpath, _, filenames in os.walk(dir):
-            dirpath = os.path.relpath(dirpath, dir)
-            for filename in filenames:
-                if any([fnmatch.fnmatch(filename, filespec) for filespec in filespecs]):
-                    if not any(
-                        [
-                            fnmatch.fnmatch(filename, filespec)
-                            for filespec in exclude_filespecs
-                        ]
-                    ):
-                        HasFile.add_file(dir_dict, dirpath, filename, value)
+    def add_dirwalk(
+        dir_dict, dir, value, filespecs, exclude_filespecs, stat_dict=None, threads=1
+    ):
+        return HasFile.add_dirwalks(
+            dir_dict, [(dir, value)], filespecs, exclude_filespecs, stat_dict, threads
+        )
+
+    # Walks each (dir, value) of 'walks' and adds the files that match filespecs but
+    # not exclude_filespecs.  If stat_dict is given, the os.stat_result of each file
+    # is added to it as { (dirpath, filename, value) -> stat_result }, so that the
+    # files don't need to be looked up again.  Returns the number of directories
+    # walked.
+    #
+    # If on_listed is given, on_listed(dirpath, value) is called (on the calling
+    # thread) as soon as the files of each directory have been added.
+    #
+    # Directories are listed on 'threads' threads (--walk-threads), across all of the
+    # trees: the walk mostly waits for the file system, which takes milliseconds per
+    # directory on network shares.  At most 'threads' listings are outstanding; the
+    # directories found in the meantime wait in 'pending'.
+    def add_dirwalks(
+        dir_dict,
+        walks,
+        filespecs,
+        exclude_filespecs,
+        stat_dict=None,
+        threads=1,
+        on_listed=None,
+    ):
+        include = HasFile.compile_filespecs(filespecs)
+        exclude = HasFile.compile_filespecs(exclude_filespecs)
+        if include is None:
+            return 0
+
+        want_stat = stat_dict is not None
+        dir_count = 0
+        # (dir, value, path of the directory to list)
+        pending = collections.deque((dir, value, dir) for dir, value in walks)
+        with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+            running = {}  # future -> (dir, value)
+            while pending or running:
+                while pending and len(running) < threads:
+                    dir, value, dirpath = pending.popleft()
+                    future = executor.submit(
+                        HasFile.scan_dir, dir, dirpath, include, exclude, want_stat
+                    )
+                    running[future] = (dir, value)
+
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    dir, value = running.pop(future)
+                    rel_dirpath, files, subdirs = future.result()
+                    dir_count += 1
+                    for filename, stat in files:
+                        HasFile.add_file(dir_dict, rel_dirpath, filename, value)
+                        if want_stat:
+                            stat_dict[(rel_dirpath, filename, value)] = stat
+                    pending.extend((dir, value, subdir) for subdir in subdirs)
+                    if on_listed:
+                        on_listed(rel_dirpath, value)
+
+        return dir_count
+
+    # Returns one regex that matches a file name if any of the fnmatch filespecs match
+    # it (with fnmatch's case rules), or None if there are no filespecs
+    def compile_filespecs(filespecs):
+        if not filespecs:
+            return None
+        return re.compile(
+            "|".join(
+                fnmatch.translate(os.path.normcase(filespec)) for filespec in filespecs
+            )
+        )
+
+    # Lists one directory (dirpath) of the tree under dir the way os.walk would:
+    # symbolic links to directories aren't followed, and a directory that can't be
+    # read is empty.  Returns (dirpath relative to dir, which is "." for dir itself,
+    # [(filename, stat_result or None)] for the files whose name matches 'include'
+    # and not 'exclude', [paths of the subdirectories]).
+    def scan_dir(dir, dirpath, include, exclude, want_stat=False):
+        rel_dirpath = os.path.relpath(dirpath, dir)
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as entries:
+                entries = list(entries)
+        except OSError:
+            return rel_dirpath, files, subdirs
+
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                try:
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                except OSError:
+                    pass
+                continue
+
+            name = os.path.normcase(entry.name)
+            if include.match(name) and not (exclude and exclude.match(name)):
+                stat = None
+                if want_stat:
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        pass
+                files.append((entry.name, stat))
+
+        return rel_dirpath, files, subdirs
+
+    # Reports how fast the directories were walked, from the Walk timer and the
+    # WalkDirs count
+    def print_walk_rate(dir_count, walk_timer):
+        seconds = walk_timer.total()
+        print(
+            "Walked {} directories in {:.3f}s ({:.0f} per second)".format(
+                dir_count, seconds, dir_count / seconds if seconds else 0
+            )
+        )
 
     def print(dir_dict):
         for dir, file_dict in sorted(dir_dict.items()):
@@ -520,13 +1021,818 @@ class HasFile(Flag):
 # canonicalized version is stored in "canon_lines".  The initial diff between versions
 # is computed from "canon_lines".
 #
-Function = collections.namedtuple("Function", ["lines", "canon_lines"])
+# line_hash and canon_hash are fingerprints (see 'fingerprint') of the lines and the
+# canonicalized lines.  split_file sets line_hash and the diff tool's canon stage sets
+# canon_hash, so that matching functions are found by comparing fingerprints.
+#
+class Function:
+    __slots__ = ("lines", "canon_lines", "line_hash", "canon_hash")
+
+    def __init__(self, lines, canon_lines):
+        self.lines = lines
+        self.canon_lines = canon_lines
+        self.line_hash = None
+        self.canon_hash = None
 
 
 def new_Function():
     return Function(lines=[], canon_lines=[])
 
 
+# A Function (see above) whose lines haven't been read yet.  Created by split_file
+# with --lazy-functions, it only records the byte ranges of the function in the
+# memory-mapped input file.  (There is more than one range if the function name
+# appears more than once.)  "lines" are read by the parser the first time they are
+# used, so functions that match early never need them.
+#
+# hashes has the FunctionIndex hash of each range, or None if there is no index.
+class LazyFunction:
+    __slots__ = (
+        "parser",
+        "buffer",
+        "line_table",
+        "ranges",
+        "hashes",
+        "materialized",
+        "canon_lines",
+        "line_hash",
+        "canon_hash",
+    )
+
+    def __init__(self, parser, buffer, line_table=None):
+        self.parser = parser
+        self.buffer = buffer
+        self.line_table = line_table
+        self.ranges = []
+        self.hashes = []
+        self.materialized = None
+        self.canon_lines = []
+        self.line_hash = None  # not computed: ranges with the same hashes are compared
+        self.canon_hash = None
+
+    @property
+    def lines(self):
+        if self.materialized is None:
+            self.materialized = self.parser.read_lines(
+                self.buffer, self.ranges, self.line_table
+            )
+        return self.materialized
+
+    # Whether the function's bytes are the same as the other's (which means that the
+    # lines are the same too).  Lengths are compared first so that most different
+    # functions are told apart without copying anything, then the index hashes if
+    # both have them.  Equal hashes are only double-checked by comparing the bytes if
+    # 'paranoid'.  (Comparing memoryviews would avoid the copies but is compared item
+    # by item, which is far slower than comparing bytes.)
+    def same_bytes(self, other, paranoid=False):
+        if [end - start for start, end in self.ranges] != [
+            end - start for start, end in other.ranges
+        ]:
+            return False
+        if None not in self.hashes and None not in other.hashes:
+            if self.hashes != other.hashes:
+                return False
+            if not paranoid:
+                return True
+        return all(
+            self.buffer[start:end] == other.buffer[other_start:other_end]
+            for (start, end), (other_start, other_end) in zip(
+                self.ranges, other.ranges
+            )
+        )
+
+    # The mapped file can't be sent to another process (e.g., for --include-missing
+    # extras), so send a plain Function.
+    def __reduce__(self):
+        return (Function, (self.lines, self.canon_lines))
+
+
+# A Function (see above) with too many lines to keep in memory (more than
+# --spill-lines).  split_file writes its lines to a temporary file a chunk of
+# --spill-lines lines at a time and hashes each chunk; while splitting, "lines" only
+# has the lines that haven't been written yet.  After finish(), "lines" reads the
+# chunks back as they're needed, and canon_lines canonicalizes them a chunk at a
+# time.
+#
+# Two spilled functions are compared chunk by chunk, and only the chunks that
+# differ are canonicalized to compare the canonicalized lines.  A spilled function
+# is never the same as one that wasn't spilled: that would have fewer lines.
+class SpilledFunction:
+    __slots__ = (
+        "parser",
+        "file",
+        "offsets",
+        "chunk_hashes",
+        "canon_hashes",
+        "length",
+        "lines",
+    )
+
+    def __init__(self, parser, lines):
+        self.parser = parser
+        self.file = tempfile.TemporaryFile()
+        self.offsets = [0]  # the file offset of each chunk, and of the end
+        self.chunk_hashes = []
+        self.canon_hashes = {}  # chunk index -> hash of the canonicalized chunk
+        self.length = 0
+        self.lines = lines
+
+    def encode(self, lines):
+        data = self.parser.empty.join(lines)
+        return data if self.parser.is_bytes else data.encode("utf-8", "surrogatepass")
+
+    def write_chunk(self, lines):
+        data = self.encode(lines)
+        self.file.write(data)
+        self.offsets.append(self.offsets[-1] + len(data))
+        self.chunk_hashes.append(hashlib.blake2b(data, digest_size=16).digest())
+        self.length += len(lines)
+
+    # Writes out the pending lines that fill whole chunks
+    def write_chunks(self):
+        chunk_lines = self.parser.config.spill_lines
+        lines = self.lines
+        while len(lines) >= chunk_lines:
+            self.write_chunk(lines[:chunk_lines])
+            del lines[:chunk_lines]
+
+    # Called at the end of split_file
+    def finish(self):
+        if self.lines:
+            self.write_chunk(self.lines)
+        self.lines = SpilledLines(self)
+
+    def chunk_count(self):
+        return len(self.chunk_hashes)
+
+    def read_chunk(self, index):
+        self.file.seek(self.offsets[index])
+        data = self.file.read(self.offsets[index + 1] - self.offsets[index])
+        if not self.parser.is_bytes:
+            data = data.decode("utf-8", "surrogatepass")
+        # The last line of a file may not have a newline
+        return self.parser.split_text(data)
+
+    @property
+    def canon_lines(self):
+        return itertools.chain.from_iterable(
+            self.parser.canon_chunk(self.read_chunk(index))
+            for index in range(self.chunk_count())
+        )
+
+    def get_canon_hash(self, index):
+        canon_hash = self.canon_hashes.get(index)
+        if canon_hash is None:
+            canon_lines = self.parser.canon_chunk(self.read_chunk(index))
+            canon_hash = hashlib.blake2b(
+                self.encode(canon_lines), digest_size=16
+            ).digest()
+            self.canon_hashes[index] = canon_hash
+        return canon_hash
+
+    def same_lines(self, other, paranoid):
+        if not isinstance(other, SpilledFunction):
+            return False
+        if self.length != other.length or self.chunk_hashes != other.chunk_hashes:
+            return False
+        return not paranoid or all(
+            self.read_chunk(index) == other.read_chunk(index)
+            for index in range(self.chunk_count())
+        )
+
+    def same_canon_lines(self, other, paranoid):
+        if not isinstance(other, SpilledFunction) or self.length != other.length:
+            return False
+        for index in range(self.chunk_count()):
+            if self.chunk_hashes[index] == other.chunk_hashes[index] and not paranoid:
+                continue
+            if paranoid:
+                parser = self.parser
+                if parser.canon_chunk(self.read_chunk(index)) != parser.canon_chunk(
+                    other.read_chunk(index)
+                ):
+                    return False
+            elif self.get_canon_hash(index) != other.get_canon_hash(index):
+                return False
+        return True
+
+    # The temporary file can't be sent to another process (e.g., for
+    # --include-missing extras), so send a plain Function.
+    def __reduce__(self):
+        return (Function, (list(self.lines), []))
+
+
+# The "lines" of a SpilledFunction: a sequence that reads the lines from the
+# function's file, keeping the last chunk that was read.  With --bytes, decode gives
+# str lines for the diff strategies (see Parser.text_lines).
+class SpilledLines:
+    __slots__ = ("func", "decode", "chunk_index", "chunk")
+
+    def __init__(self, func, decode=None):
+        self.func = func
+        self.decode = decode
+        self.chunk_index = None
+        self.chunk = None
+
+    def __len__(self):
+        return self.func.length
+
+    def get_chunk(self, index):
+        if index != self.chunk_index:
+            chunk = self.func.read_chunk(index)
+            if self.decode:
+                chunk = [self.decode(line) for line in chunk]
+            self.chunk_index = index
+            self.chunk = chunk
+        return self.chunk
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        chunk_lines = self.func.parser.config.spill_lines
+        return self.get_chunk(index // chunk_lines)[index % chunk_lines]
+
+    def __iter__(self):
+        for index in range(self.func.chunk_count()):
+            yield from self.get_chunk(index)
+
+
+# Interns the lines of a pair of input files (base and diff) so that there is only one
+# copy of each distinct line, which the functions' lists of lines share.  Functions
+# and lines are mostly the same in the two files and many lines repeat within a
+# file, so this saves a lot of memory, and comparing the lists is mostly comparing
+# references.  Each distinct line is also only canonicalized once.
+#
+# Lines are kept as str (or bytes) rather than replaced by integer ids since that is
+# what writing them and the diff strategies need.
+class LineTable:
+    __slots__ = ("lines", "canon_lines")
+
+    def __init__(self):
+        self.lines = {}  # line -> the copy of it that is used
+        self.canon_lines = {}  # line -> canonicalized line
+
+    def intern(self, line):
+        return self.lines.setdefault(line, line)
+
+    # Returns canon_line(line), calling canon_line only once for each distinct line
+    def canon(self, line, canon_line):
+        canoned_line = self.canon_lines.get(line)
+        if canoned_line is None:
+            canoned_line = self.intern(canon_line(line))
+            self.canon_lines[line] = canoned_line
+        return canoned_line
+
+
+# A fingerprint of some text (str or bytes): a blake2b digest, which is the same in
+# every process
+def fingerprint(text):
+    if isinstance(text, str):
+        text = text.encode("utf-8", "surrogatepass")
+    return hashlib.blake2b(text, digest_size=16).digest()
+
+
+# Compares the lines of two functions, using their bytes or fingerprints if they
+# have them.  Equal fingerprints are only double-checked by comparing the lines if
+# 'paranoid'.
+def same_function_lines(base_func, diff_func, paranoid=False):
+    if isinstance(base_func, SpilledFunction):
+        return base_func.same_lines(diff_func, paranoid)
+    if isinstance(diff_func, SpilledFunction):
+        return False
+    if (
+        isinstance(base_func, LazyFunction)
+        and isinstance(diff_func, LazyFunction)
+        and base_func.same_bytes(diff_func, paranoid)
+    ):
+        return True
+    # Different bytes may still be the same lines (e.g., different debug info)
+    if len(base_func.lines) != len(diff_func.lines):
+        return False
+    if base_func.line_hash is not None and diff_func.line_hash is not None:
+        if base_func.line_hash != diff_func.line_hash:
+            return False
+        return not paranoid or base_func.lines == diff_func.lines
+    return base_func.lines == diff_func.lines
+
+
+# Same as same_function_lines for the canonicalized lines
+def same_function_canon_lines(base_func, diff_func, paranoid=False):
+    if isinstance(base_func, SpilledFunction):
+        return base_func.same_canon_lines(diff_func, paranoid)
+    if isinstance(diff_func, SpilledFunction):
+        return False
+    return base_func.canon_lines == diff_func.canon_lines
+
+
+# Converts a str literal, a compiled str pattern, or a tuple of Rules to bytes (see
+# Parser.for_bytes)
+def text_to_bytes(value):
+    if isinstance(value, str):
+        return value.encode("ascii")
+    if isinstance(value, tuple):
+        return tuple(rule.to_bytes() for rule in value)
+    # Bytes patterns can't have re.UNICODE, which str patterns get by default
+    return re.compile(value.pattern.encode("ascii"), value.flags & ~re.UNICODE)
+
+
+# Iterates over the lines of a file opened in binary mode, with the same line endings
+# as in text mode
+def binary_lines(read_file):
+    for line in read_file:
+        if line.endswith(b"\r\n"):
+            line = line[:-2] + b"\n"
+        yield line
+
+
+#
+# One substitution of a parser's replace_rules or canon_rules: pattern.sub(replacement)
+# is only run on text that contains the guard literal (if any), which is much cheaper
+# to look for than running the regex.  The guard must be in every match of the
+# pattern.  replacement is a template string or a function(parser, match).
+#
+class Rule:
+    __slots__ = ("guard", "pattern", "replacement")
+
+    def __init__(self, guard, pattern, replacement):
+        self.guard = guard
+        self.pattern = pattern
+        self.replacement = replacement
+
+    def to_bytes(self):
+        replacement = self.replacement
+        if isinstance(replacement, str):
+            replacement = text_to_bytes(replacement)
+        return Rule(
+            None if self.guard is None else text_to_bytes(self.guard),
+            text_to_bytes(self.pattern),
+            replacement,
+        )
+
+
+#
+# Iterates over the lines of a memory-mapped file the way iterating over a text file
+# would, but can also jump ahead to the next line that matches a compiled bytes
+# pattern.  This lets split_file find function boundaries with a regex over the whole
+# buffer instead of running every line through the parser.
+#
+#
+# Iteration can be limited to the lines in [pos, limit).  line_start is the offset of
+# the line that was returned last.
+#
+class MappedLines:
+    __slots__ = (
+        "buffer",
+        "start_scan",
+        "end_scan",
+        "pos",
+        "limit",
+        "line_start",
+        "encoding",
+    )
+
+    def __init__(
+        self, buffer, start_scan=None, end_scan=None, pos=0, limit=None, binary=False
+    ):
+        self.buffer = buffer
+        self.start_scan = start_scan
+        self.end_scan = end_scan
+        self.pos = pos
+        self.limit = len(buffer) if limit is None else limit
+        self.line_start = pos
+        # Same as opening the file in text mode, or bytes lines if binary
+        self.encoding = None if binary else locale.getpreferredencoding(False)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        pos = self.pos
+        if pos >= self.limit:
+            raise StopIteration
+        end = self.buffer.find(b"\n", pos, self.limit)
+        end = self.limit if end < 0 else end + 1
+        self.line_start = pos
+        self.pos = end
+        line = self.buffer[pos:end]
+        if self.encoding is None:
+            if line.endswith(b"\r\n"):
+                line = line[:-2] + b"\n"
+            return line
+        line = line.decode(self.encoding)
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
+        return line
+
+    # Moves to the start of the line containing the next match of 'scan', or to the
+    # end of the buffer if there is none.  (The match need not be at the start of the
+    # line.)  Without a pattern nothing is skipped.
+    def skip_to(self, scan):
+        if scan is None:
+            return
+        match = scan.search(self.buffer, self.pos, self.limit)
+        if match is None:
+            self.pos = self.limit
+        else:
+            line_start = self.buffer.rfind(b"\n", self.pos, match.start())
+            if line_start >= 0:
+                self.pos = line_start + 1
+
+    # Skip lines that can't start a function
+    def skip_outside(self):
+        self.skip_to(self.start_scan)
+
+    # Skip the rest of a function that is being thrown away, up to the line that ends it
+    def skip_function(self):
+        self.skip_to(self.end_scan)
+
+
+# Iterates over lines (e.g., of a file opened in text mode) with the same skip_outside
+# and skip_function as MappedLines.  Without a buffer to scan, lines are skipped by
+# testing just the raw lines with the parser's func_start or func_end and
+# func_already_ended, which is still much cheaper than processing them.  The line that
+# stops the skipping is the next line returned.
+class SkippingLines:
+    __slots__ = ("lines", "parser", "skip_until")
+
+    def __init__(self, lines, parser):
+        self.lines = lines
+        self.parser = parser
+        self.skip_until = None  # the test for the line to stop skipping at
+
+    def __iter__(self):
+        for line in self.lines:
+            skip_until = self.skip_until
+            if skip_until is not None:
+                if not skip_until(line):
+                    continue
+                self.skip_until = None
+            yield line
+
+    def skip_outside(self):
+        self.skip_until = self.parser.func_start
+
+    def skip_function(self):
+        self.skip_until = self.parser.ends_function
+
+
+# Returns the path of a sidecar file (with extension ext) for an input file: next to
+# it, or in sidecar_dir if one is given
+def get_sidecar_file(sidecar_dir, file, ext):
+    if not sidecar_dir:
+        return file + ext
+    # Keep sidecar files of same-named inputs apart
+    filename = "{}_{:08x}{}".format(
+        os.path.basename(file), hash_str(os.path.abspath(file)), ext
+    )
+    return os.path.join(sidecar_dir, filename)
+
+
+# A directory for sidecar files under the user's cache directory
+def get_cache_dir(name):
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.environ.get("LOCALAPPDATA")
+    if not cache_home:
+        cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "canon", name)
+
+
+# Writes a sidecar file (JSON) atomically.  Errors aren't fatal since sidecar files
+# are only an optimization (e.g., the input may be read-only).
+def save_sidecar_file(sidecar_file, contents, description):
+    # Write to a temporary file first so that readers never see a partial file
+    temp_file = "{}.{}.tmp".format(sidecar_file, os.getpid())
+    try:
+        sidecar_dir = os.path.dirname(sidecar_file)
+        if sidecar_dir:
+            os.makedirs(sidecar_dir, exist_ok=True)
+        with open(temp_file, "w", encoding="utf-8") as file:
+            json.dump(contents, file)
+        os.replace(temp_file, sidecar_file)
+    except OSError as e:
+        print("  Can't write {} {}: {}".format(description, sidecar_file, e))
+
+
+# Returns the contents of a sidecar file, or None if it can't be read
+def load_sidecar_file(sidecar_file):
+    try:
+        with open(sidecar_file, "r", encoding="utf-8") as file:
+            contents = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return contents if isinstance(contents, dict) else None
+
+
+# Returns a hash of the contents of a file
+def hash_file(file):
+    file_hash = hashlib.blake2b()
+    with open(file, "rb") as read_file:
+        for block in iter(lambda: read_file.read(1 << 20), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+# A persistent index of the functions in an input file, kept in a .fidx sidecar file
+# (JSON) so that later runs, of either tool, don't have to scan the file again.
+#
+# The index has an Entry for each function in file order, whether or not it is
+# filtered out by the current options:
+#   name: function name (as returned by the parser's func_start)
+#   start, end: byte offsets of the function's lines, as found by scan_functions
+#   hash: hash of those bytes, so identical functions can be matched without reading
+#       them
+#   unopt: whether the function is unoptimized (for --opt-only)
+#
+# The index is only used if its key (format version, parser kind, and the file's size
+# and modification time) still matches the file.
+class FunctionIndex:
+    version = 1
+    ext = ".fidx"
+
+    Entry = collections.namedtuple("Entry", ["name", "start", "end", "hash", "unopt"])
+
+    def get_index_file(config, file):
+        return get_sidecar_file(config.index_dir, file, FunctionIndex.ext)
+
+    def get_key(config, file):
+        stat = os.stat(file)
+        return {
+            "version": FunctionIndex.version,
+            "kind": config.kind,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    def hash_bytes(buffer, start, end):
+        with memoryview(buffer) as view:
+            return hashlib.blake2b(view[start:end], digest_size=16).hexdigest()
+
+    def build(parser, buffer):
+        return [
+            FunctionIndex.Entry(
+                name,
+                start,
+                end,
+                FunctionIndex.hash_bytes(buffer, start, end),
+                parser.is_unopt(buffer, start, end),
+            )
+            for name, start, end in parser.scan_functions(buffer)
+        ]
+
+    # Whether a saved entry is well-formed, for a file of 'size' bytes
+    def is_valid_entry(entry, size):
+        return (
+            type(entry) is list
+            and len(entry) == len(FunctionIndex.Entry._fields)
+            and type(entry[0]) is str
+            and type(entry[1]) is int
+            and type(entry[2]) is int
+            and 0 <= entry[1] <= entry[2] <= size
+            and type(entry[3]) is str
+            and type(entry[4]) is bool
+        )
+
+    # Returns the entries, or None if there is no usable index (including one that
+    # is malformed, so that it is rebuilt)
+    def load(index_file, key):
+        index = load_sidecar_file(index_file)
+        if index is None or index.get("key") != key:
+            return None
+        functions = index.get("functions")
+        if type(functions) is not list or not all(
+            FunctionIndex.is_valid_entry(entry, key["size"]) for entry in functions
+        ):
+            return None
+        return [FunctionIndex.Entry(*entry) for entry in functions]
+
+    def save(index_file, key, entries):
+        index = {"key": key, "functions": [list(entry) for entry in entries]}
+        save_sidecar_file(index_file, index, "function index")
+
+
+# A Bloom filter of the names of the functions in an input file, so that with
+# --name-filter, files that can't have any of the --funcname functions aren't even
+# read.  It is kept in a .nbf sidecar file (JSON) in a per-user cache directory or in
+# --name-filter-dir.
+#
+# Filters are only loaded when files are queued, which doesn't read the files.  A
+# missing filter is built by the job, which reads the file anyway, and is used from
+# the next run on.  The filter is keyed by a hash of the file's contents, so it stays
+# valid when the file is copied, but if the size and modification time are still
+# what they were when it was written, the file isn't hashed again to check.
+class NameFilter:
+    version = 1
+    ext = ".nbf"
+    # About 1% false positives
+    bits_per_name = 10
+    hash_count = 7
+
+    def __init__(self, size, bits=None):
+        self.size = size  # in bits
+        self.bits = bits if bits is not None else bytearray((size + 7) // 8)
+
+    def get_positions(self, name):
+        digest = hashlib.blake2b(name.encode("utf-8"), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], "little")
+        hash2 = int.from_bytes(digest[8:], "little") | 1
+        return [(hash1 + i * hash2) % self.size for i in range(NameFilter.hash_count)]
+
+    def add(self, name):
+        for position in self.get_positions(name):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def may_contain(self, name):
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self.get_positions(name)
+        )
+
+    def may_contain_any(self, names):
+        return any(self.may_contain(name) for name in names)
+
+    def build(names):
+        name_filter = NameFilter(max(64, len(names) * NameFilter.bits_per_name))
+        for name in names:
+            name_filter.add(name)
+        return name_filter
+
+    def get_key(config, file):
+        stat = os.stat(file)
+        return {
+            "version": NameFilter.version,
+            "kind": config.kind,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        }
+
+    # The NameFilter in the contents of a sidecar file, or None if they're malformed
+    def from_contents(contents):
+        size = contents.get("size")
+        try:
+            bits = base64.b64decode(contents.get("bits"), validate=True)
+        except (TypeError, ValueError):
+            return None
+        if not isinstance(size, int) or size < 1 or len(bits) != (size + 7) // 8:
+            return None
+        return NameFilter(size, bits)
+
+    # Returns the NameFilter for a file if its sidecar file is still valid without
+    # reading the file, else None
+    def load(config, parser, file):
+        if not parser.func_start_scan:
+            return None
+        filter_file = get_sidecar_file(config.name_filter_dir, file, NameFilter.ext)
+        contents = load_sidecar_file(filter_file)
+        if contents is None or contents.get("key") != NameFilter.get_key(config, file):
+            return None
+        return NameFilter.from_contents(contents)
+
+    # Builds the NameFilter for a file (and writes its sidecar file), unless the one
+    # in the sidecar file is still valid.  The file is mapped once to both hash it
+    # and scan it for the function names.  None if the parser can't find the
+    # function names without splitting the file.
+    def build_for_file(config, parser, file):
+        if not parser.func_start_scan:
+            return None
+        filter_file = get_sidecar_file(config.name_filter_dir, file, NameFilter.ext)
+        key = NameFilter.get_key(config, file)
+        contents = load_sidecar_file(filter_file)
+        saved_key = contents.get("key") if contents is not None else None
+        if saved_key == key:
+            name_filter = NameFilter.from_contents(contents)
+            if name_filter is not None:
+                return name_filter
+
+        name_filter = None
+        if key["size"] == 0:  # can't map an empty file
+            file_hash = hashlib.blake2b().hexdigest()
+            name_filter = NameFilter.build(())
+        else:
+            with open(file, "rb") as read_file, mmap.mmap(
+                read_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as buffer:
+                file_hash = hashlib.blake2b(buffer).hexdigest()
+                if (
+                    isinstance(saved_key, dict)
+                    and dict(saved_key, mtime_ns=key["mtime_ns"]) == key
+                    and contents.get("hash") == file_hash
+                ):
+                    # Only the modification time is different (e.g., a copy)
+                    name_filter = NameFilter.from_contents(contents)
+                if name_filter is None:
+                    name_filter = NameFilter.build(
+                        {name for name, _, _ in parser.scan_functions(buffer)}
+                    )
+
+        contents = {
+            "key": key,
+            "hash": file_hash,
+            "size": name_filter.size,
+            "bits": base64.b64encode(name_filter.bits).decode("ascii"),
+        }
+        save_sidecar_file(filter_file, contents, "function name filter")
+        return name_filter
+
+    # Whether a file may have any of the functions named by --funcname that can be
+    # kept from it (see ConfigBase.get_wanted_funcnames).  Without a valid filter,
+    # the file may have them, unless 'build' (in a job), which builds the filter.
+    def may_have_wanted_funcs(config, parser, file, inner_dir, build=False):
+        names = config.get_wanted_funcnames(inner_dir)
+        if names is None:
+            return True
+        if not names:
+            return False
+        if not config.name_filter:
+            return True
+        if build:
+            name_filter = NameFilter.build_for_file(config, parser, file)
+        else:
+            name_filter = NameFilter.load(config, parser, file)
+        return name_filter is None or name_filter.may_contain_any(names)
+
+
+# The hashes of the contents of input files, kept between runs in a --hash-cache
+# file (JSON) as { path -> [size, mtime_ns, hash] }, so that files that don't change
+# (e.g., a base tree that is only built once) are only read once to find identical
+# files.  A hash is only used while the file's size and modification time are still
+# the same.  Files modified in the last few seconds aren't cached, since they could
+# still change without a new modification time.
+#
+# Files that aren't in the cache are hashed on 'threads' threads.  Use the cache in a
+# 'with', which saves it at the end.
+class FileHashCache:
+    version = 1
+    settle_seconds = 2
+
+    def __init__(self, cache_file, threads):
+        self.cache_file = cache_file
+        self.threads = threads
+        self.hashes = {}
+        self.changed = False
+        contents = load_sidecar_file(cache_file)
+        if contents is not None and contents.get("version") == FileHashCache.version:
+            files = contents.get("files")
+            # A malformed cache is ignored (and replaced the next time it is saved)
+            if type(files) is dict and all(
+                FileHashCache.is_valid_entry(entry) for entry in files.values()
+            ):
+                self.hashes = files
+
+    # Whether a saved [size, mtime_ns, hash] entry is well-formed
+    def is_valid_entry(entry):
+        return (
+            type(entry) is list
+            and len(entry) == 3
+            and type(entry[0]) is int
+            and type(entry[1]) is int
+            and type(entry[2]) is str
+        )
+
+    def __enter__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.threads)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.executor.shutdown()
+        self.save()
+        return False
+
+    # Returns the hashes of 'files', [(file, stat_result or None)]
+    def get_hashes(self, files):
+        hashes = []
+        missing = []  # (index, path, stat_result)
+        for file, stat in files:
+            path = os.path.abspath(file)
+            if stat is None:
+                stat = os.stat(file)
+            entry = self.hashes.get(path)
+            if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+                hashes.append(entry[2])
+            else:
+                hashes.append(None)
+                missing.append((len(hashes) - 1, path, stat))
+
+        now = time.time()
+        for (index, path, stat), file_hash in zip(
+            missing, self.executor.map(hash_file, [path for _, path, _ in missing])
+        ):
+            hashes[index] = file_hash
+            if now - stat.st_mtime >= FileHashCache.settle_seconds:
+                self.hashes[path] = [stat.st_size, stat.st_mtime_ns, file_hash]
+                self.changed = True
+        return hashes
+
+    def save(self):
+        if self.changed:
+            contents = {"version": FileHashCache.version, "files": self.hashes}
+            save_sidecar_file(self.cache_file, contents, "file hash cache")
+            self.changed = False
+
+
 #
 # Parsers contain the parameterization so that the tools can process LLVM, x64, and
 # ARM64 disassembly.
@@ -555,15 +1861,81 @@ class Parser(ABC):
     def replace_fntable(self, line):
         pass
 
+    # Most of a parser is its rule tables: replace_rules for replace_line and
+    # canon_rules for canon_line and canon_block, each a tuple of Rules applied in
+    # order.  canon_rules patterns are also run over all of a function's lines at
+    # once, so they must use re.MULTILINE for ^ and $ and must not match across a
+    # newline.
+    replace_rules = ()
+    canon_rules = ()
+
+    def apply_rules(self, rules, text):
+        for rule in rules:
+            if rule.guard is None or rule.guard in text:
+                replacement = rule.replacement
+                if not isinstance(replacement, (str, bytes)):
+                    replacement = functools.partial(replacement, self)
+                text = rule.pattern.sub(replacement, text)
+        return text
+
     # Replaces a line with one that removes distracting information (e.g., encoding bytes).
-    @abstractmethod
     def replace_line(self, line):
-        pass
+        return self.apply_rules(self.replace_rules, line)
 
     # Produces a canonicalized version of a line that will be better for diffing.
-    @abstractmethod
     def canon_line(self, line):
-        pass
+        return self.apply_rules(self.canon_rules, line)
+
+    # Canonicalizes all of a function's lines at once: text is the lines joined
+    # together (each ending in a newline), and the result must be the same as joining
+    # canon_line of each line.  Doing a whole function saves a lot of calls per line.
+    # It is only used if canon_line isn't overridden, unless canon_block is too (see
+    # by_block).  A parser can also set this to None to always use canon_line.
+    def canon_block(self, text):
+        return self.apply_rules(self.canon_rules, text)
+
+    # Whether functions can be canonicalized with canon_block.  A parser that
+    # overrides canon_line (e.g., one written before canon_block, or a subclass that
+    # changes what a built-in parser does) would lose its canon_line otherwise.
+    def by_block(self):
+        parser_class = type(self)
+        return bool(self.canon_block) and (
+            parser_class.canon_line is Parser.canon_line
+            or parser_class.canon_block is not Parser.canon_block
+        )
+
+    # Returns the canonicalized text of a function's lines (joined together), using
+    # canon_block
+    def canon_text_by_block(self, lines):
+        if not self.canon_rules and type(self).canon_block is Parser.canon_block:
+            return self.empty.join(lines)
+        if lines and lines[-1][-1:] != self.newline:
+            # Only the last line of a file can be missing the newline, which some
+            # canon_line methods add
+            return self.canon_block(self.empty.join(lines[:-1])) + self.canon_line(
+                lines[-1]
+            )
+        return self.canon_block(self.empty.join(lines))
+
+    # Returns the canonicalized lines for a function's lines, using canon_block
+    def canon_lines_by_block(self, lines):
+        return self.split_text(self.canon_text_by_block(lines))
+
+    # Splits text into lines that end in a newline, except possibly the last one
+    def split_text(self, text):
+        newline = self.newline
+        parts = text.split(newline)
+        last = parts.pop()
+        lines = [part + newline for part in parts]
+        if last:
+            lines.append(last)
+        return lines
+
+    # Canonicalizes a chunk of a SpilledFunction's lines
+    def canon_chunk(self, lines):
+        if self.by_block():
+            return self.canon_lines_by_block(lines)
+        return list(map(self.get_line_cache("canon_line"), lines))
 
     # Returns the function name if the line represents the start of a function.
     # Otherwise return None.
@@ -587,6 +1959,109 @@ class Parser(ABC):
     def func_already_ended(self, line):
         pass
 
+    # Whether the line ends the function one way or the other
+    def ends_function(self, line):
+        return self.func_already_ended(line) or self.func_end(line)
+
+    # Compiled bytes patterns used by split_file with --mmap.  func_start_scan must match
+    # (somewhere in) every line for which func_start returns a name, and func_end_scan
+    # every line that ends a function per func_end or func_already_ended.  Parsers that
+    # leave func_start_scan as None are always split line by line.
+    func_start_scan = None
+    func_end_scan = None
+    # Likewise for func_unopt_from_line, used with --lazy-functions.  None if
+    # func_unopt_from_line is always False.
+    func_unopt_scan = None
+
+    # With --bytes, lines are processed as bytes rather than str from when they are
+    # read until they are written, and are only decoded for the diff strategies.  For
+    # that the methods get their str literals and patterns from attributes, and each
+    # class lists those attributes in text_attributes so that for_bytes can convert
+    # them.  Function names are always str (see to_str).
+    text_attributes = ("newline", "empty", "long_line_prefix")
+
+    is_bytes = False
+    newline = "\n"
+    empty = ""
+    long_line_prefix = "LONG LINE: "
+
+    # Switches this parser to bytes and returns it
+    def for_bytes(self):
+        self.is_bytes = True
+        # Same as opening the file in text mode
+        self.encoding = locale.getpreferredencoding(False)
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("text_attributes", ()):
+                setattr(self, name, text_to_bytes(getattr(self, name)))
+        return self
+
+    # Returns a str for a value taken from a line (e.g., a function name)
+    def to_str(self, value):
+        return value.decode(self.encoding) if self.is_bytes else value
+
+    # Returns the lines as str, for the diff strategies
+    def text_lines(self, lines):
+        if not self.is_bytes:
+            return lines
+        if isinstance(lines, SpilledLines):
+            return SpilledLines(lines.func, lambda line: line.decode(self.encoding))
+        return [line.decode(self.encoding) for line in lines]
+
+    # --line-cache puts bounded LRU caches in front of clean_line and canon_line.  They
+    # are created on first use, so each worker process has its own.  Hits and misses
+    # are counted in Stats by report_line_caches.
+    line_caches = None  # method name -> cache
+    line_cache_reported = None  # method name -> (hits, misses) already counted
+    line_cache_counters = {
+        "clean_line": (CounterKind.CleanCacheHit, CounterKind.CleanCacheMiss),
+        "canon_line": (CounterKind.CanonCacheHit, CounterKind.CanonCacheMiss),
+    }
+
+    # Returns the method to use for name ("clean_line" or "canon_line"): the cached
+    # version with --line-cache
+    def get_line_cache(self, name):
+        if not self.config.line_cache:
+            return getattr(self, name)
+        if self.line_caches is None:
+            self.line_caches = {}
+            self.line_cache_reported = {}
+        cache = self.line_caches.get(name)
+        if cache is None:
+            cache = functools.lru_cache(maxsize=self.config.line_cache)(
+                getattr(self, name)
+            )
+            self.line_caches[name] = cache
+        return cache
+
+    # Counts the cache hits and misses since the last report in stats
+    def report_line_caches(self, stats):
+        if not self.line_caches:
+            return
+        for name, cache in self.line_caches.items():
+            info = cache.cache_info()
+            hits, misses = self.line_cache_reported.get(name, (0, 0))
+            hit_kind, miss_kind = Parser.line_cache_counters[name]
+            stats.incr(hit_kind, info.hits - hits)
+            stats.incr(miss_kind, info.misses - misses)
+            self.line_cache_reported[name] = (info.hits, info.misses)
+
+    # Called at the start of each pass over a file ("pass") and of each pair of files
+    # ("file") to clear the caches if that is their --line-cache-scope
+    def start_line_cache_scope(self, stats, scope):
+        if not self.line_caches or self.config.line_cache_scope != scope:
+            return
+        self.report_line_caches(stats)
+        for cache in self.line_caches.values():
+            cache.cache_clear()
+        self.line_cache_reported.clear()
+
+    # The caches can't be pickled (and belong to a process anyway)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("line_caches", None)
+        state.pop("line_cache_reported", None)
+        return state
+
     # Returns the line back or None depending on whether the line should be kept for
     # viewing in diffs.
     def filter_line(self, line, include_references, include_debug_info):
@@ -602,8 +2077,12 @@ class Parser(ABC):
             line = self.replace_fntable(line)
         line = self.replace_line(line)
         if self.config.max_line_length and len(line) > self.config.max_line_length:
-            prefix = "LONG LINE: "
-            line = prefix + line[: (self.config.max_line_length - len(prefix))] + "\n"
+            prefix = self.long_line_prefix
+            line = (
+                prefix
+                + line[: (self.config.max_line_length - len(prefix))]
+                + self.newline
+            )
         return line
 
     # Named tuple used while splitting files
@@ -626,13 +2105,123 @@ class Parser(ABC):
     #
     # inner_dir is the name of the innermost directory in which the file is contained.
     # It is used for scoped --filename arguments.
-    def split_file(self, stats, file, inner_dir, file_label):
+    #
+    # If line_table (a LineTable) is given, the lines are interned in it.
+    #
+    # Functions named in skip_funcs are thrown away as if they had been filtered out
+    # (see find_unchanged_funcs).
+    def split_file(
+        self, stats, file, inner_dir, file_label, line_table=None, skip_funcs=()
+    ):
         print("  Split {}".format(file_label))
 
+        self.start_line_cache_scope(stats, "pass")
+        try:
+            with self.get_phase_timers(stats)[TimeKind.Split]:
+                return self.split_file2(
+                    stats, file, inner_dir, file_label, line_table, skip_funcs
+                )
+        finally:
+            self.report_line_caches(stats)
+
+    # --timing: timing every line of a file (Filter, Clean, FuncStart, ...) takes a
+    # good part of the time that is being measured, so by default ("phase") there is
+    # just the Split timer around each file instead.  "sampled" times one in
+    # --timing-sample lines and scales those times up, "line" times every line, and
+    # "none" doesn't time splitting at all.  These return the timers to use for the
+    # whole split and for each line (or function, with --lazy-functions).
+    def get_phase_timers(self, stats):
+        return stats.timers if self.config.timing == "phase" else null_timers
+
+    def get_split_timers(self, stats):
+        if self.config.timing in ("sampled", "line"):
+            return stats.timers
+        return null_timers
+
+    def split_file2(self, stats, file, inner_dir, file_label, line_table, skip_funcs):
+        # Lines outside functions are only thrown away with --only-functions, so that's
+        # the only time that the mapped file can skip over them (or be split lazily).
+        # With --opt-only, whole functions can still be skipped.
+        if (
+            self.config.mmap
+            and (self.config.only_functions or self.config.opt_only)
+            and self.func_start_scan
+            and os.path.getsize(file) > 0  # can't map an empty file
+        ):
+            with open(file, "rb") as read_file:
+                buffer = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.config.lazy_functions and self.config.only_functions:
+                # LazyFunctions keep the mapping open until they're gone
+                entries = self.get_function_entries(stats, file, buffer)
+                if skip_funcs:
+                    entries = [e for e in entries if e.name not in skip_funcs]
+                return self.split_lazy(stats, buffer, entries, inner_dir, line_table)
+            with buffer:
+                lines = MappedLines(
+                    buffer,
+                    self.func_start_scan,
+                    self.func_end_scan,
+                    binary=self.is_bytes,
+                )
+                return self.split_lines(
+                    stats, lines, inner_dir, file_label, line_table, lines, skip_funcs
+                )
+
+        if self.is_bytes:
+            with open(file, "rb") as read_file:
+                return self.split_lines(
+                    stats,
+                    binary_lines(read_file),
+                    inner_dir,
+                    file_label,
+                    line_table,
+                    skip_funcs=skip_funcs,
+                )
+
+        with open(file, "r") as read_file:
+            return self.split_lines(
+                stats,
+                read_file,
+                inner_dir,
+                file_label,
+                line_table,
+                skip_funcs=skip_funcs,
+            )
+
+    # The line-by-line part of split_file.  If 'mapped' is given (a MappedLines, which
+    # is also 'lines'), it is used to jump over lines that would be thrown away anyway.
+    # Otherwise, if any lines can be thrown away, they are skipped with SkippingLines.
+    def split_lines(
+        self,
+        stats,
+        lines,
+        inner_dir,
+        file_label,
+        line_table=None,
+        mapped=None,
+        skip_funcs=(),
+    ):
         include_all_blank_lines = self.config.include_all_blank_lines
         include_debug_info = self.config.include_debug_info
         include_outside = not self.config.only_functions
         include_references = self.config.include_references
+        if mapped is None and (
+            self.config.opt_only
+            or not include_outside
+            or self.config.filters_funcs()
+            or skip_funcs
+        ):
+            lines = mapped = SkippingLines(lines, self)
+        intern = line_table.intern if line_table else None
+        clean_line = self.get_line_cache("clean_line")
+        spill_lines = self.config.spill_lines
+        spilled = []
+
+        timers = self.get_split_timers(stats)
+        sample = self.config.timing_sample if self.config.timing == "sampled" else 0
+        if sample:
+            sample_timers = [Stopwatch(str(k)) for k in TimeKind]
+            countdown = 1
 
         funcs = {}
         current = []  # stack (currently only 0-2 elements)
@@ -647,140 +2236,472 @@ class Parser(ABC):
         in_func = False
         in_trash = outside_is_trash
 
-        with open(file, "r") as read_file:
-            for line in read_file:
-                if in_trash:
-                    filtered_line = line
-                else:
-                    with stats.timers[TimeKind.Filter]:
-                        filtered_line = self.filter_line(
-                            line, include_references, include_debug_info
+        if mapped and in_trash:
+            mapped.skip_outside()
+
+        # The timers for the steps of each line are looked up once, here, rather than
+        # for each step.  They're null timers unless lines are timed.  With "sampled",
+        # they're switched to the sample's timers for one line in --timing-sample, and
+        # back to null timers for the next.
+        line_timer_kinds = (
+            TimeKind.Filter,
+            TimeKind.Clean,
+            TimeKind.FuncEnd,
+            TimeKind.FuncStart,
+            TimeKind.AddFunc,
+            TimeKind.Blank,
+            TimeKind.Append,
+        )
+        untimed = [null_timers[kind] for kind in line_timer_kinds]
+        if sample:
+            timed = [sample_timers[kind] for kind in line_timer_kinds]
+        else:
+            timed = [timers[kind] for kind in line_timer_kinds]
+        (
+            filter_timer,
+            clean_timer,
+            func_end_timer,
+            func_start_timer,
+            add_func_timer,
+            blank_timer,
+            append_timer,
+        ) = timed
+
+        for line in lines:
+            if sample:
+                countdown -= 1
+                if not countdown or countdown == sample - 1:
+                    (
+                        filter_timer,
+                        clean_timer,
+                        func_end_timer,
+                        func_start_timer,
+                        add_func_timer,
+                        blank_timer,
+                        append_timer,
+                    ) = (untimed if countdown else timed)
+                    if not countdown:
+                        countdown = sample
+
+            if in_trash:
+                filtered_line = line
+            else:
+                with filter_timer:
+                    filtered_line = self.filter_line(
+                        line, include_references, include_debug_info
+                    )
+                    if filtered_line is None:
+                        continue
+                with clean_timer:
+                    filtered_line = clean_line(filtered_line)
+
+            with func_end_timer:
+                if in_func and self.func_already_ended(filtered_line):
+                    in_func = False
+                    if not in_trash:
+                        current.pop()
+                    in_trash = outside_is_trash
+
+            if not in_func:
+                with func_start_timer:
+                    func_start_name = self.func_start(filtered_line)
+                with add_func_timer:
+                    if func_start_name:
+                        # print("start {}".format(func_start_name))
+                        in_func = True
+                        in_trash = (
+                            func_start_name in skip_funcs
+                            or not self.config.keep_func(inner_dir, func_start_name)
                         )
-                        if filtered_line is None:
-                            continue
-                    with stats.timers[TimeKind.Clean]:
-                        filtered_line = self.clean_line(filtered_line)
 
-                with stats.timers[TimeKind.FuncEnd]:
-                    if in_func and self.func_already_ended(filtered_line):
-                        in_func = False
                         if not in_trash:
-                            current.pop()
-                        in_trash = outside_is_trash
-
-                if not in_func:
-                    with stats.timers[TimeKind.FuncStart]:
-                        func_start_name = self.func_start(filtered_line)
-                    with stats.timers[TimeKind.AddFunc]:
-                        if func_start_name:
-                            # print("start {}".format(func_start_name))
-                            in_func = True
-                            in_trash = not self.config.keep_func(
-                                inner_dir, func_start_name
-                            )
-
-                            if not in_trash:
-                                stats.incr(CounterKind.EarlyCount)
-                                func = funcs.get(func_start_name)
-                                if func:
-                                    # The same function name appears multiple
-                                    # times in the input. It's not clear what
-                                    # to do with this, so just add some spacing.
-                                    func.lines.append("\n")
-                                    func.lines.append("\n")
-                                else:
-                                    funcs[func_start_name] = func = new_Function()
-                                current.append(Parser.Item(func_name=func_start_name, func=func))
-
-                if not in_trash:
-                    with stats.timers[TimeKind.AddFunc]:
-                        if in_func and not in_trash and self.config.opt_only and self.func_unopt_from_line(filtered_line):
-                            # Need to undo the above AddFunc (not in_trash) code
-                            in_trash = True
-                            stats.incr(CounterKind.EarlyCount, -1) # hack
-                            del funcs[current[-1].func_name]
-                            current.pop()
-
-                if not in_trash:
-                    # "" (shouldn't happen) or "\n"
-                    with stats.timers[TimeKind.Blank]:
-                        if include_all_blank_lines or len(filtered_line) > 1:
-                            current[-1].last_blank = False
-                        else:
-                            if current[-1].last_blank:
-                                continue
-                            current[-1].last_blank = True
-
-                    with stats.timers[TimeKind.Append]:
-                        if in_func or include_outside:
-                            current[-1].func.lines.append(filtered_line)
-
-                with stats.timers[TimeKind.FuncEnd]:
-                    if in_func and self.func_end(filtered_line):
-                        in_func = False
-                        if not in_trash:
-                            current.pop()
-                        in_trash = outside_is_trash
+                            stats.incr(CounterKind.EarlyCount)
+                            func = funcs.get(func_start_name)
+                            if func:
+                                # The same function name appears multiple
+                                # times in the input. It's not clear what
+                                # to do with this, so just add some spacing.
+                                func.lines.append(self.newline)
+                                func.lines.append(self.newline)
+                            else:
+                                funcs[func_start_name] = func = new_Function()
+                            current.append(Parser.Item(func_name=func_start_name, func=func))
+
+            if not in_trash:
+                with add_func_timer:
+                    if in_func and not in_trash and self.config.opt_only and self.func_unopt_from_line(filtered_line):
+                        # Need to undo the above AddFunc (not in_trash) code
+                        in_trash = True
+                        stats.incr(CounterKind.EarlyCount, -1) # hack
+                        del funcs[current[-1].func_name]
+                        current.pop()
+
+            if not in_trash:
+                # "" (shouldn't happen) or "\n"
+                with blank_timer:
+                    if include_all_blank_lines or len(filtered_line) > 1:
+                        current[-1].last_blank = False
+                    else:
+                        if current[-1].last_blank:
+                            continue
+                        current[-1].last_blank = True
+
+                with append_timer:
+                    if in_func or include_outside:
+                        if intern:
+                            filtered_line = intern(filtered_line)
+                        func_lines = current[-1].func.lines
+                        func_lines.append(filtered_line)
+                        if spill_lines and len(func_lines) >= spill_lines:
+                            self.spill(stats, funcs, current[-1], spilled)
+
+            with func_end_timer:
+                if in_func and self.func_end(filtered_line):
+                    in_func = False
+                    if not in_trash:
+                        current.pop()
+                    in_trash = outside_is_trash
+
+            # Jump over the rest of anything that is thrown away (e.g., a function
+            # found to be unoptimized with --opt-only) without processing each line
+            if mapped and in_trash:
+                if in_func:
+                    mapped.skip_function()
+                else:
+                    mapped.skip_outside()
 
+        if sample:
+            for total, sample_timer in zip(stats.timers, sample_timers):
+                total.add(sample_timer, scale=sample)
+
+        self.finish_split(funcs, spilled)
         return funcs
 
+    # Sets the line_hash of the functions that split_lines found, and finishes those
+    # that were spilled.  Hashing all of a function's lines at once is cheaper than
+    # hashing each line as it is appended.
+    def finish_split(self, funcs, spilled):
+        empty = self.empty
+        for func in funcs.values():
+            if type(func) is Function:
+                func.line_hash = fingerprint(empty.join(func.lines))
+        for func in spilled:
+            func.finish()
+
+    # Writes out the lines of a function that has reached --spill-lines lines, turning
+    # it into a SpilledFunction first if it isn't one yet
+    def spill(self, stats, funcs, item, spilled):
+        func = item.func
+        if not isinstance(func, SpilledFunction):
+            stats.incr(CounterKind.Spilled)
+            func = SpilledFunction(self, func.lines)
+            funcs[item.func_name] = item.func = func
+            spilled.append(func)
+        func.write_chunks()
+
+    # Yields (name, start, end) for each function in a mapped file, where [start, end)
+    # are the offsets of its lines.  Functions are found the same way as split_lines
+    # finds them with --only-functions, but only the lines that start and end them
+    # are looked at.
+    def scan_functions(self, buffer):
+        lines = MappedLines(
+            buffer, self.func_start_scan, self.func_end_scan, binary=self.is_bytes
+        )
+        func_name = None
+        start = 0
+
+        lines.skip_outside()
+        for line in lines:
+            if func_name:
+                if self.func_already_ended(line):
+                    yield func_name, start, lines.line_start
+                    # this line may start the next function
+                elif self.func_end(line):
+                    yield func_name, start, lines.pos
+                    func_name = None
+                    lines.skip_outside()
+                    continue
+                else:
+                    lines.skip_function()
+                    continue
+
+            func_name = self.func_start(line)
+            if func_name:
+                start = lines.line_start
+                lines.skip_function()
+            else:
+                lines.skip_outside()
+
+        if func_name:
+            # The function wasn't ended before the end of the file
+            yield func_name, start, lines.pos
+
+    # Whether the function in [start, end) of a mapped file is unoptimized
+    def is_unopt(self, buffer, start, end):
+        return bool(
+            self.func_unopt_scan and self.func_unopt_scan.search(buffer, start, end)
+        )
+
+    # Returns the FunctionIndex entries for a mapped file, from its .fidx sidecar with
+    # --function-index (which is written if it is missing or out of date), or else by
+    # scanning the file.
+    def get_function_entries(self, stats, file, buffer):
+        if not self.config.function_index:
+            with self.get_split_timers(stats)[TimeKind.FuncStart]:
+                return [
+                    FunctionIndex.Entry(name, start, end, None, None)
+                    for name, start, end in self.scan_functions(buffer)
+                ]
+
+        index_file = FunctionIndex.get_index_file(self.config, file)
+        key = FunctionIndex.get_key(self.config, file)
+        entries = FunctionIndex.load(index_file, key)
+        if entries is None:
+            with self.get_split_timers(stats)[TimeKind.FuncStart]:
+                entries = FunctionIndex.build(self, buffer)
+            FunctionIndex.save(index_file, key, entries)
+        return entries
+
+    # --changed-regions: finds the functions that are byte for byte the same in a base
+    # and a diff file before they are split, so that split_file can throw them away
+    # (skip_funcs) instead of splitting them only to have them match early.  They are
+    # counted here the way splitting and early matching would have counted them.
+    #
+    # This is rsync's idea of hashing content-defined chunks of the files to find the
+    # parts that differ, but the chunks are cut where functions start (as found by
+    # scan_functions), not by a rolling hash of every byte, which would be slower in
+    # Python than splitting.  Text that is added or removed only changes the chunks
+    # around it either way, and function chunks are what splitting needs to know.
+    #
+    # Only with --only-functions (lines outside functions are all kept in one
+    # function otherwise), and not with --lazy-functions, which reads no lines of
+    # functions that match early anyway.  Returns the names of the functions.
+    def find_unchanged_funcs(self, stats, base_file, diff_file, inner_dir):
+        if (
+            not self.config.only_functions
+            or self.config.lazy_functions
+            or not self.func_start_scan
+            or os.path.getsize(base_file) == 0
+            or os.path.getsize(diff_file) == 0
+        ):
+            return frozenset()
+
+        with open(base_file, "rb") as read_file:
+            base_buffer = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(diff_file, "rb") as read_file:
+            diff_buffer = mmap.mmap(read_file.fileno(), 0, access=mmap.ACCESS_READ)
+        with base_buffer, diff_buffer:
+            base_chunks = self.get_function_chunks(stats, base_file, base_buffer)
+            diff_chunks = self.get_function_chunks(stats, diff_file, diff_buffer)
+
+            with stats.timers[TimeKind.EarlyMatch]:
+                unchanged = set()
+                for name, base_entries in base_chunks.items():
+                    diff_entries = diff_chunks.get(name)
+                    if (
+                        diff_entries
+                        and self.config.keep_func(inner_dir, name)
+                        and self.same_chunks(
+                            base_buffer, base_entries, diff_buffer, diff_entries
+                        )
+                    ):
+                        unchanged.add(name)
+                        stats.incr(CounterKind.EarlyCount, 2 * len(base_entries))
+                        stats.incr(CounterKind.EarlyMatch)
+
+        return frozenset(unchanged)
+
+    # The FunctionIndex entries of a mapped file by function name
+    def get_function_chunks(self, stats, file, buffer):
+        chunks = {}
+        for entry in self.get_function_entries(stats, file, buffer):
+            chunks.setdefault(entry.name, []).append(entry)
+        return chunks
+
+    # Whether all of the chunks of a function are the same in base and diff.  The
+    # index hashes are compared if there are any (but not with --paranoid), or else
+    # the bytes.  With --opt-only, an unoptimized function is never the same: splitting
+    # drops it.
+    def same_chunks(self, base_buffer, base_entries, diff_buffer, diff_entries):
+        if len(base_entries) != len(diff_entries):
+            return False
+        for base_entry, diff_entry in zip(base_entries, diff_entries):
+            if base_entry.end - base_entry.start != diff_entry.end - diff_entry.start:
+                return False
+            if (
+                base_entry.hash is not None
+                and diff_entry.hash is not None
+                and not self.config.paranoid
+            ):
+                if base_entry.hash != diff_entry.hash:
+                    return False
+            elif (
+                base_buffer[base_entry.start : base_entry.end]
+                != diff_buffer[diff_entry.start : diff_entry.end]
+            ):
+                return False
+        if self.config.opt_only:
+            for entry in base_entries:
+                unopt = entry.unopt
+                if unopt is None:
+                    unopt = self.is_unopt(base_buffer, entry.start, entry.end)
+                if unopt:
+                    return False
+        return True
+
+    # split_file with --lazy-functions.  Returns { function_name -> LazyFunction },
+    # keeping the functions that split_lines would keep.
+    def split_lazy(self, stats, buffer, entries, inner_dir, line_table=None):
+        timers = self.get_split_timers(stats)
+        funcs = {}
+        for entry in entries:
+            with timers[TimeKind.AddFunc]:
+                if not self.config.keep_func(inner_dir, entry.name):
+                    continue
+
+                stats.incr(CounterKind.EarlyCount)
+                if self.config.opt_only:
+                    unopt = entry.unopt
+                    if unopt is None:
+                        unopt = self.is_unopt(buffer, entry.start, entry.end)
+                    if unopt:
+                        # Same as split_lines, which drops all of the function
+                        stats.incr(CounterKind.EarlyCount, -1)
+                        funcs.pop(entry.name, None)
+                        continue
+
+                func = funcs.get(entry.name)
+                if not func:
+                    funcs[entry.name] = func = LazyFunction(self, buffer, line_table)
+                func.ranges.append((entry.start, entry.end))
+                func.hashes.append(entry.hash)
+
+        return funcs
+
+    # Reads the lines of a LazyFunction the way split_lines would have: the first
+    # line of each range starts the function and is kept as is, the rest are filtered
+    # and cleaned.
+    def read_lines(self, buffer, ranges, line_table=None):
+        include_all_blank_lines = self.config.include_all_blank_lines
+        include_debug_info = self.config.include_debug_info
+        include_references = self.config.include_references
+        intern = line_table.intern if line_table else None
+        clean_line = self.get_line_cache("clean_line")
+
+        lines = []
+        for start, end in ranges:
+            if lines:
+                # Same as split_lines for repeated function names
+                lines.append(self.newline)
+                lines.append(self.newline)
+
+            last_blank = True
+            mapped = MappedLines(buffer, pos=start, limit=end, binary=self.is_bytes)
+            for index, line in enumerate(mapped):
+                if index:
+                    line = self.filter_line(line, include_references, include_debug_info)
+                    if line is None:
+                        continue
+                    line = clean_line(line)
+
+                if include_all_blank_lines or len(line) > 1:
+                    last_blank = False
+                else:
+                    if last_blank:
+                        continue
+                    last_blank = True
+
+                if intern:
+                    line = intern(line)
+                lines.append(line)
+
+        return lines
+
 
 class LlvmParser(Parser):
     def default_filespec(self):
         return "*.ll"
 
+    text_attributes = (
+        "debug_value_prefix",
+        "DI_def",
+        "reference_prefix",
+        "fntable_prefix",
+        "fntable_end",
+        "fntable_replacement",
+        "replace_rules",
+        "canon_rules",
+        "block_label_replacement",
+        "func_def",
+        "func_end_prefix",
+    )
+
+    debug_value_prefix = "  call void @llvm.dbg.value"
     DI_def = re.compile(r"!\d+ = (?:distinct|!DI|!{)", re.ASCII)
 
     def is_debug_info(self, line):
         # 'match' means at start of line
-        return line.startswith("  call void @llvm.dbg.value") or self.DI_def.match(line)
+        return line.startswith(self.debug_value_prefix) or self.DI_def.match(line)
+
+    reference_prefix = "declare "
 
     def is_reference(self, line):
-        return line.startswith(r"declare ")
+        return line.startswith(self.reference_prefix)
+
+    fntable_prefix = "@SbtFnTable = "
+    fntable_end = "]"
+    fntable_replacement = "...\n"
 
     def replace_fntable(self, line):
-        if line.startswith(r"@SbtFnTable = "):
-            end = line.find("]") + 1
-            line = line[:end] + "...\n"
+        if line.startswith(self.fntable_prefix):
+            end = line.find(self.fntable_end) + 1
+            line = line[:end] + self.fntable_replacement
         return line
 
     # Match either i64 or i8* for GPR type since this is something we may occasionally change
     # e.g. for rip/rsp/rbp
     sapphire_cc_regs = re.compile(r"%GuestCtx\*(, (i64|i8\*)){17,17}(, <4 x i32>){16,16}")
 
-    def replace_line(self, line):
-        line = self.sapphire_cc_regs.sub("SphCCRegs", line)
-        return line
+    replace_rules = (Rule("GuestCtx", sapphire_cc_regs, "SphCCRegs"),)
 
     variable = re.compile(r"(%|!)\d+|(%[a-zA-Z.]+(?:[0-9]+[A-Za-z.]+)*)\d*", re.ASCII)
+    # The newline is replaced too since the label is padded
     block_label = re.compile(
-        r"^(?:([A-Za-z.]*)[0-9]+|(Label_)[a-f0-9]+): +(; preds.*)$", re.ASCII
+        r"^(?:([A-Za-z.]*)[0-9]+|(Label_)[a-f0-9]+): +(; preds.*)$\n?",
+        re.ASCII | re.MULTILINE,
     )
+    block_label_replacement = r"\1\2[[N]]:"
 
-    def canon_line(self, line):
+    def replace_block_label(self, block_match):
+        return (
+            block_match.expand(self.block_label_replacement).ljust(50)
+            + block_match.group(3)
+            + self.newline
+        )
+
+    canon_rules = (
         # only one of \1 or \2 will have a value
-        line = self.variable.sub(r"\1\2[[N]]", line)
-        block_match = self.block_label.match(line)
-        if block_match:
-            line = (
-                block_match.expand(r"\1\2[[N]]:").ljust(50)
-                + block_match.group(3)
-                + "\n"
-            )
-        return line
+        Rule(None, variable, r"\1\2[[N]]"),
+        Rule("; preds", block_label, replace_block_label),
+    )
 
     func_def = re.compile(r"define [^@]*@([^(]+)\(")
+    func_start_scan = re.compile(rb"^define ", re.MULTILINE)
+    func_end_scan = re.compile(rb"^}", re.MULTILINE)
 
     def func_start(self, line):
         func_match = self.func_def.match(line)  # 'match' means at start of line
-        return func_match.group(1) if func_match else None
+        return self.to_str(func_match.group(1)) if func_match else None
 
     def func_unopt_from_line(self, line):
         return False
 
+    func_end_prefix = "}"
+
     def func_end(self, line):
-        return line[0] == "}"  # ugh, this is faster.  All lines should have \n.
-        # return line.startswith("}")
+        # ugh, this is faster than startswith.  All lines should have \n.  (line[0]
+        # would be an int for bytes.)
+        return line[:1] == self.func_end_prefix
 
     def func_already_ended(self, line):
         return False
@@ -790,8 +2711,21 @@ class ArmParser(Parser):
     def default_filespec(self):
         return "*.s"
 
+    text_attributes = (
+        "debug_value_text",
+        "loc_text",
+        "replace_rules",
+        "canon_rules",
+        "line_comments",
+        "func_def",
+        "func_end_text",
+    )
+
+    debug_value_text = "//DEBUG_VALUE: "
+    loc_text = "\t.loc"
+
     def is_debug_info(self, line):
-        return "//DEBUG_VALUE: " in line or "\t.loc" in line
+        return self.debug_value_text in line or self.loc_text in line
 
     def is_reference(self, line):
         return False
@@ -801,10 +2735,10 @@ class ArmParser(Parser):
 
     encoding_comments = re.compile(r" +// encoding: .*")
 
-    def replace_line(self, line):
+    replace_rules = (
         # mov   w16, #41944             // encoding: [0x10,0x7b,0x94,0x52]
-        line = self.encoding_comments.sub(r"", line)
-        return line
+        Rule("// encoding: ", encoding_comments, ""),
+    )
 
     numbered = re.compile(
         r"(\.Lfunc_begin|\.Lfunc_end|\.Lexception|\.Ltmp|\.LBB(?:\d+)_|\.Lcst_begin|\.Lcst_end|\.Lttbase|\.Lttbaseref|\.LJTI|\.LCPI|\.Ldebug_loc|string offset=|GCC_except_table|x|w|%bb\.|%return)\d+",
@@ -812,33 +2746,35 @@ class ArmParser(Parser):
     )
     line_comments = re.compile(r" +// .*")
 
-    def canon_line(self, line):
+    canon_rules = (
         # numbered things
-        line = self.numbered.sub(r"\1[[N]]", line)
-
+        Rule(None, numbered, r"\1[[N]]"),
         # possible future improvement: remove or simplify this kind of line (optionally?)
         #    // fixup A - offset: 0, value: S_SbtGlobalDispatchDll, kind: fixup_aarch64_pcrel_call26
-        # line = self.line_comments.sub(r"", line)
-
+        # Rule("// ", line_comments, ""),
+        #
         # Old scripts had these - needed?
         #        -e s/[[:punct:]]%PATHFILE%[[:punct:]]/[[file]]/g ^
         # rem  -e s/\/\/[[:space:]]%PATHFILE%/[[file]]/g ^
         # rem sed ':a;s/\([Ss]h\.*\)[^\. ]/\1./;ta;s/[Ss]h/../g'
         # rem  -e s/[[:space:]]\+\/\//"  "\/\//g ^
-
-        return line
+    )
 
     func_def = re.compile(r"// -- Begin function (.*)")
+    func_start_scan = re.compile(rb"// -- Begin function")
+    func_end_scan = re.compile(rb"// -- End function")
 
     def func_start(self, line):
         func_match = self.func_def.search(line)  # 'search' means anywhere in line
-        return func_match.group(1) if func_match else None
+        return self.to_str(func_match.group(1)) if func_match else None
 
     def func_unopt_from_line(self, line):
         return False
 
+    func_end_text = "// -- End function"
+
     def func_end(self, line):
-        return "// -- End function" in line
+        return self.func_end_text in line
 
     def func_already_ended(self, line):
         return False
@@ -848,6 +2784,8 @@ class X64Parser(Parser):
     def default_filespec(self):
         return "*.asm"
 
+    text_attributes = ("replace_rules", "func_def")
+
     def is_debug_info(self, line):
         return False
 
@@ -860,23 +2798,24 @@ class X64Parser(Parser):
     encoding_bytes1 = re.compile(r"(^  [0-9A-F]{16}:)(?: [0-9A-F]{2}){1,6} +")
     encoding_bytes2 = re.compile(r"^ +(?: [0-9A-F]{2}){1,6}$")
 
-    def replace_line(self, line):
+    replace_rules = (
         #  0000000140001006: F2 0F 10 0D 0A D3  movsd       xmm1,mmword ptr [__real@3fa999999999999a]
         #                    03 00
-        line = self.encoding_bytes1.sub(r"\1  ", line)
-        line = self.encoding_bytes2.sub(r"", line)
-        return line
-
-    def canon_line(self, line):
-        # possible future improvement: remove distracting numbers?
+        Rule(":", encoding_bytes1, r"\1  "),
+        Rule(None, encoding_bytes2, ""),
+    )
 
-        return line
+    # possible future improvement: remove distracting numbers?
+    canon_rules = ()
 
     func_def = re.compile(r"^([^ ]+):$")
+    # Functions only end where the next one starts
+    func_start_scan = re.compile(rb"^[^ \r\n]+:\r?$", re.MULTILINE)
+    func_end_scan = func_start_scan
 
     def func_start(self, line):
         func_match = self.func_def.match(line)
-        return func_match.group(1) if func_match else None
+        return self.to_str(func_match.group(1)) if func_match else None
 
     def func_unopt_from_line(self, line):
         return False
@@ -892,6 +2831,8 @@ class JITX64Parser(Parser):
     def default_filespec(self):
         return "*.dasm"
 
+    text_attributes = ("canon_rules", "func_def", "unopt_prefix", "func_end_prefix")
+
     def is_debug_info(self, line):
         return False
 
@@ -901,36 +2842,90 @@ class JITX64Parser(Parser):
     def replace_fntable(self, line):
         return line
 
-    def replace_line(self, line):
-        return line
-
     rbp_offset = re.compile(r"([rsp|rbp])([\+\-])[0-9A-F]+H")
-    comment = re.compile("\s*;.*$")
+    # Not \s, which could match the newline before a comment line in canon_block
+    comment = re.compile(r"[^\S\n]*;.*$", re.MULTILINE)
     IG = re.compile(r"G_M\d+_IG\d+")
 
-    def canon_line(self, line):
+    canon_rules = (
         # possible future improvement: remove distracting numbers?
-        line = self.rbp_offset.sub(r"\1\2[[N]]", line)
-        line = self.comment.sub(r"", line)
-        line = self.IG.sub(r"G_M[[N]]_IG[[N]]", line)
-        return line
+        Rule("H", rbp_offset, r"\1\2[[N]]"),
+        Rule(";", comment, ""),
+        Rule("_IG", IG, r"G_M[[N]]_IG[[N]]"),
+    )
 
     func_def = re.compile(r"^; Assembly listing for method (.*)$")
+    func_start_scan = re.compile(rb"^; Assembly listing for method ", re.MULTILINE)
+    func_end_scan = re.compile(rb"^; Total bytes of code", re.MULTILINE)
+    func_unopt_scan = re.compile(rb"^; MinOpts code", re.MULTILINE)
     invalid_chars = "():<>+"
 
     def func_start(self, line):
         func_match = self.func_def.match(line)
-        return ''.join(['_' if c in self.invalid_chars else c for c in func_match.group(1)]) if func_match else None
+        return ''.join(['_' if c in self.invalid_chars else c for c in self.to_str(func_match.group(1))]) if func_match else None
+
+    unopt_prefix = "; MinOpts code"
 
     def func_unopt_from_line(self, line):
-        return line.startswith("; MinOpts code")
+        return line.startswith(self.unopt_prefix)
+
+    func_end_prefix = "; Total bytes of code"
 
     def func_end(self, line):
-        return line.startswith("; Total bytes of code")
+        return line.startswith(self.func_end_prefix)
 
     def func_already_ended(self, line):
         return False
 
 
+#
+# Parsers by kind (the -k/--kind argument).  A parser is registered either as a class
+# or as "module:Class", which is only imported the first time the kind is used.
+# --parser-module loads a module that calls register_parser for its own parsers, so
+# new kinds don't need changes here.
+#
+parser_registry = {
+    "llvm": LlvmParser,
+    "arm": ArmParser,
+    "x64": X64Parser,
+    "jitx64": JITX64Parser,
+}
+
+
+def register_parser(kind, parser):
+    parser_registry[kind] = parser
+
+
+# Returns the parser class for kind, importing it if needed
+def get_parser_class(kind):
+    parser = parser_registry.get(kind)
+    if parser is None:
+        raise ValueError(
+            "Unknown kind {} (known kinds: {})".format(
+                kind, ", ".join(sorted(parser_registry))
+            )
+        )
+    if isinstance(parser, str):
+        module_name, _, class_name = parser.partition(":")
+        parser = getattr(importlib.import_module(module_name), class_name)
+        parser_registry[kind] = parser
+    return parser
+
+
+# Imports a --parser-module, given as a module name or a path to a .py file
+def load_parser_module(name):
+    if not name.endswith(".py"):
+        return importlib.import_module(name)
+    module_name = os.path.splitext(os.path.basename(name))[0]
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, name)
+    module = importlib.util.module_from_spec(spec)
+    # Registered first so that worker processes can unpickle its parsers by name
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
 def parser_map():
-    return {"llvm": LlvmParser, "arm": ArmParser, "x64": X64Parser, "jitx64": JITX64Parser}
+    return {kind: get_parser_class(kind) for kind in parser_registry}
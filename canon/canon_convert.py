@@ -0,0 +1,48 @@
+# Converts Python strategy files (such as samples/*.py) to the declarative format
+# read by load_strategy_file (see the "Declarative strategy files" comment in canon.py).
+
+import argparse
+import os
+import sys
+
+from canon import *
+
+
+def convert_file(input_filename, output_dir):
+    items = load_strategy_file(input_filename)
+
+    output_filename = change_ext(input_filename, declarative_strategy_ext)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        output_filename = os.path.join(output_dir, os.path.basename(output_filename))
+
+    write_declarative_strategy_file(items, output_filename)
+
+    # Make sure that the output reads back to the same strategies
+    if repr(load_strategy_file(output_filename)) != repr(items):
+        raise ValueError("{} did not convert faithfully".format(input_filename))
+
+    print("{} -> {} ({} items)".format(input_filename, output_filename, len(items)))
+
+
+def main(args):
+    cmd_parser = argparse.ArgumentParser(
+        description="Convert Python strategy files to declarative ({}) files".format(
+            declarative_strategy_ext
+        )
+    )
+    cmd_parser.add_argument("files", metavar="FILE", nargs="+", help="Python strategy file")
+    cmd_parser.add_argument(
+        "-o",
+        "--output-dir",
+        help="Set output directory (defaults to next to each input file)",
+        default=None,
+    )
+    cmd_args = cmd_parser.parse_args(args)
+
+    for input_filename in cmd_args.files:
+        convert_file(input_filename, cmd_args.output_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -57,10 +57,12 @@ class ExtractTool:
         config = ExtractTool.parse_args(args)
         extracttool = ExtractTool()
         extracttool.config = config
-        extracttool.stats = Stats("Total")
+        extracttool.stats = Stats("Total", config.timing)
 
-        extracttool.parser = parser_map()[config.kind]()
+        extracttool.parser = get_parser_class(config.kind)()
         extracttool.parser.config = config
+        if config.bytes_mode:
+            extracttool.parser.for_bytes()
         if not config.filespecs:
             config.filespecs = [extracttool.parser.default_filespec()]
 
@@ -77,14 +79,17 @@ class ExtractTool:
         #
 
         rel_dir_dict = {}
-        with self.stats.timers[TimeKind.Walk]:
-            HasFile.add_dirwalk(
+        with self.stats.timers[TimeKind.Walk] as walk_timer:
+            dir_count = HasFile.add_dirwalk(
                 rel_dir_dict,
                 input_dir,
                 HasFile.BASE,
                 self.config.filespecs,
                 self.config.exclude_filespecs,
+                threads=self.config.walk_threads,
             )
+        self.stats.incr(CounterKind.WalkDirs, dir_count)
+        HasFile.print_walk_rate(dir_count, walk_timer)
 
         #
         # Queue a job for each file
@@ -104,9 +109,21 @@ class ExtractTool:
                 rel_file = os.path.join(dirpath, file)
                 input_file = os.path.join(input_dir, rel_file)
 
+                if not NameFilter.may_have_wanted_funcs(
+                    self.config, self.parser, input_file, inner_dir
+                ):
+                    print(" No requested functions in {}".format(rel_file))
+                    self.stats.incr(CounterKind.NameFiltered)
+                    continue
+
                 file_label = get_without_ext(file)
                 controller.queue_job(
-                    self.process_file, input_file, extract_subdir, inner_dir, file_label
+                    self.process_file,
+                    input_file,
+                    extract_subdir,
+                    inner_dir,
+                    file_label,
+                    files=(input_file,),
                 )
 
     def process_file(self, input_file, extract_subdir, inner_dir, file_label):
@@ -120,7 +137,15 @@ class ExtractTool:
         print(" Process {}".format(file_label))
         os.makedirs(extract_subdir, exist_ok=True)
 
-        stats = Stats(file_label)
+        stats = Stats(file_label, self.config.timing)
+        # Builds the name filter if it wasn't there when the file was queued
+        if not NameFilter.may_have_wanted_funcs(
+            self.config, self.parser, input_file, inner_dir, build=True
+        ):
+            print("  No requested functions in {}".format(file_label))
+            stats.incr(CounterKind.NameFiltered)
+            return extract_subdir, {}, {}, stats
+
         funcs = self.parser.split_file(stats, input_file, inner_dir, file_label)
 
         return self.process_file_contents(
@@ -136,13 +161,13 @@ class ExtractTool:
                 _, filename = os.path.split(input_file)
                 output_file = os.path.join(extract_subdir, filename)
 
-                with open(output_file, "w") as f:
+                with open(output_file, "wb" if self.parser.is_bytes else "w") as f:
                     first = True
                     for funcname, function in funcs.items():
                         if first:
                             first = False
                         else:
-                            f.write("\n")
+                            f.write(self.parser.newline)
 
                         f.writelines(function.lines)
 
@@ -43,8 +43,43 @@ def hash_str(string):
     return (hash1 + (hash2 * 1566083941)) % mod_value
 
 
+# Finds every index at which 'pattern' occurs as a contiguous run in 'sequence' using
+# Rabin-Karp (a rolling hash over the elements, verified on a hash hit).  The elements
+# are expected to be small integers, such as interned line ids.
+def find_subsequences(sequence, pattern):
+    size = len(pattern)
+    if size == 0 or size > len(sequence):
+        return []
+
+    mod_value = (1 << 61) - 1
+    base = 1_000_003
+    high = pow(base, size - 1, mod_value)
+
+    pattern_hash = 0
+    window_hash = 0
+    for index in range(size):
+        pattern_hash = (pattern_hash * base + pattern[index]) % mod_value
+        window_hash = (window_hash * base + sequence[index]) % mod_value
+
+    result = []
+    last_start = len(sequence) - size
+    start = 0
+    while True:
+        if window_hash == pattern_hash and sequence[start : start + size] == pattern:
+            result.append(start)
+        if start == last_start:
+            break
+        window_hash = (
+            (window_hash - sequence[start] * high) * base + sequence[start + size]
+        ) % mod_value
+        start += 1
+    return result
+
+
 # Represents a range with inclusive start and exclusive end -- [start, end)
 class Range:
+    __slots__ = ("start", "end")
+
     def __init__(self, start, end=None):
         self.start = start
         self.end = end if end is not None else start + 1
@@ -115,8 +150,10 @@ class Stopwatch:
         self._start = None
         pass
 
-    def add(self, stopwatch):
-        self._total = self._total + stopwatch._total
+    # Adds the time of another Stopwatch, multiplied by scale (e.g., to extrapolate
+    # from a sample)
+    def add(self, stopwatch, scale=1):
+        self._total = self._total + stopwatch._total * scale
 
     def total(self):
         return self._total
@@ -130,6 +167,18 @@ class Stopwatch:
         return False
 
 
+# A Stopwatch that doesn't time anything, for code that is only sometimes timed
+class NullStopwatch:
+    def total(self):
+        return 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
 # Used to provide indented logging for a function.
 #
 # Unfortunately, I don't know a good way to specify arguments.  Options implemented here:
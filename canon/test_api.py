@@ -1,7 +1,14 @@
 # Incomplete set of tests for various functions in the canon tools.
 
 import canon
+import concurrent.futures
+import glob
 import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import tempfile
 import unittest
 
 
@@ -577,6 +584,1360 @@ class TestDiffParser(unittest.TestCase):
         self.help_parse("11a10,11", 11, 11, 9, 11)
 
 
+class TestFindSubsequences(unittest.TestCase):
+    def test_find(self):
+        tests = [
+            ([1, 2, 3, 1, 2, 3, 1, 2], [1, 2], [0, 3, 6]),
+            ([1, 1, 1, 1], [1, 1], [0, 1, 2]),
+            ([1, 2, 3], [1, 2, 3], [0]),
+            ([1, 2, 3], [3], [2]),
+            ([1, 2, 3], [2, 1], []),
+            ([1, 2], [1, 2, 3], []),
+            ([1, 2], [], []),
+            ([], [1], []),
+        ]
+
+        for index, (sequence, pattern, expected) in enumerate(tests):
+            with self.subTest(i=index):
+                self.assertEqual(canon.find_subsequences(sequence, pattern), expected)
+
+
+class TestLiteralLines(unittest.TestCase):
+    def test_get_literal_lines(self):
+        tests = [
+            ([canon.Diff(["a", "b"], [])], [], (["a", "b"], [])),
+            ([canon.Diff([""], [])], [], ([""], [])),
+            ([canon.Diff(["a"], ["b"]), canon.Gap(canon.Range(1))], [], (["a"], ["b"])),
+            ([canon.Diff(["a[[#]]"], [])], [], None),
+            ([canon.Diff(["a{{.*}}"], [])], [], None),
+            ([canon.Diff(["a"], [], repeat=canon.Range(0, 2))], [], None),
+            ([canon.Diff(["a"], [], is_filler=True)], [], None),
+            ([canon.Gap(canon.Range(1)), canon.Diff(["a"], [])], [], None),
+            ([canon.Diff(["a"], [])], [canon.Diff(["b"], [])], None),
+        ]
+
+        for index, (patterns, skips, expected) in enumerate(tests):
+            with self.subTest(i=index):
+                self.assertEqual(
+                    canon.get_literal_lines(patterns, skips, debug_patterns=False),
+                    expected,
+                )
+
+
+class TestDeclarativeStrategies(unittest.TestCase):
+    def test_samples_roundtrip(self):
+        for sample in sorted(glob.glob("samples/*.py")):
+            with self.subTest(sample=sample):
+                items = canon.load_strategy_file(sample)
+                lines = [json.dumps(canon.strategy_to_json(item)) for item in items]
+                converted = [canon.strategy_from_json(json.loads(l)) for l in lines]
+                self.assertEqual(repr(converted), repr(items))
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "s.jsonl")
+            with open(filename, "w") as f:
+                f.write("# comment\n")
+                f.write('{"skip": "s", "diff": {"diff": ["a"], "base": []}}\n')
+                f.write("\n")
+                f.write(
+                    '{"strategy": "t", "patterns": [{"diff": ["b"], "base": ["c"], '
+                    '"repeat": [0, 3]}, {"gap": [1, 4]}, {"diff": [], "base": ["d"], '
+                    '"filler": true}], "skips": [{"diff": ["e"], "base": []}]}\n'
+                )
+            items = canon.load_strategy_file(filename)
+
+        self.assertEqual(len(items), 2)
+        skip, strategy = items
+        self.assertEqual(skip.name, "s")
+        self.assertEqual(skip.skip.diff_lines, ["a"])
+        self.assertEqual(strategy.name, "t")
+        self.assertEqual(strategy.patterns[0].repeat, canon.Range(0, 3))
+        self.assertEqual(strategy.patterns[1].gap_range, canon.Range(1, 4))
+        self.assertTrue(strategy.patterns[2].is_filler)
+        self.assertEqual(strategy.skips[0].diff_lines, ["e"])
+
+    def test_load_fail(self):
+        tests = [
+            '{"strategy": "t"}',
+            '{"strategy": "t", "patterns": [], "extra": 1}',
+            '{"strategy": "t", "patterns": [{"diff": ["a"]}]}',
+            '{"strategy": "t", "patterns": [{"diff": "a", "base": []}]}',
+            '{"strategy": "t", "patterns": [{"gap": [1]}]}',
+            '{"skip": "s", "diff": {"diff": [], "base": []}, "patterns": []}',
+            '{"strategy": "t", "patterns": [{"diff": [], "base": [], "filler": "no"}]}',
+            '{"strategy": "t", "patterns": {"diff": [], "base": []}}',
+            '{"strategy": "t", "patterns": [], "skips": 3}',
+            '{"strategy": 1, "patterns": []}',
+            '{"skip": "s", "diff": [1]}',
+            "[1, 2]",
+            "Strategy('t')",
+        ]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "s.jsonl")
+            for index, test in enumerate(tests):
+                with self.subTest(i=index):
+                    with open(filename, "w") as f:
+                        f.write(test + "\n")
+                    with self.assertRaisesRegex(ValueError, "s.jsonl:1: "):
+                        canon.load_strategy_file(filename)
+
+
+class TestSkipState(unittest.TestCase):
+    def test_move(self):
+        skip_state = canon.DiffTool.SkipState([canon.Diff(["a", "b"], ["a", "b"])])
+        self.assertTrue(skip_state.is_complete())
+
+        skip_state.set_progress(False, 0, 1)
+        self.assertFalse(skip_state.is_complete())
+        self.assertFalse(skip_state.diff_is_complete())
+        self.assertTrue(skip_state.base_is_complete())
+
+        # finishing the diff side leaves an unmatched move
+        skip_state.set_progress(False, 0, 2)
+        self.assertEqual(skip_state.match_differences, [1])
+        self.assertEqual(skip_state.diff_progress, [0])
+        self.assertTrue(skip_state.needs_progress(True, 0))
+        self.assertFalse(skip_state.diff_is_complete())
+
+        skip_state.set_progress(True, 0, 1)
+        skip_state.set_progress(True, 0, 2)
+        self.assertEqual(skip_state.match_differences, [0])
+        self.assertTrue(skip_state.is_complete())
+
+    def test_add(self):
+        skip_state = canon.DiffTool.SkipState(
+            [canon.Diff(["a"], []), canon.Diff([], ["b", "c"])]
+        )
+        # an add or remove has no other side to balance
+        skip_state.set_progress(False, 0, 1)
+        self.assertTrue(skip_state.is_complete())
+
+        skip_state.set_progress(True, 1, 1)
+        self.assertFalse(skip_state.base_is_complete())
+        self.assertTrue(skip_state.diff_is_complete())
+        _, mapping = skip_state.get_progress(True, 1)
+        mapping["x"] = 1
+        skip_state.set_progress(True, 1, 2)
+        self.assertTrue(skip_state.is_complete())
+        self.assertEqual(skip_state.get_progress(True, 1), (0, {}))
+
+
+class TestMappedSplit(unittest.TestCase):
+    class MockConfig(canon.ConfigBase):
+        def __init__(self, mmap, opt_only, lazy_functions=False, function_index=False):
+            self.kind = "llvm"
+            self.funcspecs = None
+            self.funcnames = None
+            self.exclude_funcspecs = None
+            self.exclude_funcnames = {"skipped"}
+            self.mmap = mmap
+            self.lazy_functions = lazy_functions
+            self.function_index = function_index
+            self.index_dir = None
+            self.line_cache = 0
+            self.line_cache_scope = "pass"
+            self.timing = "phase"
+            self.timing_sample = 100
+            self.spill_lines = 0
+            self.opt_only = opt_only
+            self.only_functions = True
+            self.include_all_blank_lines = False
+            self.include_debug_info = False
+            self.include_fntable = False
+            self.include_references = False
+            self.max_line_length = 0
+            self.paranoid = False
+
+    # kind -> file contents
+    test_data = {
+        "llvm": (
+            "; header\n"
+            "declare void @g()\n"
+            "define void @skipped() {\n"
+            "  ret void\n"
+            "}\n"
+            "\n"
+            "define i32 @f(i32 %0) {\r\n"
+            "  %2 = add i32 %0, 1\r\n"
+            "\r\n"
+            "\r\n"
+            "  ret i32 %2\r\n"
+            "}\r\n"
+            "!1 = !DILocation()\n"
+            "define i32 @f(i32 %0) {\n"
+            "  call void @llvm.dbg.value(metadata i32 %0)\n"
+            "  ret i32 %0\n"
+            "}\n"
+            "define void @h() {\n"
+            "  ret void\n"
+            "}"
+        ),
+        "arm": (
+            "\t.text\n"
+            "\t.globl f // -- Begin function f\n"
+            "f:\n"
+            "\tret\n"
+            "\t// -- End function\n"
+            "\t.globl skipped // -- Begin function skipped\n"
+            "\tret\n"
+            "\t// -- End function\n"
+            "trailer\n"
+        ),
+        "x64": (
+            "header line\n"
+            "f:\n"
+            "  0000000140001000: 48 83 EC 28        sub rsp,28h\n"
+            "skipped:\n"
+            "  0000000140001004: C3                 ret\n"
+            "h:\r\n"
+            "  0000000140001005: C3                 ret\r\n"
+        ),
+        "jitx64": (
+            "; Assembly listing for method A:f()\n"
+            "; MinOpts code\n"
+            "       ret\n"
+            "; Total bytes of code 1\n"
+            "between\n"
+            "; Assembly listing for method A:g()\n"
+            "       mov rax, 1 ; comment\n"
+            "; Total bytes of code 5\n"
+        ),
+    }
+
+    def split(
+        self, kind, contents, mmap, opt_only, lazy_functions=False, only_functions=True
+    ):
+        parser = canon.parser_map()[kind]()
+        parser.config = TestMappedSplit.MockConfig(mmap, opt_only, lazy_functions)
+        parser.config.only_functions = only_functions
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "input")
+            with open(filename, "w", newline="") as f:
+                f.write(contents)
+            funcs = parser.split_file(canon.Stats("test"), filename, "dir", "label")
+            return {name: func.lines for name, func in funcs.items()}
+
+    def test_same_as_text(self):
+        for kind, contents in TestMappedSplit.test_data.items():
+            for opt_only in [False, True]:
+                with self.subTest(kind=kind, opt_only=opt_only):
+                    expected = self.split(kind, contents, False, opt_only)
+                    self.assertTrue(expected)
+                    self.assertNotIn("skipped", expected)
+                    self.assertEqual(self.split(kind, contents, True, opt_only), expected)
+                    self.assertEqual(
+                        self.split(kind, contents, True, opt_only, True), expected
+                    )
+
+    # Doesn't skip anything, for comparing with splits that do
+    class NoSkip:
+        def skip_outside(self):
+            pass
+
+        def skip_function(self):
+            pass
+
+    def test_skipping(self):
+        for kind, contents in TestMappedSplit.test_data.items():
+            for only_functions, opt_only in itertools.product([False, True], repeat=2):
+                with self.subTest(
+                    kind=kind, only_functions=only_functions, opt_only=opt_only
+                ):
+                    parser = canon.parser_map()[kind]()
+                    parser.config = TestMappedSplit.MockConfig(False, opt_only)
+                    parser.config.only_functions = only_functions
+                    funcs = parser.split_lines(
+                        canon.Stats("test"),
+                        # as read in text mode
+                        contents.replace("\r\n", "\n").splitlines(keepends=True),
+                        "dir",
+                        "label",
+                        mapped=TestMappedSplit.NoSkip(),
+                    )
+                    expected = {name: func.lines for name, func in funcs.items()}
+                    for mmap in [False, True]:
+                        split = self.split(
+                            kind, contents, mmap, opt_only, only_functions=only_functions
+                        )
+                        self.assertEqual(split, expected)
+
+    def test_lazy_functions(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(True, False, True)
+        with tempfile.TemporaryDirectory() as tmp:
+            base_file = os.path.join(tmp, "base")
+            diff_file = os.path.join(tmp, "diff")
+            with open(base_file, "w") as f:
+                f.write(TestMappedSplit.test_data["llvm"])
+            with open(diff_file, "w") as f:
+                f.write(
+                    TestMappedSplit.test_data["llvm"].replace(
+                        "@llvm.dbg.value(metadata i32 %0)", "@llvm.dbg.value(metadata i32 %1)"
+                    )
+                )
+
+            stats = canon.Stats("test")
+            base_funcs = parser.split_file(stats, base_file, "dir", "label")
+            diff_funcs = parser.split_file(stats, diff_file, "dir", "label")
+            base_h, diff_h = base_funcs["h"], diff_funcs["h"]
+            base_f, diff_f = base_funcs["f"], diff_funcs["f"]
+            self.assertIsInstance(base_h, canon.LazyFunction)
+
+            # Same bytes, so the lines are never read
+            self.assertTrue(canon.same_function_lines(base_h, diff_h))
+            self.assertIsNone(base_h.materialized)
+
+            # Different bytes but the difference is in debug info that is filtered out
+            self.assertFalse(base_f.same_bytes(diff_f))
+            self.assertTrue(canon.same_function_lines(base_f, diff_f))
+
+            # Lazy functions are sent to other processes as plain Functions
+            copy = pickle.loads(pickle.dumps(base_f))
+            self.assertIsInstance(copy, canon.Function)
+            self.assertEqual(copy.lines, base_f.lines)
+
+    def test_changed_regions(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(True, False)
+        contents = TestMappedSplit.test_data["llvm"]
+        with tempfile.TemporaryDirectory() as tmp:
+            base_file = os.path.join(tmp, "base")
+            diff_file = os.path.join(tmp, "diff")
+            with open(base_file, "w", newline="") as f:
+                f.write(contents)
+            with open(diff_file, "w", newline="") as f:
+                changed = contents.replace("ret i32 %0", "ret i32 1")
+                f.write("; more header\n" + changed)
+
+            for paranoid in [False, True]:
+                with self.subTest(paranoid=paranoid):
+                    parser.config.paranoid = paranoid
+                    stats = canon.Stats("test")
+                    unchanged = parser.find_unchanged_funcs(
+                        stats, base_file, diff_file, "dir"
+                    )
+                    # "skipped" is filtered out, and the second "f" changed
+                    self.assertEqual(unchanged, {"h"})
+                    self.assertEqual(stats.counters[canon.CounterKind.EarlyCount], 2)
+                    self.assertEqual(stats.counters[canon.CounterKind.EarlyMatch], 1)
+
+            for file in [base_file, diff_file]:
+                stats = canon.Stats("test")
+                funcs = parser.split_file(stats, file, "dir", "label")
+                split = parser.split_file(stats, file, "dir", "label", None, unchanged)
+                self.assertEqual(list(split), ["f"])
+                self.assertEqual(split["f"].lines, funcs["f"].lines)
+
+            # Lines outside functions may have changed too
+            parser.config.only_functions = False
+            self.assertEqual(
+                parser.find_unchanged_funcs(
+                    canon.Stats("test"), base_file, diff_file, "dir"
+                ),
+                set(),
+            )
+
+    def test_bytes_mode(self):
+        for kind, contents in TestMappedSplit.test_data.items():
+            for mmap in [False, True]:
+                with self.subTest(kind=kind, mmap=mmap):
+                    text_parser = canon.parser_map()[kind]()
+                    bytes_parser = canon.parser_map()[kind]().for_bytes()
+                    text_parser.config = TestMappedSplit.MockConfig(mmap, False)
+                    bytes_parser.config = text_parser.config
+                    with tempfile.TemporaryDirectory() as tmp:
+                        filename = os.path.join(tmp, "input")
+                        with open(filename, "w", newline="") as f:
+                            f.write(contents)
+                        stats = canon.Stats("test")
+                        text_funcs = text_parser.split_file(stats, filename, "d", "l")
+                        bytes_funcs = bytes_parser.split_file(stats, filename, "d", "l")
+
+                    self.assertEqual(list(bytes_funcs), list(text_funcs))
+                    for name, text_func in text_funcs.items():
+                        bytes_lines = bytes_funcs[name].lines
+                        self.assertTrue(all(isinstance(l, bytes) for l in bytes_lines))
+                        self.assertEqual(bytes_parser.text_lines(bytes_lines), text_func.lines)
+                        self.assertEqual(
+                            [bytes_parser.canon_line(l).decode() for l in bytes_lines],
+                            [text_parser.canon_line(l) for l in text_func.lines],
+                        )
+
+    def test_function_index(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(True, False, True, True)
+        contents = TestMappedSplit.test_data["llvm"]
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "input.ll")
+            with open(filename, "w", newline="") as f:
+                f.write(contents)
+            index_file = filename + canon.FunctionIndex.ext
+
+            stats = canon.Stats("test")
+            funcs = parser.split_file(stats, filename, "dir", "label")
+            self.assertTrue(os.path.exists(index_file))
+            key = canon.FunctionIndex.get_key(parser.config, filename)
+            entries = canon.FunctionIndex.load(index_file, key)
+            self.assertEqual(
+                [(e.name, e.start, e.end) for e in entries],
+                [
+                    ("skipped", 27, 65),
+                    ("f", 66, 134),
+                    ("f", 153, 237),
+                    ("h", 237, 268),
+                ],
+            )
+            self.assertTrue(all(e.hash for e in entries))
+            self.assertEqual(
+                {name: func.lines for name, func in funcs.items()},
+                self.split("llvm", contents, False, False),
+            )
+
+            # Functions are matched by their hashes, even in different files
+            copy = os.path.join(tmp, "copy.ll")
+            with open(copy, "w", newline="") as f:
+                f.write(contents.replace("define void @h()", "define void @x()"))
+            copy_funcs = parser.split_file(stats, copy, "dir", "label")
+            self.assertTrue(copy_funcs["f"].same_bytes(funcs["f"]))
+            self.assertIsNone(copy_funcs["f"].materialized)
+
+            # Equal hashes are only trusted unless paranoid
+            f = funcs["f"]
+            start, end = f.ranges[-1]
+            buffer = bytearray(f.buffer)
+            buffer[end - 2] ^= 1
+            forged = canon.LazyFunction(parser, bytes(buffer))
+            forged.ranges, forged.hashes = f.ranges, f.hashes
+            self.assertTrue(forged.same_bytes(f))
+            self.assertFalse(forged.same_bytes(f, True))
+            self.assertTrue(copy_funcs["f"].same_bytes(f, True))
+
+            # The index is used as long as the file doesn't change
+            entries[-1] = entries[-1]._replace(name="renamed")
+            canon.FunctionIndex.save(index_file, key, entries)
+            funcs = parser.split_file(stats, filename, "dir", "label")
+            self.assertIn("renamed", funcs)
+
+            os.utime(filename, ns=(0, 0))
+            funcs = parser.split_file(stats, filename, "dir", "label")
+            self.assertIn("h", funcs)
+            self.assertNotIn("renamed", funcs)
+
+            # A malformed index is rebuilt
+            key = canon.FunctionIndex.get_key(parser.config, filename)
+            for functions in [
+                [["f", 66, 134, "hash"]],
+                [["f", 66, len(contents) + 1, "hash", False]],
+                [["f", "66", 134, "hash", False]],
+                {"f": [66, 134]},
+            ]:
+                with self.subTest(functions=functions):
+                    with open(index_file, "w") as f:
+                        json.dump({"key": key, "functions": functions}, f)
+                    self.assertIsNone(canon.FunctionIndex.load(index_file, key))
+                    funcs = parser.split_file(stats, filename, "dir", "label")
+                    self.assertIn("h", funcs)
+                    self.assertEqual(
+                        len(canon.FunctionIndex.load(index_file, key)), 4
+                    )
+
+    def test_empty_file(self):
+        self.assertEqual(self.split("llvm", "", True, False), {})
+
+
+class TestLineTable(unittest.TestCase):
+    def test_intern(self):
+        table = canon.LineTable()
+        line = table.intern("".join(["  ret", "\n"]))
+        self.assertIs(table.intern("".join(["  ret", "\n"])), line)
+
+    def test_canon(self):
+        table = canon.LineTable()
+        calls = []
+
+        def canon_line(line):
+            calls.append(line)
+            return line.upper()
+
+        lines = ["a\n", "b\n", "a\n", "A\n"]
+        canon_lines = [table.canon(line, canon_line) for line in lines]
+        self.assertEqual(canon_lines, ["A\n", "B\n", "A\n", "A\n"])
+        self.assertEqual(calls, ["a\n", "b\n", "A\n"])
+        self.assertIs(canon_lines[0], canon_lines[3])
+
+    def test_split(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(False, False)
+        table = canon.LineTable()
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "input.ll")
+            with open(filename, "w") as f:
+                f.write(TestMappedSplit.test_data["llvm"])
+            stats = canon.Stats("test")
+            base_funcs = parser.split_file(stats, filename, "dir", "label", table)
+            diff_funcs = parser.split_file(stats, filename, "dir", "label", table)
+
+        for name, base_func in base_funcs.items():
+            for base_line, diff_line in zip(base_func.lines, diff_funcs[name].lines):
+                self.assertIs(base_line, diff_line)
+
+
+class TestSameFunction(unittest.TestCase):
+    def make_function(self, lines, canon_lines=None):
+        return canon.Function(lines=list(lines), canon_lines=list(canon_lines or lines))
+
+    def test_same_lines(self):
+        base = self.make_function(["a\n", "b\n"])
+        self.assertTrue(canon.same_function_lines(base, self.make_function(base.lines)))
+        self.assertFalse(canon.same_function_lines(base, self.make_function(["a\n"])))
+        self.assertFalse(
+            canon.same_function_lines(base, self.make_function(["a\n", "c\n"]))
+        )
+
+    def test_same_canon_lines(self):
+        base = self.make_function(["a 1\n", "b\n"], ["a N\n", "b\n"])
+        diff = self.make_function(["a 2\n", "b\n"], ["a N\n", "b\n"])
+        self.assertFalse(canon.same_function_lines(base, diff))
+        self.assertTrue(canon.same_function_canon_lines(base, diff))
+        diff.canon_lines[1] = "c\n"
+        self.assertFalse(canon.same_function_canon_lines(base, diff))
+
+    def test_fingerprints(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(False, False)
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "input.ll")
+            with open(filename, "w") as f:
+                f.write(TestMappedSplit.test_data["llvm"])
+            funcs = parser.split_file(canon.Stats("test"), filename, "dir", "label")
+        for func in funcs.values():
+            self.assertEqual(func.line_hash, canon.fingerprint("".join(func.lines)))
+
+        base = self.make_function(["a\n", "b\n"])
+        diff = self.make_function(["a\n", "c\n"])
+        base.line_hash = canon.fingerprint("".join(base.lines))
+        diff.line_hash = canon.fingerprint("".join(diff.lines))
+        self.assertFalse(canon.same_function_lines(base, diff))
+        # Pretend that the fingerprints collide
+        diff.line_hash = base.line_hash
+        self.assertTrue(canon.same_function_lines(base, diff))
+        self.assertFalse(canon.same_function_lines(base, diff, paranoid=True))
+
+    def test_canon_match(self):
+        tool = canon.DiffTool()
+        tool.parser = canon.LlvmParser()
+        tool.config = tool.parser.config = TestMappedSplit.MockConfig(False, False)
+        tool.config.canon_per_line = False
+        for paranoid, by_block in itertools.product([False, True], repeat=2):
+            with self.subTest(paranoid=paranoid, by_block=by_block):
+                tool.config.paranoid = paranoid
+                tool.config.canon_per_line = not by_block
+                base_funcs = {
+                    "f": self.make_function(["  %1 = add i32 %0, 1\n"]),
+                    "g": self.make_function(["  ret i32 1\n"]),
+                }
+                diff_funcs = {
+                    "f": self.make_function(["  %2 = add i32 %1, 1\n"]),
+                    "g": self.make_function(["  ret i32 2\n"]),
+                }
+                for func in itertools.chain(base_funcs.values(), diff_funcs.values()):
+                    func.canon_lines = []
+                tool.canon_match_file(
+                    canon.Stats("test"), base_funcs, diff_funcs, "label", None
+                )
+                self.assertEqual(list(base_funcs), ["g"])
+                self.assertEqual(base_funcs["g"].canon_lines, ["  ret i32 1\n"])
+                self.assertEqual(
+                    base_funcs["g"].canon_hash,
+                    canon.fingerprint("".join(base_funcs["g"].canon_lines)),
+                )
+
+    def test_pickle(self):
+        func = self.make_function(["a\n"], ["b\n"])
+        func.line_hash = canon.fingerprint("a\n")
+        copy = pickle.loads(pickle.dumps(func))
+        # Fingerprints are the same in every process
+        self.assertEqual(copy.line_hash, func.line_hash)
+        self.assertEqual(copy.lines, func.lines)
+        self.assertEqual(copy.canon_lines, func.canon_lines)
+
+
+class TestLineCache(unittest.TestCase):
+    def test_counts(self):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(False, False)
+        parser.config.line_cache = 2
+        stats = canon.Stats("test")
+
+        canon_line = parser.get_line_cache("canon_line")
+        for line in ["%1 = a\n", "%2 = b\n", "%1 = a\n", "%3 = c\n", "%2 = b\n"]:
+            self.assertEqual(canon_line(line), parser.canon_line(line))
+        parser.report_line_caches(stats)
+        self.assertEqual(stats.counters[canon.CounterKind.CanonCacheHit], 1)
+        self.assertEqual(stats.counters[canon.CounterKind.CanonCacheMiss], 4)
+
+        # Clearing for a new scope doesn't lose counts
+        parser.start_line_cache_scope(stats, "pass")
+        canon_line("%1 = a\n")
+        parser.report_line_caches(stats)
+        self.assertEqual(stats.counters[canon.CounterKind.CanonCacheMiss], 5)
+
+        copy = pickle.loads(pickle.dumps(parser))
+        self.assertIsNone(copy.line_caches)
+
+
+class TestCanonBlock(unittest.TestCase):
+    # kind -> lines to canonicalize, in addition to the test data files
+    test_lines = {
+        "llvm": [
+            "define i32 @f(i32 %0) {\n",
+            "Label_1f:                                 ; preds = %5, %3\n",
+            "12:  ; preds = %10\n",
+            "  %13 = add i32 %0, %.foo12\n",
+            "\n",
+            "}",
+        ],
+        "arm": [
+            "\tbl\t.Ltmp12\n",
+            ".LBB3_4:  // %bb.4\n",
+            "\tldr\tx1, [x2, #8]\n",
+            "\tret",
+        ],
+        "jitx64": [
+            "G_M1234_IG05:        ; offs=000040H\n",
+            "       mov      rax, qword ptr [rbp-18H]    ; comment\n",
+            "\n",
+            "; a comment line\n",
+            "  ;indented comment\n",
+            "       ret      ",
+        ],
+    }
+
+    def get_lines(self, kind):
+        lines = []
+        if kind == "llvm":
+            for filename in glob.glob(os.path.join("test_data", "*.ll")):
+                with open(filename) as f:
+                    lines.extend(f.readlines())
+        # The last line is missing its newline
+        return lines + TestCanonBlock.test_lines[kind]
+
+    def test_same_as_per_line(self):
+        for kind in TestCanonBlock.test_lines:
+            for is_bytes in [False, True]:
+                with self.subTest(kind=kind, is_bytes=is_bytes):
+                    parser = canon.parser_map()[kind]()
+                    lines = self.get_lines(kind)
+                    if is_bytes:
+                        parser.for_bytes()
+                        lines = [line.encode() for line in lines]
+                    self.assertEqual(
+                        parser.canon_lines_by_block(lines),
+                        [parser.canon_line(line) for line in lines],
+                    )
+                    self.assertEqual(parser.canon_lines_by_block(lines[:-1]), [
+                        parser.canon_line(line) for line in lines[:-1]
+                    ])
+                    self.assertEqual(parser.canon_lines_by_block([]), [])
+
+
+class TestParserRules(unittest.TestCase):
+    class RuleParser(canon.X64Parser):
+        text_attributes = ("canon_rules",)
+
+        def double(self, match):
+            return match.group(0) * 2
+
+        canon_rules = (
+            canon.Rule("#", canon.re.compile(r"#\d+"), "#N"),
+            canon.Rule(None, canon.re.compile(r"^x", canon.re.MULTILINE), double),
+        )
+
+    def test_rules(self):
+        for is_bytes in [False, True]:
+            with self.subTest(is_bytes=is_bytes):
+                parser = TestParserRules.RuleParser()
+                convert = str
+                if is_bytes:
+                    parser.for_bytes()
+                    convert = str.encode
+                tests = [
+                    ("mov #12, #3\n", "mov #N, #N\n"),
+                    ("x 12\n", "xx 12\n"),
+                    # the guard isn't there, so the pattern isn't run
+                    ("x12 3\n", "xx12 3\n"),
+                ]
+                for line, expected in tests:
+                    self.assertEqual(parser.canon_line(convert(line)), convert(expected))
+                lines = [convert(line) for line, _ in tests]
+                self.assertEqual(
+                    parser.canon_lines_by_block(lines),
+                    [convert(expected) for _, expected in tests],
+                )
+
+    def test_guard_skips_pattern(self):
+        class NeverRun:
+            def sub(self, replacement, text):
+                raise AssertionError("pattern run without its guard")
+
+        parser = canon.LlvmParser()
+        rule = canon.Rule("; preds", NeverRun(), "")
+        self.assertEqual(parser.apply_rules((rule,), "%1 = add\n"), "%1 = add\n")
+
+
+class TestParserRegistry(unittest.TestCase):
+    def test_builtin_kinds(self):
+        self.assertIs(canon.get_parser_class("llvm"), canon.LlvmParser)
+        self.assertIs(canon.parser_map()["jitx64"], canon.JITX64Parser)
+        with self.assertRaises(ValueError):
+            canon.get_parser_class("no-such-kind")
+
+    def test_lazy_and_module(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            module_file = os.path.join(temp_dir, "test_canon_parser_module.py")
+            with open(module_file, "w") as f:
+                f.write(
+                    "from canon_base import *\n"
+                    "\n"
+                    "class TestKindParser(X64Parser):\n"
+                    "    def default_filespec(self):\n"
+                    '        return "*.tk"\n'
+                    "\n"
+                    'register_parser("testkind", TestKindParser)\n'
+                    'register_parser("lazykind", "test_canon_parser_module:TestKindParser")\n'
+                )
+            try:
+                module = canon.load_parser_module(module_file)
+                self.assertIs(canon.get_parser_class("testkind"), module.TestKindParser)
+                # "module:Class" is resolved (and then kept) on first use
+                self.assertIsInstance(canon.parser_registry["lazykind"], str)
+                self.assertIs(canon.get_parser_class("lazykind"), module.TestKindParser)
+                self.assertIs(canon.parser_registry["lazykind"], module.TestKindParser)
+            finally:
+                canon.parser_registry.pop("testkind", None)
+                canon.parser_registry.pop("lazykind", None)
+                canon.sys.modules.pop("test_canon_parser_module", None)
+
+    # A parser module that overrides canon_line (rather than canon_rules) isn't
+    # canonicalized by block
+    def test_canon_line_override(self):
+        class UpperParser(canon.LlvmParser):
+            def canon_line(self, line):
+                return line.upper()
+
+        class OldStyleParser(canon.X64Parser):
+            canon_rules = ()
+
+            def canon_line(self, line):
+                return line.upper()
+
+        try:
+            for kind, parser_class in [("upper", UpperParser), ("old", OldStyleParser)]:
+                with self.subTest(kind=kind):
+                    canon.register_parser(kind, parser_class)
+                    parser = canon.get_parser_class(kind)()
+                    parser.config = TestMappedSplit.MockConfig(False, False)
+                    self.assertFalse(parser.by_block())
+                    lines = ["abc\n", "def\n"]
+                    self.assertEqual(parser.canon_chunk(lines), ["ABC\n", "DEF\n"])
+
+                    tool = canon.DiffTool()
+                    tool.parser = parser
+                    tool.config = parser.config
+                    tool.config.canon_per_line = False
+                    base_funcs = {
+                        "f": canon.Function(lines=lines, canon_lines=[]),
+                        "g": canon.Function(lines=["x\n"], canon_lines=[]),
+                    }
+                    diff_funcs = {
+                        "f": canon.Function(lines=["ABC\n", "def\n"], canon_lines=[]),
+                        "g": canon.Function(lines=["y\n"], canon_lines=[]),
+                    }
+                    tool.canon_match_file(
+                        canon.Stats("test"), base_funcs, diff_funcs, "label", None
+                    )
+                    self.assertEqual(list(base_funcs), ["g"])
+                    self.assertEqual(base_funcs["g"].canon_lines, ["X\n"])
+        finally:
+            canon.parser_registry.pop("upper", None)
+            canon.parser_registry.pop("old", None)
+        self.assertTrue(canon.LlvmParser().by_block())
+
+    # Spawned workers don't inherit the parent's modules, so they load them too
+    def test_worker_modules(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            module_file = os.path.join(temp_dir, "test_canon_worker_module.py")
+            with open(module_file, "w") as f:
+                f.write(
+                    "from canon_base import *\n"
+                    "\n"
+                    "class WorkerKindParser(X64Parser):\n"
+                    "    pass\n"
+                    "\n"
+                    'register_parser("workerkind", WorkerKindParser)\n'
+                )
+            try:
+                module = canon.load_parser_module(module_file)
+                with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=1,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=canon.init_worker,
+                    initargs=(None, [module_file]),
+                ) as executor:
+                    parser_class = executor.submit(
+                        canon.get_parser_class, "workerkind"
+                    ).result()
+                self.assertIs(parser_class, module.WorkerKindParser)
+            finally:
+                canon.parser_registry.pop("workerkind", None)
+                canon.sys.modules.pop("test_canon_worker_module", None)
+
+
+class TestSplitTiming(unittest.TestCase):
+    line_kinds = [canon.TimeKind.Filter, canon.TimeKind.FuncStart, canon.TimeKind.Append]
+
+    def split(self, timing, timing_sample=100, only_functions=False):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(False, False)
+        parser.config.only_functions = only_functions
+        parser.config.timing = timing
+        parser.config.timing_sample = timing_sample
+        stats = canon.Stats("test", timing)
+        funcs = parser.split_file(
+            stats, os.path.join("test_data", "ntum-base.ll"), "dir", "label"
+        )
+        return {name: func.lines for name, func in funcs.items()}, stats
+
+    def test_modes(self):
+        expected, _ = self.split("line")
+        for timing in ["none", "phase", "sampled", "line"]:
+            with self.subTest(timing=timing):
+                funcs, stats = self.split(timing, timing_sample=1)
+                self.assertEqual(funcs, expected)
+                self.assertEqual(
+                    stats.timers[canon.TimeKind.Split].total() > 0, timing == "phase"
+                )
+                for kind in TestSplitTiming.line_kinds:
+                    self.assertEqual(
+                        stats.timers[kind].total() > 0, timing in ["sampled", "line"]
+                    )
+                self.assertEqual(json.loads(stats.report())["timing"], timing)
+
+    # "none" and "phase" use a loop without the per-line timers
+    def test_untimed_loop(self):
+        for only_functions in [False, True]:
+            expected, _ = self.split("line", only_functions=only_functions)
+            for timing in ["none", "phase"]:
+                with self.subTest(timing=timing, only_functions=only_functions):
+                    funcs, _ = self.split(timing, only_functions=only_functions)
+                    self.assertEqual(funcs, expected)
+
+    def test_sample_scale(self):
+        sample = canon.Stopwatch("sample")
+        sample._total = 0.5
+        total = canon.Stopwatch("total")
+        total.add(sample, scale=10)
+        self.assertEqual(total.total(), 5)
+
+
+class TestSpill(unittest.TestCase):
+    def split(self, filename, spill_lines, is_bytes=False):
+        parser = canon.LlvmParser()
+        parser.config = TestMappedSplit.MockConfig(False, False)
+        parser.config.only_functions = False
+        parser.config.spill_lines = spill_lines
+        if is_bytes:
+            parser.for_bytes()
+        stats = canon.Stats("test")
+        funcs = parser.split_file(stats, filename, "dir", "label")
+        return parser, funcs, stats
+
+    def test_same_lines(self):
+        for is_bytes in [False, True]:
+            with self.subTest(is_bytes=is_bytes):
+                parser, expected, _ = self.split(os.path.join("test_data", "ntum-base.ll"), 0, is_bytes)
+                _, funcs, stats = self.split(os.path.join("test_data", "ntum-base.ll"), 3, is_bytes)
+                self.assertEqual(funcs.keys(), expected.keys())
+                spilled = [
+                    name
+                    for name, func in funcs.items()
+                    if isinstance(func, canon.SpilledFunction)
+                ]
+                self.assertTrue(spilled)
+                self.assertEqual(stats.counters[canon.CounterKind.Spilled], len(spilled))
+                for name, func in funcs.items():
+                    lines = expected[name].lines
+                    self.assertEqual(list(func.lines), lines)
+                    self.assertEqual(len(func.lines), len(lines))
+                    self.assertEqual(func.lines[len(lines) // 2], lines[len(lines) // 2])
+                    self.assertEqual(func.lines[-1], lines[-1])
+                    self.assertEqual(func.lines[3:9], lines[3:9])
+                    self.assertEqual(
+                        list(parser.text_lines(func.lines)), parser.text_lines(lines)
+                    )
+                    if name in spilled:
+                        self.assertEqual(
+                            list(func.canon_lines),
+                            [parser.canon_line(line) for line in lines],
+                        )
+                        copy = pickle.loads(pickle.dumps(func))
+                        self.assertEqual(copy.lines, lines)
+
+    def write(self, tmp, name, lines):
+        filename = os.path.join(tmp, name)
+        with open(filename, "w") as f:
+            f.write("define void @f() {\n" + "".join(lines) + "}\n")
+        return filename
+
+    def test_compare(self):
+        lines = ["  %{} = add i64 %{}, 1\n".format(i + 1, i) for i in range(20)]
+        renumbered = list(lines)
+        renumbered[10] = "  %99 = add i64 %10, 1\n"
+        changed = list(lines)
+        changed[10] = "  %11 = sub i64 %10, 1\n"
+        # name -> (lines, same lines as the base, same canonicalized lines)
+        tests = {
+            "same": (lines, True, True),
+            "renumbered": (renumbered, False, True),
+            "changed": (changed, False, False),
+            "shorter": (lines[:-1], False, False),
+        }
+        with tempfile.TemporaryDirectory() as tmp:
+            base_file = self.write(tmp, "base", lines)
+            _, unspilled, _ = self.split(base_file, 0)
+            for paranoid in [False, True]:
+                for name, (diff_lines, same, same_canon) in tests.items():
+                    with self.subTest(name=name, paranoid=paranoid):
+                        diff_file = self.write(tmp, name, diff_lines)
+                        base_func = self.split(base_file, 6)[1]["f"]
+                        diff_func = self.split(diff_file, 6)[1]["f"]
+                        self.assertIsInstance(base_func, canon.SpilledFunction)
+                        self.assertEqual(
+                            canon.same_function_lines(base_func, diff_func, paranoid),
+                            same,
+                        )
+                        self.assertEqual(
+                            canon.same_function_canon_lines(
+                                base_func, diff_func, paranoid
+                            ),
+                            same_canon,
+                        )
+                        if name == "renumbered" and not paranoid:
+                            # Only the chunk with the difference was canonicalized
+                            self.assertEqual(list(base_func.canon_hashes), [1])
+
+                        # Never the same as a function that wasn't spilled
+                        self.assertFalse(
+                            canon.same_function_lines(unspilled["f"], base_func)
+                        )
+
+
+class TestNameFilter(unittest.TestCase):
+    def test_bloom(self):
+        names = ["f{}".format(i) for i in range(1000)]
+        name_filter = canon.NameFilter.build(names)
+        self.assertTrue(all(name_filter.may_contain(name) for name in names))
+        false_positives = sum(
+            name_filter.may_contain("g{}".format(i)) for i in range(1000)
+        )
+        self.assertLess(false_positives, 50)
+        self.assertFalse(canon.NameFilter.build([]).may_contain_any(["f"]))
+
+    def test_sidecar(self):
+        parser = canon.LlvmParser()
+        parser.config = config = TestMappedSplit.MockConfig(False, False)
+        config.name_filter = True
+        config.funcnames = {None: frozenset(["f"]), "d1": frozenset(["h"])}
+        with tempfile.TemporaryDirectory() as tmp:
+            config.name_filter_dir = os.path.join(tmp, "filters")
+            file = os.path.join(tmp, "input.ll")
+            with open(file, "w") as f:
+                f.write(TestMappedSplit.test_data["llvm"])
+            filter_file = canon.get_sidecar_file(
+                config.name_filter_dir, file, canon.NameFilter.ext
+            )
+
+            def may_have(inner_dir, build=True):
+                return canon.NameFilter.may_have_wanted_funcs(
+                    config, parser, file, inner_dir, build
+                )
+
+            # Without a filter, queueing a file doesn't build one
+            config.funcnames = {None: frozenset(["x"])}
+            self.assertTrue(may_have("d1", build=False))
+            self.assertFalse(os.path.exists(filter_file))
+            self.assertFalse(may_have("d1"))
+            self.assertTrue(os.path.exists(filter_file))
+            self.assertFalse(may_have("d1", build=False))
+
+            config.funcnames = {None: frozenset(["f"]), "d1": frozenset(["h"])}
+            self.assertTrue(may_have("d1"))
+            config.funcnames = {None: frozenset(["x"]), "d1": frozenset(["h"])}
+            self.assertFalse(may_have("d2"))
+            self.assertTrue(may_have("d1"))
+
+            # Only with --only-functions
+            config.only_functions = False
+            self.assertTrue(may_have("d2"))
+            config.only_functions = True
+
+            # A copy (with a new modification time) uses the same filter
+            os.utime(file, ns=(0, 0))
+            with open(filter_file) as f:
+                bits = json.load(f)["bits"]
+            parser.scan_functions = None  # would fail if it was used
+            self.assertTrue(may_have("d1"))
+            with open(filter_file) as f:
+                contents = json.load(f)
+            self.assertEqual(contents["bits"], bits)
+            self.assertEqual(contents["key"]["mtime_ns"], 0)
+            del parser.scan_functions
+
+            # A malformed filter is rebuilt
+            with open(filter_file, "w") as f:
+                json.dump(dict(contents, bits=7), f)
+            config.funcnames = {"d1": frozenset(["x"])}
+            self.assertTrue(may_have("d1", build=False))
+            self.assertFalse(may_have("d1"))
+            with open(filter_file) as f:
+                self.assertEqual(json.load(f)["bits"], bits)
+
+            # Changed contents
+            with open(file, "w") as f:
+                f.write(TestMappedSplit.test_data["llvm"].replace("@h(", "@x("))
+            config.funcnames = {"d1": frozenset(["h"])}
+            self.assertFalse(may_have("d1"))
+            # No functions at all are wanted from d2
+            self.assertFalse(may_have("d2"))
+            config.funcnames = {"d1": frozenset(["x"])}
+            self.assertTrue(may_have("d1"))
+
+
+class TestDirWalk(unittest.TestCase):
+    def make_tree(self, root, files):
+        for file in files:
+            path = os.path.join(root, file)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(file)
+
+    def test_add_dirwalks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base_dir = os.path.join(tmp, "base")
+            diff_dir = os.path.join(tmp, "diff")
+            self.make_tree(
+                base_dir, ["a.ll", "b.txt", "x.ll", "d1/c.ll", "d1/d2/e.ll", "d3/x.ll"]
+            )
+            self.make_tree(diff_dir, ["a.ll", "d1/c.ll", "d1/f.ll"])
+            # Linked directories aren't walked
+            os.symlink(os.path.join(base_dir, "d1"), os.path.join(diff_dir, "link"))
+
+            walks = [(base_dir, canon.HasFile.BASE), (diff_dir, canon.HasFile.DIFF)]
+            for threads in [1, 2, 8]:
+                with self.subTest(threads=threads):
+                    dir_dict = {}
+                    stat_dict = {}
+                    listed = []
+                    dir_count = canon.HasFile.add_dirwalks(
+                        dir_dict,
+                        walks,
+                        ["*.ll", "*.s"],
+                        ["x*", "*.s"],
+                        stat_dict,
+                        threads,
+                        lambda dirpath, value: listed.append(
+                            (dirpath, value, dict(dir_dict.get(dirpath, {})))
+                        ),
+                    )
+                    self.assertEqual(dir_count, 6)
+                    # Each directory's files are there as soon as it is listed
+                    self.assertEqual(len(listed), 6)
+                    self.assertIn(
+                        ("d1", canon.HasFile.DIFF),
+                        [(dirpath, value) for dirpath, value, _ in listed],
+                    )
+                    for dirpath, value, files in listed:
+                        if dirpath == "d1" and value == canon.HasFile.BASE:
+                            self.assertTrue(files["c.ll"] & canon.HasFile.BASE)
+                    self.assertEqual(
+                        dir_dict,
+                        {
+                            ".": {"a.ll": canon.HasFile.BOTH},
+                            "d1": {
+                                "c.ll": canon.HasFile.BOTH,
+                                "f.ll": canon.HasFile.DIFF,
+                            },
+                            os.path.join("d1", "d2"): {"e.ll": canon.HasFile.BASE},
+                        },
+                    )
+                    self.assertEqual(len(stat_dict), 6)
+                    stat = stat_dict[("d1", "c.ll", canon.HasFile.BASE)]
+                    self.assertEqual(stat.st_size, len("d1/c.ll"))
+
+            # The same as os.walk and fnmatch
+            dir_dict = {}
+            canon.HasFile.add_dirwalk(
+                dir_dict, base_dir, canon.HasFile.BASE, ["*"], []
+            )
+            expected = {}
+            for dirpath, _, filenames in os.walk(base_dir):
+                for filename in filenames:
+                    canon.HasFile.add_file(
+                        expected,
+                        os.path.relpath(dirpath, base_dir),
+                        filename,
+                        canon.HasFile.BASE,
+                    )
+            self.assertEqual(dir_dict, expected)
+
+            # No filespecs match nothing
+            dir_dict = {}
+            canon.HasFile.add_dirwalk(dir_dict, base_dir, canon.HasFile.BASE, [], [])
+            self.assertEqual(dir_dict, {})
+
+
+class TestIdenticalFiles(unittest.TestCase):
+    def test_find_identical_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, "hashes.json")
+            os.makedirs(os.path.join(tmp, "base"))
+            os.makedirs(os.path.join(tmp, "diff"))
+            contents = {
+                "same.ll": ("a\n", "a\n"),
+                "changed.ll": ("a\n", "b\n"),
+                "longer.ll": ("a\n", "a\na\n"),
+            }
+            for file, (base, diff) in contents.items():
+                for side, text in [("base", base), ("diff", diff)]:
+                    path = os.path.join(tmp, side, file)
+                    with open(path, "w") as f:
+                        f.write(text)
+                    # Old enough to be cached
+                    os.utime(path, (1000000000, 1000000000))
+            os.link(
+                os.path.join(tmp, "base", "changed.ll"),
+                os.path.join(tmp, "base", "linked.ll"),
+            )
+            os.link(
+                os.path.join(tmp, "base", "changed.ll"),
+                os.path.join(tmp, "diff", "linked.ll"),
+            )
+
+            walks = [
+                (os.path.join(tmp, "base"), canon.HasFile.BASE),
+                (os.path.join(tmp, "diff"), canon.HasFile.DIFF),
+            ]
+            dir_dict = {}
+            stat_dict = {}
+            canon.HasFile.add_dirwalks(dir_dict, walks, ["*.ll"], [], stat_dict)
+            pairs = {
+                file: tuple(os.path.join(tmp, side, file) for side in ["base", "diff"])
+                for file in dir_dict["."]
+            }
+
+            tool = canon.DiffTool()
+            expected = {"same.ll", "linked.ll"}
+            self.assertEqual(tool.find_identical_files(".", pairs, stat_dict), expected)
+            for run in range(2):
+                with canon.FileHashCache(cache_file, 2) as hash_cache:
+                    identical = tool.find_identical_files(
+                        ".", pairs, stat_dict, hash_cache
+                    )
+                    self.assertEqual(identical, expected)
+                    # Only files of the same size that aren't linked are hashed,
+                    # and the second time, they are in the cache
+                    self.assertEqual(len(hash_cache.hashes), 4)
+                    self.assertEqual(hash_cache.changed, run == 0)
+
+            # A changed file is hashed again
+            path = os.path.join(tmp, "diff", "same.ll")
+            with open(path, "w") as f:
+                f.write("b\n")
+            os.utime(path, (1000000001, 1000000001))
+            stat_dict[(".", "same.ll", canon.HasFile.DIFF)] = os.stat(path)
+            with canon.FileHashCache(cache_file, 2) as hash_cache:
+                identical = tool.find_identical_files(".", pairs, stat_dict, hash_cache)
+                self.assertEqual(identical, {"linked.ll"})
+
+    # queue_dir runs on its own thread while finished jobs' stats are added, so its
+    # stats are only added to the tool's under the controller's lock
+    def test_queue_dir_stats(self):
+        class MockLock:
+            held = False
+
+            def __enter__(self):
+                self.held = True
+
+            def __exit__(self, type, value, traceback):
+                self.held = False
+
+        class MockController:
+            def __init__(self):
+                self.lock = MockLock()
+                self.jobs = []
+
+            def queue_job(self, *args, **kwargs):
+                self.jobs.append(args[1:3])
+
+        class LockedStats(canon.Stats):
+            def add(self, stat):
+                assert controller.lock.held
+                super().add(stat)
+                added.append(stat)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for side, text in [("base", "a\n"), ("diff", "b\n")]:
+                os.makedirs(os.path.join(tmp, side))
+                for file in ["same.ll", "changed.ll"]:
+                    with open(os.path.join(tmp, side, file), "w") as f:
+                        f.write("a\n" if file == "same.ll" else text)
+            base, diff = (os.path.join(tmp, side) for side in ["base", "diff"])
+
+            tool = canon.DiffTool()
+            tool.config = canon.DiffTool.parse_args(
+                ["-b", base, "-d", diff, "-o", os.path.join(tmp, "out")]
+            )
+            tool.parser = None
+            tool.stats = LockedStats("Total")
+            controller = MockController()
+            added = []
+            both = canon.HasFile.BOTH
+            tool.queue_dir(controller, ".", {"same.ll": both, "changed.ll": both}, {})
+
+        self.assertEqual(len(added), 1)
+        changed = tuple(os.path.join(root, ".", "changed.ll") for root in [base, diff])
+        self.assertEqual(controller.jobs, [changed])
+
+
+    def test_malformed_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_file = os.path.join(tmp, "hashes.json")
+            file = os.path.join(tmp, "a.ll")
+            with open(file, "w") as f:
+                f.write("a\n")
+            os.utime(file, (1000000000, 1000000000))
+            file_hash = canon.hash_file(file)
+            version = canon.FileHashCache.version
+            for files in [[], {file: [1, 2]}, {file: {"size": 2}}, {file: [2, 3, 4]}]:
+                with self.subTest(files=files):
+                    with open(cache_file, "w") as f:
+                        json.dump({"version": version, "files": files}, f)
+                    with canon.FileHashCache(cache_file, 1) as hash_cache:
+                        self.assertEqual(hash_cache.hashes, {})
+                        hashes = hash_cache.get_hashes([(file, None)])
+                        self.assertEqual(hashes, [file_hash])
+                    with open(cache_file) as f:
+                        saved = json.load(f)["files"]
+                    self.assertEqual(saved[os.path.abspath(file)][2], file_hash)
+
+
+class TestPrefetch(unittest.TestCase):
+    class MockConfig:
+        def __init__(self, prefetch):
+            self.jobs = 1
+            self.prefetch = prefetch
+            self.diff_limit = None
+            self.func_limit = None
+            self.file_limit = None
+
+    def test_prefetcher(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            file = os.path.join(tmp, "input.ll")
+            with open(file, "wb") as f:
+                f.write(b"x" * (canon.Prefetcher.block_size + 1))
+            prefetcher = canon.Prefetcher.get()
+            self.assertIs(canon.Prefetcher.get(), prefetcher)
+            # Missing files are ignored
+            prefetcher.prefetch([file, os.path.join(tmp, "missing.ll")])
+            prefetcher.files.join()
+            self.assertIn(file, prefetcher.recent)
+
+    def test_controller(self):
+        def job(*files):
+            jobs.append(files)
+
+        def launcher(controller):
+            for i in range(3):
+                files = (
+                    os.path.join(tmp, "base{}.ll".format(i)),
+                    os.path.join(tmp, "diff{}.ll".format(i)),
+                )
+                controller.queue_job(job, *files, files=files)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            for prefetch in [False, True]:
+                with self.subTest(prefetch=prefetch):
+                    jobs = []
+                    config = TestPrefetch.MockConfig(prefetch)
+                    canon.Controller(config, canon.Stats("test"), launcher).go()
+                    self.assertEqual(len(jobs), 3)
+                    recent = canon.Prefetcher.get().recent
+                    # Each job runs as soon as it is queued, so only the rest of
+                    # its own files are prefetched
+                    self.assertEqual(
+                        os.path.join(tmp, "diff0.ll") in recent, prefetch
+                    )
+                    self.assertNotIn(os.path.join(tmp, "base0.ll"), recent)
+
+
+class TestSharedLimits(unittest.TestCase):
+    class MockConfig:
+        def __init__(self, diff_limit, func_limit):
+            self.diff_limit = diff_limit
+            self.func_limit = func_limit
+
+    def test_unlimited(self):
+        limits = canon.SharedLimits(TestSharedLimits.MockConfig(None, None))
+        self.assertEqual(limits.reserve(1000), 1000)
+        self.assertEqual(limits.reserve(0), 0)
+        self.assertFalse(limits.reached())
+
+    def test_diff_limit(self):
+        limits = canon.SharedLimits(TestSharedLimits.MockConfig(5, None))
+        self.assertEqual(limits.reserve(3), 3)
+        self.assertFalse(limits.reached())
+        # only the remainder of the limit is granted
+        self.assertEqual(limits.reserve(3), 2)
+        self.assertTrue(limits.reached())
+        self.assertEqual(limits.reserve(1), 0)
+        self.assertEqual(limits.diff_count.value, 5)
+
+    def test_func_limit(self):
+        limits = canon.SharedLimits(TestSharedLimits.MockConfig(None, 2))
+        self.assertEqual(limits.reserve(10), 10)
+        self.assertEqual(limits.reserve(10), 10)
+        self.assertTrue(limits.reached())
+        self.assertEqual(limits.reserve(1), 0)
+        self.assertEqual(limits.func_count.value, 2)
+
+    # A job that was queued before a limit was reached doesn't read its files
+    def test_skip_queued_job(self):
+        config = TestSharedLimits.MockConfig(None, 1)
+        config.timing = "phase"
+        limits = canon.SharedLimits(config)
+        limits.reserve(1)
+        tool = canon.DiffTool()
+        tool.config = config
+        tool.parser = None  # would fail if the files were split
+        saved = canon.SharedLimits.current
+        canon.SharedLimits.install(limits)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                result = tool.process_file(
+                    os.path.join(tmp, "base.ll"),
+                    os.path.join(tmp, "diff.ll"),
+                    tmp,
+                    "dir",
+                    "",
+                    "label",
+                )
+        finally:
+            canon.SharedLimits.install(saved)
+        self.assertEqual(result[:3], (tmp, {}, {}))
+
+
 class TestFuncNameSet(unittest.TestCase):
     class MockConfig(canon.ConfigBase):
         def __init__(self, funcnames):
@@ -661,6 +2022,67 @@ class TestFuncNameSet(unittest.TestCase):
                 config = TestFuncNameSet.MockConfig(mapping)
                 for dir_name, funcname, answer in answers:
                     self.assertEqual(config.keep_func(dir_name, funcname), answer)
+                    # again, from the memo
+                    self.assertEqual(config.keep_func(dir_name, funcname), answer)
+
+    def test_funcname_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "names")
+            with open(filename, "w") as f:
+                f.write("a\n\n  d1:d1a\r\nb\n")
+            names = canon.ConfigBase.read_funcname_file(filename)
+        self.assertEqual(names, ["a", "d1:d1a", "b"])
+        self.assertEqual(
+            canon.ConfigBase.process_arg_funcnames(names),
+            {None: {"a", "b"}, "d1": {"d1a"}},
+        )
+
+
+class TestFuncSpecs(unittest.TestCase):
+    # (funcspecs, combined, names that any of them are found in, names they aren't)
+    test_data = [
+        ([], False, [], ["f"]),
+        (["^f"], False, ["f", "foo"], ["of"]),
+        (["^f", "bar$", "b.z"], True, ["foo", "xbar", "abiz"], ["ofo", "barx", "bz"]),
+        # group numbers would be wrong in the combination
+        (["(a)\\1", "^f"], False, ["xaa", "f"], ["ab", "of"]),
+        (["(?P<x>a)(?P=x)", "^f"], False, ["aa", "f"], ["ab"]),
+        # a global flag would apply to all
+        (["(?i)^f", "bar$"], False, ["Foo", "bar"], ["BAR"]),
+        # a repeated group name doesn't compile
+        (["(?P<x>a)", "(?P<x>b)"], False, ["a", "b"], ["c"]),
+    ]
+
+    def test_search(self):
+        for index, (specs, combined, found, not_found) in enumerate(
+            TestFuncSpecs.test_data
+        ):
+            with self.subTest(i=index):
+                funcspecs = canon.FuncSpecs(specs)
+                self.assertEqual(len(funcspecs), len(specs))
+                self.assertEqual(funcspecs.combined is not None, combined)
+                for name in found:
+                    self.assertTrue(funcspecs.search(name), name)
+                for name in not_found:
+                    self.assertFalse(funcspecs.search(name), name)
+
+    # The command line values are passed as one iterator
+    def test_command_line(self):
+        config = canon.DiffTool.parse_args(
+            ["-b", "base", "-d", "diff", "-S", "^f", "bar$", "-S", "b.z"]
+            + ["-T", "zzz", "yyy"]
+        )
+        self.assertEqual(len(config.funcspecs), 3)
+        self.assertIsNotNone(config.funcspecs.combined)
+        for name, keep in [
+            ("foo", True),
+            ("xbar", True),
+            ("abiz", True),
+            ("ofo", False),
+            ("fzzz", False),
+            ("yyybar", False),
+        ]:
+            self.assertEqual(config.keep_func("dir", name), keep, name)
 
 
 if __name__ == "__main__":
@@ -4,6 +4,8 @@
 import builtins
 import canon_base
 import canon
+import os
+import tempfile
 import unittest
 
 
@@ -69,7 +71,52 @@ class TestSamples(unittest.TestCase):
         filtered_diff_commands = test_difftool.filter_diff(context)
         self.assertEqual(filtered_diff_commands, [diff2])
 
+    def test_literal(self):
+        base_lines = ["1\n", "a\n", "b\n", "2\n", "3\n", "a\n", "b\n", "4\n"]
+        diff_lines = ["1\n", "2\n", "a\n", "b\n", "3\n", "4\n"]
+
+        diff1 = canon.DiffCommand(canon.Range(1, 1), canon.Range(1, 3))
+        diff2 = canon.DiffCommand(canon.Range(2, 4), canon.Range(4, 4))
+        diff3 = canon.DiffCommand(canon.Range(5, 5), canon.Range(5, 7))
+        diff_commands = [diff1, diff2, diff3]
+
+        strategies = [
+            canon.compile_strategy(
+                canon.Strategy(name="remove ab", patterns=[canon.Diff([], ["a", "b"])]),
+                global_skips=[],
+            )
+        ]
+        self.assertEqual(strategies[0].literal_lines, ([], ["a", "b"]))
+
+        test_difftool = canon.DiffTool()
+        test_difftool.config = MockConfig()
+
+        stats = canon.Stats("literal")
+        context = canon.DiffTool.MatchContext(
+            stats=stats,
+            base_file_lines=base_lines,
+            diff_file_lines=diff_lines,
+            commands=diff_commands,
+            strategies=strategies,
+            skips=[],
+        )
+        filtered_diff_commands = test_difftool.filter_diff(context)
+        self.assertEqual(filtered_diff_commands, [diff2])
+        self.assertEqual(context.get_literal_starts(strategies[0], True), {1, 5})
+        self.assertEqual(stats.strategy_counters, {"remove ab": 2})
+
     def test_ntum(self):
+        self._test_ntum("samples/ntum.py")
+
+    def test_ntum_declarative(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "ntum.jsonl")
+            canon.write_declarative_strategy_file(
+                canon.load_strategy_file("samples/ntum.py"), filename
+            )
+            self._test_ntum(filename)
+
+    def _test_ntum(self, strategy_filename):
         with open("test_data/ntum-base.ll", "r") as f:
             base_lines = f.readlines()
         with open("test_data/ntum-diff.ll", "r") as f:
@@ -80,7 +127,7 @@ class TestSamples(unittest.TestCase):
             canon.DiffCommand(canon.Range(x), canon.Range(x)) for x in range(1, 12, 2)
         ]
         skips, strategies = canon.load_strategy_files(
-            ["samples/ntum.py"], is_debug_patterns=False
+            [strategy_filename], is_debug_patterns=False
         )
 
         test_difftool = canon.DiffTool()